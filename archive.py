@@ -0,0 +1,332 @@
+import os
+import time
+import zlib
+import gzip
+import struct
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 256 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_ENTRY_LIMIT = 0xFFFF
+# Deflate can grow incompressible data slightly, so switch to ZIP64 early
+ZIP64_SAFE_SIZE = 0xFFFFFFFF - 0x1000000
+
+STORED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm', '.m4v',
+    '.mp3', '.aac', '.m4a', '.ogg', '.opus', '.flac',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.apk', '.jar', '.dmg', '.iso'
+}
+
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+# An empty final deflate block, closing a stream built from sync-flushed pieces
+DEFLATE_FINAL_BLOCK = b'\x03\x00'
+
+FORMATS = ('zip', 'tar', 'tar.gz', 'tar.zst')
+
+def dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+def is_precompressed(name):
+    return os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+
+def iter_tree(root):
+    """Yield (full_path, arcname) for every file under root."""
+    for current, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            full_path = os.path.join(current, name)
+            yield full_path, os.path.relpath(full_path, root).replace(os.sep, '/')
+
+def ordered_map(func, items, workers, window=None):
+    """Apply func to items on a thread pool and yield (item, result) in input order.
+
+    At most `window` items are in flight, which bounds memory to a few
+    chunks per worker. With one worker everything runs inline.
+    """
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    window = window or workers * 2
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= window:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def rechunk(blocks, size):
+    buffer = []
+    buffered = 0
+    for data in blocks:
+        if not data:
+            continue
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= size:
+            joined = b''.join(buffer)
+            for start in range(0, len(joined) - size + 1, size):
+                yield joined[start:start + size]
+            rest = joined[len(joined) - len(joined) % size:]
+            buffer = [rest] if rest else []
+            buffered = len(rest)
+    if buffer:
+        yield b''.join(buffer)
+
+class ZipEntry:
+    def __init__(self, arcname, method, mtime, mode, size):
+        self.arcname = arcname.encode('utf-8')
+        self.method = method
+        self.dos_time, self.dos_date = dos_datetime(mtime)
+        self.mode = mode
+        self.offset = 0
+        self.zip64 = size >= ZIP64_SAFE_SIZE
+        self.crc = 0
+        self.compressed_size = 0
+        self.size = 0
+        self.compressor = None
+
+class ZipStream:
+    """Build a ZIP archive as a stream of bytes without seeking or temp files.
+
+    Every member is written with a data descriptor so CRC and sizes can
+    follow the data. ZIP64 records are emitted only for members, offsets
+    or entry counts that need them. With more than one worker each chunk
+    is deflated independently on a thread pool and closed with a sync
+    flush, so the pieces concatenate into one valid deflate stream.
+    """
+
+    def __init__(self, compression_level=6, workers=1, chunk_size=CHUNK_SIZE):
+        self.compression_level = max(0, min(9, int(compression_level)))
+        self.workers = max(1, int(workers))
+        self.chunk_size = chunk_size
+        self.entries = []
+        self.offset = 0
+
+    def method_for(self, arcname):
+        if self.compression_level == 0 or is_precompressed(arcname):
+            return METHOD_STORED
+        return METHOD_DEFLATED
+
+    def local_header(self, entry):
+        extra = b''
+        if entry.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            sizes = (ZIP64_LIMIT, ZIP64_LIMIT)
+        else:
+            sizes = (0, 0)
+        header = struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if entry.zip64 else 20,
+            FLAG_DATA_DESCRIPTOR | FLAG_UTF8, entry.method, entry.dos_time, entry.dos_date,
+            0, sizes[0], sizes[1], len(entry.arcname), len(extra)
+        )
+        return header + entry.arcname + extra
+
+    def data_descriptor(self, entry):
+        if entry.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, entry.crc, entry.compressed_size, entry.size)
+        return struct.pack('<IIII', 0x08074b50, entry.crc, entry.compressed_size, entry.size)
+
+    def central_header(self, entry):
+        fields = []
+        size = entry.size
+        compressed_size = entry.compressed_size
+        offset = entry.offset
+        if size >= ZIP64_LIMIT:
+            fields.append(size)
+            size = ZIP64_LIMIT
+        if compressed_size >= ZIP64_LIMIT:
+            fields.append(compressed_size)
+            compressed_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = ZIP64_LIMIT
+        extra = b''
+        if fields:
+            extra = struct.pack('<HH', 0x0001, 8 * len(fields)) + b''.join(struct.pack('<Q', f) for f in fields)
+        version = 45 if (fields or entry.zip64) else 20
+        header = struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version,
+            FLAG_DATA_DESCRIPTOR | FLAG_UTF8, entry.method, entry.dos_time, entry.dos_date,
+            entry.crc, compressed_size, size, len(entry.arcname), len(extra), 0, 0, 0,
+            (entry.mode & 0xFFFF) << 16, offset
+        )
+        return header + entry.arcname + extra
+
+    def end_records(self, cd_offset, cd_size):
+        count = len(self.entries)
+        records = b''
+        if count >= ZIP64_ENTRY_LIMIT or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            zip64_offset = cd_offset + cd_size
+            records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, cd_size, cd_offset)
+            records += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+        records += struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, ZIP64_ENTRY_LIMIT), min(count, ZIP64_ENTRY_LIMIT),
+            min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0
+        )
+        return records
+
+    def emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def iter_blocks(self, members):
+        for full_path, arcname in members:
+            try:
+                f = open(full_path, 'rb')
+            except OSError:
+                continue
+            with f:
+                stat_result = os.fstat(f.fileno())
+                entry = ZipEntry(arcname, self.method_for(arcname), stat_result.st_mtime, stat_result.st_mode, stat_result.st_size)
+                if entry.method == METHOD_DEFLATED and self.workers == 1:
+                    entry.compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+                yield 'start', entry, None
+                # Stop at the size seen when the header was written so a file
+                # growing underneath us cannot outgrow a non-ZIP64 entry
+                remaining = stat_result.st_size
+                while remaining > 0:
+                    data = f.read(min(self.chunk_size, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield 'data', entry, data
+                yield 'end', entry, None
+
+    def compress_block(self, item):
+        kind, entry, data = item
+        if kind != 'data' or entry.method != METHOD_DEFLATED:
+            return data
+        if entry.compressor:
+            return entry.compressor.compress(data)
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def iter_members(self, members):
+        for (kind, entry, data), result in ordered_map(self.compress_block, self.iter_blocks(members), self.workers):
+            if kind == 'start':
+                entry.offset = self.offset
+                yield self.emit(self.local_header(entry))
+            elif kind == 'data':
+                entry.size += len(data)
+                entry.crc = zlib.crc32(data, entry.crc)
+                if result:
+                    entry.compressed_size += len(result)
+                    yield self.emit(result)
+            else:
+                if entry.method == METHOD_DEFLATED:
+                    tail = entry.compressor.flush() if entry.compressor else DEFLATE_FINAL_BLOCK
+                    entry.compressed_size += len(tail)
+                    yield self.emit(tail)
+                yield self.emit(self.data_descriptor(entry))
+                self.entries.append(entry)
+
+    def iter_central_directory(self):
+        cd_offset = self.offset
+        for entry in self.entries:
+            yield self.emit(self.central_header(entry))
+        yield self.end_records(cd_offset, self.offset - cd_offset)
+
+    def iter_directory(self, root):
+        def parts():
+            yield from self.iter_members(iter_tree(root))
+            yield from self.iter_central_directory()
+        return rechunk(parts(), self.chunk_size)
+
+class TarStream:
+    """Build a tar archive as a stream, optionally gzip or zstd compressed.
+
+    gzip output is a series of independent gzip members, one per block,
+    compressed on a thread pool; readers treat concatenated members as a
+    single file. zstd uses the library's own worker threads.
+    """
+
+    def __init__(self, compression=None, compression_level=6, workers=1, chunk_size=CHUNK_SIZE, block_size=1024 * 1024):
+        if compression == 'zst' and zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        self.compression = compression
+        self.compression_level = compression_level
+        self.workers = max(1, int(workers))
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+
+    def iter_tar(self, members):
+        for full_path, arcname in members:
+            try:
+                f = open(full_path, 'rb')
+            except OSError:
+                continue
+            with f:
+                stat_result = os.fstat(f.fileno())
+                info = tarfile.TarInfo(arcname)
+                info.size = stat_result.st_size
+                info.mtime = int(stat_result.st_mtime)
+                info.mode = stat_result.st_mode & 0o7777
+                yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+                remaining = info.size
+                while remaining > 0:
+                    data = f.read(min(self.chunk_size, remaining))
+                    if not data:
+                        # The file shrank; pad so the header stays truthful
+                        data = bytes(min(self.chunk_size, remaining))
+                    remaining -= len(data)
+                    yield data
+                if info.size % tarfile.BLOCKSIZE:
+                    yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+        yield bytes(tarfile.BLOCKSIZE * 2)
+
+    def gzip_block(self, data):
+        return gzip.compress(data, compresslevel=self.compression_level, mtime=0)
+
+    def iter_directory(self, root):
+        blocks = rechunk(self.iter_tar(iter_tree(root)), self.block_size)
+        if self.compression == 'gz':
+            for _, compressed in ordered_map(self.gzip_block, blocks, self.workers):
+                yield compressed
+        elif self.compression == 'zst':
+            compressor = zstandard.ZstdCompressor(level=self.compression_level, threads=self.workers if self.workers > 1 else 0).compressobj()
+            for data in blocks:
+                compressed = compressor.compress(data)
+                if compressed:
+                    yield compressed
+            yield compressor.flush()
+        else:
+            yield from blocks
+
+def stream_directory(root, archive_format='zip', compression_level=6, workers=1):
+    """Return (iterator, mimetype, extension) for the requested archive format."""
+    if archive_format == 'zip':
+        return ZipStream(compression_level, workers).iter_directory(root), 'application/zip', '.zip'
+    if archive_format == 'tar':
+        return TarStream(None, compression_level, workers).iter_directory(root), 'application/x-tar', '.tar'
+    if archive_format == 'tar.gz':
+        return TarStream('gz', compression_level, workers).iter_directory(root), 'application/gzip', '.tar.gz'
+    if archive_format == 'tar.zst':
+        return TarStream('zst', compression_level, workers).iter_directory(root), 'application/zstd', '.tar.zst'
+    raise ValueError(f"Unsupported archive format: {archive_format}")
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import shutil
+import zipfile
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import archive
+
+def make_tree(root, files, file_size):
+    """Create a source-tree-like folder of compressible text files."""
+    line = b"def handler(request):\n    return jsonify({'status': 'ok', 'items': items})\n"
+    content = (line * (file_size // len(line) + 1))[:file_size]
+    for i in range(files):
+        folder = os.path.join(root, f"pkg{i % 50:02d}", f"mod{i % 7}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"file{i:06d}.py"), 'wb') as f:
+            f.write(content)
+
+def tree_size(root):
+    total = 0
+    for current, dirs, files in os.walk(root):
+        for name in files:
+            total += os.path.getsize(os.path.join(current, name))
+    return total
+
+def bench_tempfile_zip(root, level):
+    # The pre-streaming /api/download implementation
+    temp_dir = tempfile.mkdtemp()
+    try:
+        zip_path = os.path.join(temp_dir, 'out.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as zipf:
+            for current, dirs, files in os.walk(root):
+                for name in files:
+                    full_path = os.path.join(current, name)
+                    zipf.write(full_path, os.path.relpath(full_path, root))
+        with open(zip_path, 'rb') as f:
+            while f.read(archive.CHUNK_SIZE):
+                pass
+        return os.path.getsize(zip_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def bench_stream(root, archive_format, level, workers):
+    body, mime_type, extension = archive.stream_directory(root, archive_format, level, workers)
+    return sum(len(chunk) for chunk in body)
+
+def run(label, func, source_bytes):
+    start = time.perf_counter()
+    output_bytes = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {source_bytes / elapsed / 1e6:9.1f} MB/s   {elapsed:7.2f}s   ratio {output_bytes / source_bytes:.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Folder archive throughput benchmark")
+    parser.add_argument('path', nargs='?', help="folder to archive (a synthetic tree is generated when omitted)")
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--level', type=int, default=6)
+    args = parser.parse_args()
+
+    generated = None
+    root = args.path
+    if not root:
+        generated = tempfile.mkdtemp()
+        make_tree(generated, args.files, args.file_size)
+        root = generated
+
+    try:
+        source_bytes = tree_size(root)
+        cpus = os.cpu_count() or 1
+        print(f"Source: {root} ({source_bytes / 1e6:.1f} MB), level {args.level}, {cpus} CPUs")
+        run("zipfile + temp dir (old)", lambda: bench_tempfile_zip(root, args.level), source_bytes)
+        run("zip stream, workers=1", lambda: bench_stream(root, 'zip', args.level, 1), source_bytes)
+        run(f"zip stream, workers={cpus}", lambda: bench_stream(root, 'zip', args.level, cpus), source_bytes)
+        run(f"tar.gz stream, workers={cpus}", lambda: bench_stream(root, 'tar.gz', args.level, cpus), source_bytes)
+        if archive.zstandard is not None:
+            run(f"tar.zst stream, workers={cpus}", lambda: bench_stream(root, 'tar.zst', 3, cpus), source_bytes)
+        else:
+            print("tar.zst skipped (zstandard not installed)")
+    finally:
+        if generated:
+            shutil.rmtree(generated, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
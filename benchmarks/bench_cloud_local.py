@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, jsonify
+from urllib3.util.retry import Retry
+
+import cloud_connection
+
+def make_app():
+    """Stand-in for main.app: one cheap endpoint, so the numbers are transport overhead."""
+    app = Flask('bench')
+
+    @app.route('/api/is_up')
+    def is_up():
+        return jsonify({"status": "up"})
+
+    return app
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def serve_werkzeug(port):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server('127.0.0.1', port, make_app(), threaded=True).serve_forever()
+
+def serve_gunicorn(port, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class BenchApplication(BaseApplication):
+        def load_config(self):
+            for key, value in {'bind': f'127.0.0.1:{port}', 'workers': 1, 'worker_class': 'gthread',
+                               'threads': threads, 'keepalive': 5, 'loglevel': 'warning'}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return make_app()
+
+    BenchApplication().run()
+
+def wait_for(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit(f"server on port {port} did not start")
+
+def timed(call, requests_count):
+    call()
+    start = time.perf_counter()
+    for _ in range(requests_count):
+        call()
+    return (time.perf_counter() - start) / requests_count
+
+def bench_in_process(requests_count):
+    app = make_app()
+    pool = ThreadPoolExecutor(max_workers=1)
+
+    def call():
+        # Same path as ShareifyLocalClient.local_request: run the view on the pool, wait for it
+        response = pool.submit(cloud_connection.call_wsgi, app, 'GET', '/api/is_up', None, {}).result(5)
+        b''.join(response.iter_content(cloud_connection.READ_CHUNK_SIZE))
+        response.close()
+
+    try:
+        return timed(call, requests_count)
+    finally:
+        pool.shutdown()
+
+def bench_loopback(target, args, requests_count):
+    port = free_port()
+    process = multiprocessing.Process(target=target, args=(port,) + args, daemon=True)
+    process.start()
+    try:
+        wait_for(port)
+        session = cloud_connection.make_session(1, Retry(total=0))
+        url = f'http://127.0.0.1:{port}/api/is_up'
+
+        def call():
+            response = session.get(url, stream=True, timeout=5)
+            b''.join(response.iter_content(cloud_connection.READ_CHUNK_SIZE))
+            response.close()
+
+        return timed(call, requests_count)
+    finally:
+        process.terminate()
+        process.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Cloud command latency: in-process WSGI vs HTTP loopback")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8, help="gthread threads for the gunicorn run")
+    args = parser.parse_args()
+
+    print(f"GET /api/is_up, mean of {args.requests} sequential requests")
+    results = [('in-process WSGI', bench_in_process(args.requests))]
+    results.append(('loopback, werkzeug threaded', bench_loopback(serve_werkzeug, (), args.requests)))
+    try:
+        import gunicorn
+    except ImportError:
+        print("  gunicorn is not installed, skipping the gthread run")
+    else:
+        results.append(('loopback, gunicorn gthread', bench_loopback(serve_gunicorn, (args.threads,), args.requests)))
+    for label, seconds in results:
+        print(f"  {label:<30} {seconds * 1000:8.3f} ms")
+
+if __name__ == "__main__":
+    main()
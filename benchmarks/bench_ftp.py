@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+import ftplib
+import socket
+import logging
+import tempfile
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+from pyftpdlib.log import config_logging
+
+import ftp_handlers
+import quotas
+
+class LimitAuthorizer(DummyAuthorizer):
+    """Stand-in for main.CustomAuthorizer with a fixed download cap."""
+
+    def __init__(self, download_limit=0):
+        super().__init__()
+        self.download_limit = download_limit
+
+    def get_quota(self, username):
+        return self.download_limit, 0, 0
+
+def make_handler(profile, root, download_limit):
+    authorizer = LimitAuthorizer(download_limit)
+    authorizer.add_user('bench', 'bench', root, perm='elr')
+    if profile == 'stock':
+        # pyftpdlib defaults: 64 KiB buffers, no sendfile
+        handler = type('StockHandler', (FTPHandler,), {'use_sendfile': False})
+    else:
+        handler = type('TunedHandler', (ftp_handlers.ShareifyFTPHandler,), {})
+        handler.dtp_handler = type('TunedDTPHandler', (ftp_handlers.ShareifyDTPHandler,), {})
+        sendfile, buffer_kb = {'sendfile-64k': (True, 64), 'tuned': (True, 256), 'no-sendfile-256k': (False, 256)}[profile]
+        ftp_handlers.apply_profile(handler, sendfile, buffer_kb * 1024)
+        handler.quotas = quotas.QuotaManager()
+    handler.authorizer = authorizer
+    return handler
+
+def serve(profile, root, download_limit, port_queue):
+    config_logging(level=logging.WARNING)
+    server = FTPServer(('127.0.0.1', 0), make_handler(profile, root, download_limit))
+    port_queue.put(server.address[1])
+    server.serve_forever(handle_exit=False)
+
+def download(port, name, size):
+    received = 0
+
+    def count(chunk):
+        nonlocal received
+        received += len(chunk)
+
+    ftp = ftplib.FTP()
+    ftp.connect('127.0.0.1', port)
+    ftp.login('bench', 'bench')
+    start = time.perf_counter()
+    ftp.retrbinary(f'RETR {name}', count, blocksize=256 * 1024)
+    elapsed = time.perf_counter() - start
+    ftp.quit()
+    if received != size:
+        raise SystemExit(f"short transfer: {received} of {size} bytes")
+    return elapsed
+
+def run(profile, root, name, size, rounds, download_limit=0):
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(profile, root, download_limit, port_queue), daemon=True)
+    process.start()
+    try:
+        port = port_queue.get(timeout=10)
+        best = min(download(port, name, size) for _ in range(rounds))
+    finally:
+        process.terminate()
+        process.join()
+    label = profile + (f" (cap {download_limit // 1024 ** 2} MiB/s)" if download_limit else "")
+    print(f"  {label:<30} {best:8.3f} s   {size / best / 1024 ** 2:9.1f} MiB/s")
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="FTP download throughput over loopback")
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--cap-mb', type=int, default=32, help="download cap for the throttled run, 0 to skip")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    name = 'payload.bin'
+    size = args.size_mb * 1024 * 1024
+    with open(os.path.join(root, name), 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+    try:
+        print(f"RETR of {args.size_mb} MiB over {socket.gethostname()} loopback, best of {args.rounds}")
+        for profile in ('stock', 'no-sendfile-256k', 'sendfile-64k', 'tuned'):
+            run(profile, root, name, size, args.rounds)
+        if args.cap_mb:
+            # A capped transfer is paced, so keep it short
+            capped = min(size, args.cap_mb * 1024 * 1024 * 2)
+            with open(os.path.join(root, 'capped.bin'), 'wb') as f:
+                f.truncate(capped)
+            run('tuned', root, 'capped.bin', capped, 1, args.cap_mb * 1024 * 1024)
+    finally:
+        for entry in os.listdir(root):
+            os.remove(os.path.join(root, entry))
+        os.rmdir(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import permissions
+
+def make_grants(count, rng):
+    """Folder grants shaped like real ones: a few top-level shares with nested project folders."""
+    grants = set()
+    while len(grants) < count:
+        depth = rng.randint(1, 4)
+        grants.add('/'.join(f"{rng.choice(['share', 'team', 'media', 'backup'])}{rng.randint(0, 99)}" for _ in range(depth)) + '/')
+    return sorted(grants)
+
+def make_lookups(grants, count, rng):
+    lookups = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            # Allowed: something inside a granted folder
+            lookups.append(rng.choice(grants) + f"sub{rng.randint(0, 9)}/file{rng.randint(0, 999)}.txt")
+        else:
+            lookups.append(f"private{rng.randint(0, 99)}/other/file{rng.randint(0, 999)}.txt")
+    return lookups
+
+def bench_json_scan(raw, lookups):
+    # What has_access did before the principal cache: parse the column on every call
+    hits = 0
+    for path in lookups:
+        for p in json.loads(raw):
+            if path.startswith(p):
+                hits += 1
+                break
+    return hits
+
+def bench_list_scan(grants, lookups):
+    hits = 0
+    for path in lookups:
+        for p in grants:
+            if path.startswith(p):
+                hits += 1
+                break
+    return hits
+
+def bench_trie(trie, lookups):
+    hits = 0
+    for path in lookups:
+        if trie.matches(path):
+            hits += 1
+    return hits
+
+def run(label, func, lookups):
+    start = time.perf_counter()
+    hits = func()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<28} {elapsed / lookups * 1e6:9.2f} us/lookup   {hits} allowed")
+    return hits
+
+def bench_roles(endpoints, roles_per_endpoint, lookups, rng):
+    role_names = [f"role{i}" for i in range(roles_per_endpoint * 2)]
+    roles = {f"/api/endpoint{i}": rng.sample(role_names, roles_per_endpoint) for i in range(endpoints)}
+    addresses = [f"/api/endpoint{rng.randint(0, endpoints * 2)}" for _ in range(lookups)]
+    checks = [(address, rng.choice(role_names)) for address in addresses]
+    print(f"roles.json with {endpoints} endpoints, {roles_per_endpoint} roles each, {lookups} checks")
+
+    def list_scan():
+        allowed = 0
+        for address, role in checks:
+            for item in roles.get(address, []):
+                if item == role:
+                    allowed += 1
+                    break
+        return allowed
+
+    matrix = permissions.RoleMatrix()
+
+    def compiled():
+        allowed = 0
+        for address, role in checks:
+            if matrix.allows(roles, address, role):
+                allowed += 1
+        return allowed
+
+    run("list scan (old)", list_scan, lookups)
+    run("frozenset matrix", compiled, lookups)
+
+def main():
+    parser = argparse.ArgumentParser(description="Permission check micro-benchmark")
+    parser.add_argument('--grants', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    for count in args.grants:
+        grants = make_grants(count, rng)
+        lookups = make_lookups(grants, args.lookups, rng)
+        raw = json.dumps(grants)
+        print(f"{count} path grants, {args.lookups} lookups")
+        start = time.perf_counter()
+        trie = permissions.PathTrie(grants)
+        print(f"  {'trie build':<28} {(time.perf_counter() - start) * 1000:9.2f} ms")
+        expected = run("trie", lambda: bench_trie(trie, lookups), args.lookups)
+        if run("list scan", lambda: bench_list_scan(grants, lookups), args.lookups) != expected:
+            raise SystemExit("trie and list scan disagree")
+        # The json variant gets slow quickly, keep its share of the run bounded
+        sample = lookups[:max(100, args.lookups * 10 // count)]
+        run("json.loads + scan (old)", lambda: bench_json_scan(raw, sample), len(sample))
+    bench_roles(100, 3, args.lookups, rng)
+
+if __name__ == "__main__":
+    main()
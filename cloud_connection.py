@@ -8,6 +8,10 @@ import os
 import sys
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.test import Client
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from colorama import init, Fore, Back, Style
 
 
@@ -47,9 +51,48 @@ DEFAULT_SERVER_ID = None
 DEFAULT_SERVER_NAME = None
 DEFAULT_HEARTBEAT_INTERVAL = 30
 DEFAULT_COMMAND_TIMEOUT = 30
+DEFAULT_COMMAND_WORKERS = 4
+DEFAULT_COMMAND_BACKLOG = 16
+MAX_COMMAND_TIMEOUT = 300
+READ_CHUNK_SIZE = 64 * 1024
+# How often a command waiting on an in-process view checks for a cancel
+LOCAL_POLL_INTERVAL = 0.1
+HTTP_METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS')
+JSON_BODY_METHODS = ('POST', 'PUT', 'PATCH')
+
+class CommandCancelled(Exception):
+    pass
+
+def make_session(pool_size, retry):
+    """requests.Session that keeps up to pool_size connections alive per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def call_wsgi(app, method, url, body, headers):
+    """Run one API request through the WSGI app in this process, body fully read."""
+    response = Client(app).open(url, method=method, json=body, headers=headers, buffered=True,
+                                environ_base={'REMOTE_ADDR': '127.0.0.1'})
+    return WSGIResponse(response)
+
+class WSGIResponse:
+    """Just enough of requests.Response for read_response() over an in-process call."""
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.encoding = response.mimetype_params.get('charset')
+
+    def iter_content(self, chunk_size):
+        yield from self.response.iter_encoded()
+
+    def close(self):
+        self.response.close()
 
 class ShareifyLocalClient:
-    def __init__(self, cloud_url="https://bridge.bbarni.hackclub.app", server_id=None, server_name=None, user_id=None, auth_token=None, username=None, password=None):
+    def __init__(self, cloud_url="https://bridge.bbarni.hackclub.app", server_id=None, server_name=None, user_id=None, auth_token=None, username=None, password=None, local_app=None):
         self.cloud_url = DEFAULT_CLOUD_URL
         
         self.cloud_config = load_cloud_config()
@@ -75,6 +118,21 @@ class ShareifyLocalClient:
         self.connected = False
         self.heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL
         self.command_timeout = DEFAULT_COMMAND_TIMEOUT
+        self.command_workers = self.cloud_config.get('command_workers', DEFAULT_COMMAND_WORKERS)
+        self.command_backlog = self.cloud_config.get('command_backlog', DEFAULT_COMMAND_BACKLOG)
+        # Running plus queued commands; anything beyond this is refused instead of piling up
+        self.command_slots = threading.BoundedSemaphore(self.command_workers + self.command_backlog)
+        self.command_pool = ThreadPoolExecutor(max_workers=self.command_workers, thread_name_prefix='cloud-command')
+        self.commands = {}
+        self.commands_lock = threading.Lock()
+        self.emit_lock = threading.Lock()
+        # Only retry failures to connect: a request that reached the server is never sent twice
+        self.local_session = make_session(self.command_workers, Retry(total=2, connect=2, read=False, status=0, backoff_factor=0.2))
+        self.bridge_session = make_session(2, Retry(total=3, connect=3, read=False, status=0, backoff_factor=0.5))
+        # main.app when running in the same process; commands then skip the HTTP loopback
+        self.local_app = local_app
+        # Views run here so a command worker can give up on one at its deadline
+        self.local_app_pool = ThreadPoolExecutor(max_workers=self.command_workers, thread_name_prefix='cloud-local-api') if local_app is not None else None
         self.last_successful_ping = time.time()
         self.reconnect_attempts = 0
         self.max_reconnect_attempts = 5
@@ -93,6 +151,8 @@ class ShareifyLocalClient:
             print("Disconnected from cloud bridge")
             self.connected = False
             self.authenticated = False
+            # Their responses could not be delivered anyway
+            self.cancel_all_commands()
             
         @self.sio.on('authentication_success')
         def on_auth_success(data):
@@ -190,21 +250,14 @@ class ShareifyLocalClient:
             timestamp = data.get('timestamp')
             shareify_jwt = data.get('shareify_jwt')
             print(f"Received command {command_id}: {command} (method: {method})")
+            self.submit_command(command_id, command, method, body, shareify_jwt, data.get('timeout'))
+
+        @self.sio.on('cancel_command')
+        def on_cancel_command(data):
+            command_id = data.get('command_id')
+            if not self.cancel_command(command_id):
+                print(f"Cancel for unknown or finished command {command_id}")
 
-            try:
-                self.execute_api_request(command_id, command, method, body, shareify_jwt)
-            except Exception as e:
-                print(f"Failed to handle command: {e}")
-                if self.sio.connected:
-                    try:
-                        self.sio.emit('command_response', {
-                            'command_id': command_id,
-                            'response': {'error': str(e)}
-                        })
-                    except Exception as emit_error:
-                        print(f"Failed to emit command error: {emit_error}")
-            
-            
         @self.sio.on('pong')
         def on_pong(data):
             self.last_successful_ping = time.time()
@@ -463,6 +516,7 @@ class ShareifyLocalClient:
         print_status("Disconnecting from cloud bridge...", "info")
         self.connected = False
         self.authenticated = False
+        self.cancel_all_commands()
         if self.sio.connected:
             try:
                 self.sio.disconnect()
@@ -478,7 +532,97 @@ class ShareifyLocalClient:
             print("\nShutting down...")
             self.disconnect()
 
-    def execute_api_request(self, command_id, url, method='GET', body=None, shareify_jwt=None):
+    def submit_command(self, command_id, url, method='GET', body=None, shareify_jwt=None, timeout=None):
+        """Queue a command on the worker pool so a slow one does not hold up the socket.io thread."""
+        if not self.command_slots.acquire(blocking=False):
+            print(f"Command pool is saturated, refusing command {command_id}")
+            self.send_error_response(command_id, 'Server is busy, try again later', 'busy')
+            return False
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            timeout = self.command_timeout
+        deadline = time.monotonic() + min(timeout, MAX_COMMAND_TIMEOUT)
+        cancel = threading.Event()
+        try:
+            with self.commands_lock:
+                future = self.command_pool.submit(self.run_command, command_id, url, method, body, shareify_jwt, deadline, cancel)
+                self.commands[command_id] = (future, cancel)
+        except RuntimeError as e:
+            self.command_slots.release()
+            print(f"Failed to queue command {command_id}: {e}")
+            self.send_error_response(command_id, 'Server is shutting down')
+            return False
+        future.add_done_callback(lambda done: self.finish_command(command_id, done))
+        return True
+
+    def run_command(self, command_id, url, method, body, shareify_jwt, deadline, cancel):
+        try:
+            self.execute_api_request(command_id, url, method, body, shareify_jwt, deadline, cancel)
+        except Exception as e:
+            print(f"Failed to handle command: {e}")
+            self.emit_response(command_id, {'error': str(e)})
+
+    def finish_command(self, command_id, future):
+        with self.commands_lock:
+            if self.commands.get(command_id, (None,))[0] is future:
+                del self.commands[command_id]
+        self.command_slots.release()
+
+    def cancel_command(self, command_id):
+        with self.commands_lock:
+            entry = self.commands.get(command_id)
+        if entry is None:
+            return False
+        future, cancel = entry
+        cancel.set()
+        if future.cancel():
+            # It never started, so nothing else will answer it
+            self.send_error_response(command_id, 'Command cancelled', 'cancelled')
+        print(f"Cancelled command {command_id}")
+        return True
+
+    def cancel_all_commands(self):
+        with self.commands_lock:
+            command_ids = list(self.commands)
+        for command_id in command_ids:
+            self.cancel_command(command_id)
+
+    def read_response(self, response, deadline, cancel):
+        """Read the body in chunks so a cancel or the command deadline can stop a long transfer."""
+        chunks = []
+        try:
+            for chunk in response.iter_content(READ_CHUNK_SIZE):
+                if cancel.is_set():
+                    raise CommandCancelled()
+                if time.monotonic() > deadline:
+                    raise requests.exceptions.Timeout()
+                chunks.append(chunk)
+        finally:
+            response.close()
+        return b''.join(chunks)
+
+    def local_request(self, method, url, body, headers, deadline, cancel):
+        if self.local_app is None:
+            return self.local_session.request(method, url, json=body, headers=headers,
+                                              timeout=deadline - time.monotonic(), stream=True)
+        future = self.local_app_pool.submit(call_wsgi, self.local_app, method, url, body, headers)
+        while True:
+            try:
+                return future.result(max(min(LOCAL_POLL_INTERVAL, deadline - time.monotonic()), 0))
+            except FutureTimeout:
+                if not cancel.is_set() and time.monotonic() < deadline:
+                    continue
+            # The view cannot be interrupted; let it finish in the background and drop its response
+            if not future.cancel():
+                future.add_done_callback(lambda done: done.exception() is None and done.result().close())
+            if cancel.is_set():
+                raise CommandCancelled()
+            raise requests.exceptions.Timeout()
+
+    def execute_api_request(self, command_id, url, method='GET', body=None, shareify_jwt=None, deadline=None, cancel=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.command_timeout
+        if cancel is None:
+            cancel = threading.Event()
         try:
             base_url = "http://127.0.0.1:6969/api"
             
@@ -497,14 +641,7 @@ class ShareifyLocalClient:
                 '/get_logs', '/finder', '/get_file'
             ]
             if not any(url == ep or url.startswith(ep) for ep in allowed_endpoints):
-                if self.sio.connected:
-                    try:
-                        self.sio.emit('command_response', {
-                            'command_id': command_id,
-                            'response': {'error': 'Not allowed (security reasons) to access this endpoint.'}
-                        })
-                    except Exception as emit_error:
-                        print(f"Failed to emit security error: {emit_error}")
+                self.emit_response(command_id, {'error': 'Not allowed (security reasons) to access this endpoint.'})
                 return
 
             headers = {'Content-Type': 'application/json'}
@@ -512,34 +649,30 @@ class ShareifyLocalClient:
             if shareify_jwt:
                 headers['Authorization'] = f'Bearer {shareify_jwt}'
             
-            if method.upper() == 'GET':
-                if isinstance(body, dict) and body:
-                    import urllib.parse
-                    query_string = urllib.parse.urlencode(body)
-                    if '?' in full_url:
-                        full_url = f"{full_url}&{query_string}"
-                    else:
-                        full_url = f"{full_url}?{query_string}"
-                response = requests.get(full_url, headers=headers, timeout=self.command_timeout)
-            elif method.upper() == 'POST':
-                response = requests.post(full_url, json=body, headers=headers, timeout=self.command_timeout)
-            elif method.upper() == 'PUT':
-                response = requests.put(full_url, json=body, headers=headers, timeout=self.command_timeout)
-            elif method.upper() == 'DELETE':
-                response = requests.delete(full_url, headers=headers, timeout=self.command_timeout)
-            elif method.upper() == 'PATCH':
-                response = requests.patch(full_url, json=body, headers=headers, timeout=self.command_timeout)
-            elif method.upper() == 'HEAD':
-                response = requests.head(full_url, headers=headers, timeout=self.command_timeout)
-            elif method.upper() == 'OPTIONS':
-                response = requests.options(full_url, headers=headers, timeout=self.command_timeout)
-            else:
+            method = method.upper()
+            if method not in HTTP_METHODS:
                 raise ValueError(f"Unsupported HTTP method: {method}")
+            if method == 'GET' and isinstance(body, dict) and body:
+                import urllib.parse
+                query_string = urllib.parse.urlencode(body)
+                if '?' in full_url:
+                    full_url = f"{full_url}&{query_string}"
+                else:
+                    full_url = f"{full_url}?{query_string}"
+
+            if cancel.is_set():
+                raise CommandCancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Spent its whole budget waiting for a worker
+                raise requests.exceptions.Timeout()
+            response = self.local_request(method, full_url, body if method in JSON_BODY_METHODS else None, headers, deadline, cancel)
+            content = self.read_response(response, deadline, cancel)
 
             try:
-                response_data = response.json()
-            except json.JSONDecodeError:
-                response_data = response.text
+                response_data = json.loads(content)
+            except ValueError:
+                response_data = content.decode(response.encoding or 'utf-8', errors='replace')
             
             is_file_endpoint = url.endswith('/get_file') or 'get_file' in url
             if is_file_endpoint and isinstance(response_data, dict) and 'content' in response_data:
@@ -547,52 +680,41 @@ class ShareifyLocalClient:
             else:
                 self.send_standard_response(command_id, response_data)
             
+        except CommandCancelled:
+            print(f"Command {command_id} cancelled")
+            self.send_error_response(command_id, 'Command cancelled', 'cancelled')
+
         except requests.exceptions.Timeout:
             print(f"API request timeout for command {command_id}")
-            if self.sio.connected:
-                try:
-                    self.sio.emit('command_response', {
-                        'command_id': command_id,
-                        'response': {'error': 'API request timeout'}
-                    })
-                except Exception as emit_error:
-                    print(f"Failed to emit timeout error: {emit_error}")
-            
+            self.emit_response(command_id, {'error': 'API request timeout'})
+
         except requests.exceptions.ConnectionError:
             print(f"API connection error for command {command_id}")
-            if self.sio.connected:
-                try:
-                    self.sio.emit('command_response', {
-                        'command_id': command_id,
-                        'response': {'error': 'Failed to connect to local API server'}
-                    })
-                except Exception as emit_error:
-                    print(f"Failed to emit connection error: {emit_error}")
-            
+            self.emit_response(command_id, {'error': 'Failed to connect to local API server'})
+
         except Exception as e:
             print(f"General error for command {command_id}: {e}")
-            if self.sio.connected:
-                try:
-                    self.sio.emit('command_response', {
-                        'command_id': command_id,
-                        'response': {'error': str(e)}
-                    })
-                except Exception as emit_error:
-                    print(f"Failed to emit general error: {emit_error}")
+            self.emit_response(command_id, {'error': str(e)})
 
-    def send_standard_response(self, command_id, response_data):
-        if self.sio.connected:
-            try:
+    def emit_response(self, command_id, response):
+        """Emit a command_response. Commands finish out of order; the bridge matches them by command_id."""
+        if not self.sio.connected:
+            print("Socket not connected, cannot emit response")
+            return False
+        try:
+            with self.emit_lock:
                 self.sio.emit('command_response', {
                     'command_id': command_id,
-                    'response': response_data
+                    'response': response
                 })
-                print(f"Successfully emitted response for command {command_id}")
-                time.sleep(0.1)
-            except Exception as emit_error:
-                print(f"Failed to emit response: {emit_error}")
-        else:
-            print("Socket not connected, cannot emit response")
+            return True
+        except Exception as emit_error:
+            print(f"Failed to emit response: {emit_error}")
+            return False
+
+    def send_standard_response(self, command_id, response_data):
+        if self.emit_response(command_id, response_data):
+            print(f"Successfully emitted response for command {command_id}")
 
     def handle_large_file_response(self, command_id, response_data):
         
@@ -650,11 +772,10 @@ class ShareifyLocalClient:
                 try:
                     print(f"Storage attempt {attempt + 1}/{max_retries}")
                     
-                    store_response = requests.post(
+                    store_response = self.bridge_session.post(
                         f"{self.cloud_url}/cloud/file/store",
                         json=storage_data,
-                        timeout=dynamic_timeout,
-                        headers={'Connection': 'close'}
+                        timeout=dynamic_timeout
                     )
                     
                     if store_response.status_code == 200:
@@ -768,21 +889,9 @@ class ShareifyLocalClient:
             print(f"Error in fallback response: {e}")
             self.send_error_response(command_id, f"File storage and fallback failed: {str(e)}")
 
-    def send_error_response(self, command_id, error_message):
-        if self.sio.connected:
-            try:
-                self.sio.emit('command_response', {
-                    'command_id': command_id,
-                    'response': {
-                        'error': error_message,
-                        'status': 'error'
-                    }
-                })
-                print(f"Sent error response for command {command_id}: {error_message}")
-            except Exception as emit_error:
-                print(f"Failed to emit error response: {emit_error}")
-        else:
-            print("Socket not connected, cannot emit error response")
+    def send_error_response(self, command_id, error_message, status='error'):
+        if self.emit_response(command_id, {'error': error_message, 'status': status}):
+            print(f"Sent error response for command {command_id}: {error_message}")
 
     def send_chunked_file_response(self, command_id, response_data):
         print("Warning: send_chunked_file_response called, redirecting to file storage")
@@ -790,7 +899,12 @@ class ShareifyLocalClient:
     
 def main():
     try:
-        client = ShareifyLocalClient()
+        local_app = None
+        if load_cloud_config().get('in_process_api'):
+            # Load the API like a gunicorn worker would, without the FTP server
+            from main import create_app
+            local_app = create_app(start_ftp=False)
+        client = ShareifyLocalClient(local_app=local_app)
         
         print()
         print_status(f"\n=== Shareify Cloud Client Starting ===")
@@ -802,6 +916,7 @@ def main():
         print_status(f"Enabled: {client.enabled}")
         print_status(f"Heartbeat Interval: {client.heartbeat_interval}s")
         print_status(f"Command Timeout: {client.command_timeout}s")
+        print_status(f"Local API: {'in-process' if client.local_app is not None else 'HTTP loopback'}")
         print_status("="*50)
         print()
         
@@ -0,0 +1,98 @@
+import gzip
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript', 'application/xml', 'image/svg+xml')
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+class ResponseCompressor:
+    """Compresses finished API responses with gzip or zstd, whichever the client prefers.
+
+    Only buffered responses of a compressible type above min_size are
+    touched; streamed bodies, ranges, binary types and anything that
+    already carries a Content-Encoding go out as they are.
+    """
+
+    def __init__(self, min_size=1024, gzip_level=6, zstd_level=3, loopback=False):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+        self.loopback = loopback
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {"compressed": 0, "skipped": 0, "bytes_in": 0, "bytes_out": 0, "gzip": 0, "zstd": 0}
+
+    def encodings(self):
+        return ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+    def choose_encoding(self, request):
+        best = None
+        for encoding in self.encodings():
+            quality = request.accept_encodings[encoding]
+            if quality and (best is None or quality > best[1]):
+                best = (encoding, quality)
+        return best[0] if best else None
+
+    def eligible(self, request, response):
+        if response.direct_passthrough or response.is_streamed:
+            return False
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return False
+        if 'Content-Encoding' in response.headers or 'no-transform' in response.headers.get('Cache-Control', ''):
+            return False
+        if not response.mimetype.startswith(COMPRESSIBLE_TYPES):
+            return False
+        if not self.loopback and request.remote_addr in LOOPBACK_ADDRESSES:
+            # Compressing for a client on the same machine only costs CPU
+            return False
+        length = response.calculate_content_length()
+        return length is not None and length >= self.min_size
+
+    def compress(self, data, encoding):
+        if encoding == 'zstd':
+            compressor = getattr(self.local, 'zstd', None)
+            if compressor is None:
+                # ZstdCompressor is not thread safe, keep one per thread
+                compressor = self.local.zstd = zstandard.ZstdCompressor(level=self.zstd_level)
+            return compressor.compress(data)
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+    def apply(self, request, response):
+        encoding = None
+        if self.eligible(request, response):
+            response.vary.add('Accept-Encoding')
+            encoding = self.choose_encoding(request)
+        if encoding is None:
+            with self.lock:
+                self.stats['skipped'] += 1
+            return response
+        data = response.get_data()
+        compressed = self.compress(data, encoding)
+        if len(compressed) >= len(data):
+            with self.lock:
+                self.stats['skipped'] += 1
+            return response
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            # A different body needs a different validator
+            response.set_etag(f"{etag}-{encoding}", weak)
+        with self.lock:
+            self.stats['compressed'] += 1
+            self.stats[encoding] += 1
+            self.stats['bytes_in'] += len(data)
+            self.stats['bytes_out'] += len(compressed)
+        return response
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['ratio'] = round(stats['bytes_in'] / stats['bytes_out'], 2) if stats['bytes_out'] else None
+        stats['min_size'] = self.min_size
+        stats['zstd_available'] = zstandard is not None
+        return stats
@@ -0,0 +1,279 @@
+import os
+import sys
+import errno
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+READ_BLOCK = 1024 * 1024
+HASH_ALGORITHMS = ('blake2b', 'sha256')
+LINK_MODES = ('reflink', 'copy')
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+def new_hasher(algorithm):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.new(algorithm)
+
+def file_stamp(path):
+    stat_result = os.stat(path)
+    return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+def clone_file(source, dest):
+    """Copy-on-write clone of source, raising OSError when the filesystem has no reflinks."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported here")
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+class DedupStore:
+    """Content hashes of uploaded files, used to avoid storing or sending the same bytes twice.
+
+    Every file written through an upload is hashed and recorded with its
+    inode, mtime and size. An upload whose content is already on disk is
+    turned into a reflink of the existing copy, and clients can ask up
+    front which hashes the server holds so they can skip sending them.
+    An entry is only trusted while the file's stamp still matches, so
+    files changed behind our back are never used.
+    """
+
+    def __init__(self, db_path, algorithm='blake2b', link_mode='reflink'):
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unsupported dedup hash {algorithm}")
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unsupported dedup link mode {link_mode}")
+        self.db_path = db_path
+        self.algorithm = algorithm
+        self.link_mode = link_mode
+        self.lock = threading.Lock()
+        self.stats = {"hashed_bytes": 0, "reflinked": 0, "copied": 0, "transfer_saved_bytes": 0}
+        self.initialize()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        return conn
+
+    def initialize(self):
+        conn = self.connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    algorithm TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    ino INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    shared INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS files_digest ON files (algorithm, digest)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def hash_file(self, path):
+        hasher = new_hasher(self.algorithm)
+        size = 0
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(READ_BLOCK), b''):
+                hasher.update(block)
+                size += len(block)
+        self.count('hashed_bytes', size)
+        return hasher.hexdigest()
+
+    def copy_stream(self, stream, file):
+        """Write stream to an open file, hashing it on the way, and return the digest."""
+        hasher = new_hasher(self.algorithm)
+        size = 0
+        for block in iter(lambda: stream.read(READ_BLOCK), b''):
+            hasher.update(block)
+            file.write(block)
+            size += len(block)
+        self.count('hashed_bytes', size)
+        return hasher.hexdigest()
+
+    def valid(self, row):
+        path, size, ino, mtime_ns = row
+        try:
+            return file_stamp(path) == (ino, mtime_ns, size)
+        except OSError:
+            return False
+
+    def record(self, path, digest, shared=False):
+        ino, mtime_ns, size = file_stamp(path)
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO files (path, algorithm, digest, size, ino, mtime_ns, shared) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (path, self.algorithm, digest, size, ino, mtime_ns, int(shared))
+                )
+        finally:
+            conn.close()
+
+    def discard(self, path):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM files WHERE path = ?', (path,))
+        finally:
+            conn.close()
+
+    def lookup(self, digest, accept=None, exclude=None):
+        """Return (path, size) of an unchanged file with this digest, dropping stale entries."""
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                'SELECT path, size, ino, mtime_ns FROM files WHERE algorithm = ? AND digest = ?',
+                (self.algorithm, digest)
+            ).fetchall()
+            stale = []
+            found = None
+            for row in rows:
+                if not self.valid(row):
+                    stale.append((row[0],))
+                elif row[0] != exclude and (accept is None or accept(row[0])):
+                    found = (row[0], row[1])
+                    break
+            if stale:
+                with conn:
+                    conn.executemany('DELETE FROM files WHERE path = ?', stale)
+        finally:
+            conn.close()
+        return found
+
+    def known(self, digests, accept=None):
+        return [digest for digest in digests if self.lookup(digest, accept)]
+
+    def materialize(self, source, dest, allow_copy=True):
+        """Atomically place a copy of source at dest, sharing its blocks when possible."""
+        temp_path = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.{os.getpid()}.{threading.get_ident()}.dedup")
+        methods = {'reflink': ('reflink', 'copy'), 'copy': ('copy',)}[self.link_mode]
+        if not allow_copy:
+            # Replacing a file with a plain copy of itself would only cost I/O
+            methods = methods[:-1]
+        try:
+            for method in methods:
+                try:
+                    if method == 'reflink':
+                        clone_file(source, temp_path)
+                    else:
+                        shutil.copyfile(source, temp_path)
+                    break
+                except OSError:
+                    if method == methods[-1]:
+                        raise
+                    # Other filesystem or no reflink support, try the next way
+                    if os.path.lexists(temp_path):
+                        os.remove(temp_path)
+            os.replace(temp_path, dest)
+        finally:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+        self.count({'reflink': 'reflinked', 'copy': 'copied'}[method])
+        return method
+
+    def add(self, path, digest=None):
+        """Record a freshly written file, sharing blocks with an existing copy of the same content."""
+        if digest is None:
+            digest = self.hash_file(path)
+        method = None
+        if self.link_mode != 'copy':
+            source = self.lookup(digest, exclude=path)
+            try:
+                if source and file_stamp(source[0])[0] != file_stamp(path)[0]:
+                    method = self.materialize(source[0], path, allow_copy=False)
+            except OSError:
+                # No way to share blocks here, keep the file just written
+                method = None
+        self.record(path, digest, shared=method == 'reflink')
+        return digest, method
+
+    def link(self, digest, dest, accept=None):
+        """Create dest from an existing file with this digest so the client never sends it."""
+        source = self.lookup(digest, accept)
+        if not source:
+            return None
+        method = self.materialize(source[0], dest)
+        self.record(dest, digest, shared=method == 'reflink')
+        self.count('transfer_saved_bytes', source[1])
+        return method, source[1]
+
+    def reclaim(self):
+        """Drop stale entries, share blocks between duplicate copies and report the space saved."""
+        conn = self.connect()
+        try:
+            rows = conn.execute('SELECT path, size, ino, mtime_ns, algorithm, digest, shared FROM files ORDER BY path').fetchall()
+        finally:
+            conn.close()
+        report = {"files": 0, "unique": 0, "stale": 0, "relinked": 0, "reclaimed_bytes": 0, "saved_bytes": 0}
+        stale = []
+        groups = {}
+        for row in rows:
+            if self.valid(row[:4]):
+                groups.setdefault((row[4], row[5]), []).append(row)
+            else:
+                stale.append((row[0],))
+        report['stale'] = len(stale)
+        shared = []
+        for (algorithm, digest), group in groups.items():
+            report['files'] += len(group)
+            report['unique'] += 1
+            keeper = group[0]
+            for row in group[1:]:
+                if row[6] or self.link_mode == 'copy':
+                    continue
+                if row[2] == keeper[2]:
+                    shared.append((row[0],))
+                    continue
+                try:
+                    # Check both files again right before touching anything
+                    if not (self.valid(keeper[:4]) and self.valid(row[:4])):
+                        continue
+                    self.materialize(keeper[0], row[0], allow_copy=False)
+                except OSError:
+                    continue
+                report['relinked'] += 1
+                report['reclaimed_bytes'] += row[1]
+                shared.append((row[0],))
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany('DELETE FROM files WHERE path = ?', stale)
+                for (path,) in shared:
+                    try:
+                        ino, mtime_ns, size = file_stamp(path)
+                    except OSError:
+                        continue
+                    conn.execute('UPDATE files SET shared = 1, ino = ?, mtime_ns = ? WHERE path = ?', (ino, mtime_ns, path))
+            report['saved_bytes'] = conn.execute('SELECT COALESCE(SUM(size), 0) FROM files WHERE shared = 1').fetchone()[0]
+        finally:
+            conn.close()
+        return report
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['algorithm'] = self.algorithm
+        stats['link_mode'] = self.link_mode
+        conn = self.connect()
+        try:
+            stats['files'], stats['shared_bytes'] = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(CASE WHEN shared = 1 THEN size ELSE 0 END), 0) FROM files'
+            ).fetchone()
+        finally:
+            conn.close()
+        return stats
@@ -0,0 +1,109 @@
+import os
+from pyftpdlib.handlers import FTPHandler, DTPHandler
+
+import quotas
+
+DOWNLOAD_COMMANDS = ('RETR',)
+UPLOAD_COMMANDS = ('STOR', 'STOU', 'APPE')
+
+class ShareifyDTPHandler(DTPHandler):
+    """Data channel that charges the account's shared bandwidth bucket.
+
+    Works like pyftpdlib's ThrottledDTPHandler, but the budget belongs to
+    the FTP account rather than the connection, so parallel sessions split
+    one cap. Uncapped transfers keep the zero-copy sendfile() path; only a
+    capped download has to pass through userspace so it can be paced.
+    """
+
+    _throttler = None
+
+    def transfer(self):
+        return getattr(self.cmd_channel, 'transfer', None)
+
+    def use_sendfile(self):
+        transfer = self.transfer()
+        if transfer is not None and transfer.limited:
+            return False
+        return DTPHandler.use_sendfile(self)
+
+    def recv(self, buffer_size):
+        chunk = super().recv(buffer_size)
+        self.throttle(len(chunk))
+        return chunk
+
+    def send(self, data):
+        num_sent = super().send(data)
+        self.throttle(num_sent)
+        return num_sent
+
+    def throttle(self, size):
+        transfer = self.transfer()
+        if transfer is None or not size:
+            return
+        delay = transfer.charge(size)
+        if delay > 0 and not self._closed:
+            # Same trick as ThrottledDTPHandler: drop out of the ioloop for a while
+            def unsleep():
+                self.add_channel(events=self.ioloop.READ if self.receive else self.ioloop.WRITE)
+
+            self.del_channel()
+            self._cancel_throttler()
+            self._throttler = self.ioloop.call_later(delay, unsleep, _errback=self.handle_error)
+
+    def _cancel_throttler(self):
+        if self._throttler is not None and not self._throttler.cancelled:
+            self._throttler.cancel()
+
+    def close(self):
+        self._cancel_throttler()
+        super().close()
+
+class ShareifyFTPHandler(FTPHandler):
+    """FTPHandler that holds one of the account's transfer slots per RETR/STOR."""
+
+    dtp_handler = ShareifyDTPHandler
+    quotas = None
+    transfer = None
+
+    def pre_process_command(self, line, cmd, arg):
+        if self.quotas is not None and self.authenticated and (cmd in DOWNLOAD_COMMANDS or cmd in UPLOAD_COMMANDS):
+            self.end_transfer()
+            download_limit, upload_limit, max_transfers = self.authorizer.get_quota(self.username)
+            direction = 'download' if cmd in DOWNLOAD_COMMANDS else 'upload'
+            try:
+                self.transfer = self.quotas.acquire('ftp:' + self.username, direction, download_limit, upload_limit, max_transfers)
+            except quotas.QuotaExceeded as e:
+                self.respond(f"450 {e}.")
+                return
+            super().pre_process_command(line, cmd, arg)
+            if self._out_dtp_queue is None and self._in_dtp_queue is None and (self.data_channel is None or self.data_channel.file_obj is None):
+                # The command failed before a transfer was set up
+                self.end_transfer()
+            return
+        super().pre_process_command(line, cmd, arg)
+
+    def end_transfer(self, total=None):
+        if self.transfer is not None:
+            self.transfer.release(total)
+            self.transfer = None
+
+    def _on_dtp_close(self):
+        if self.data_channel is not None:
+            self.end_transfer(self.data_channel.get_transmitted_bytes())
+        super()._on_dtp_close()
+
+    def ftp_ABOR(self, line):
+        super().ftp_ABOR(line)
+        if self.data_channel is None:
+            self.end_transfer()
+
+    def close(self):
+        self.end_transfer()
+        super().close()
+
+def apply_profile(handler, sendfile=True, buffer_size=256 * 1024):
+    """Tune a handler class for throughput: sendfile() for downloads and larger socket reads and writes."""
+    handler.use_sendfile = bool(sendfile) and hasattr(os, 'sendfile')
+    handler.dtp_handler.ac_in_buffer_size = int(buffer_size)
+    handler.dtp_handler.ac_out_buffer_size = int(buffer_size)
+    return handler
@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import signal
+import secrets
+import threading
+import subprocess
+
+READ_CHUNK = 64 * 1024
+FINISHED_STATES = ('exited', 'killed', 'timeout', 'failed', 'lost')
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+def decode_output(data, final=False):
+    """Decode UTF-8 output, holding back a character split across the chunk end."""
+    end = len(data)
+    if not final:
+        # Step back over continuation bytes to the start of the last character
+        start = max(0, end - 3)
+        for index in range(end - 1, start - 1, -1):
+            byte = data[index]
+            if byte & 0xC0 != 0x80:
+                needed = 2 if byte & 0xE0 == 0xC0 else 3 if byte & 0xF0 == 0xE0 else 4 if byte & 0xF8 == 0xF0 else 1
+                if end - index < needed:
+                    end = index
+                break
+    return data[:end].decode('utf-8', errors='replace'), end
+
+class JobManager:
+    """Runs shell commands as background jobs with their output spooled to disk.
+
+    Each job has a <id>.log file with its combined output and a <id>.json
+    file with its state, so any worker process can report on, stream or
+    cancel a job. Workers only queue jobs; the supervisor thread in the
+    leader process launches them, so recycling a worker never orphans one.
+    """
+
+    def __init__(self, job_dir, timeout=300, cpu_seconds=None, memory_mb=None,
+                 max_output=16 * 1024 * 1024, max_running=4, max_queued=16, keep_finished=200, poll=0.1):
+        self.job_dir = job_dir
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.max_output = max_output
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.poll = poll
+        self.queue_dir = os.path.join(job_dir, 'queue')
+        self.running = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.supervisor = None
+        self.stats = {"queued": 0, "started": 0, "finished": 0, "cancelled": 0, "timeouts": 0, "rejected": 0}
+        os.makedirs(self.queue_dir, exist_ok=True)
+
+    def paths(self, job_id):
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            raise KeyError(job_id)
+        base = os.path.join(self.job_dir, job_id)
+        return base + '.json', base + '.log'
+
+    def queue_path(self, job_id):
+        return os.path.join(self.queue_dir, job_id)
+
+    def save(self, job):
+        state_path, _ = self.paths(job['id'])
+        temp_path = f"{state_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(job, file)
+        os.replace(temp_path, state_path)
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            job = self.get(job_id)
+            job.pop('output_size', None)
+            job.update(fields)
+            self.save(job)
+        return job
+
+    def get(self, job_id):
+        state_path, log_path = self.paths(job_id)
+        try:
+            with open(state_path, 'r') as file:
+                job = json.load(file)
+        except (OSError, ValueError):
+            raise KeyError(job_id)
+        if job['status'] == 'running' and job.get('worker') != os.getpid() and not process_alive(job['worker']):
+            # The worker that owned the job died before it could record the exit
+            job['status'] = 'lost'
+        try:
+            job['output_size'] = os.path.getsize(log_path)
+        except OSError:
+            job['output_size'] = 0
+        return job
+
+    def list(self, owner):
+        jobs = []
+        for name in os.listdir(self.job_dir):
+            if name.endswith('.json'):
+                try:
+                    job = self.get(name[:-5])
+                except KeyError:
+                    continue
+                if job['owner'] == owner:
+                    jobs.append(job)
+        jobs.sort(key=lambda job: job['started'], reverse=True)
+        return jobs
+
+    def wrap_command(self, command):
+        if os.name == 'nt':
+            return command
+        limits = []
+        if self.cpu_seconds:
+            limits.append(f"ulimit -t {int(self.cpu_seconds)}")
+        if self.memory_mb:
+            limits.append(f"ulimit -v {int(self.memory_mb) * 1024}")
+        return '; '.join(limits + [command])
+
+    def submit(self, command, cwd, owner):
+        """Queue a command for the supervisor and return the job state."""
+        if self.max_queued and len(os.listdir(self.queue_dir)) >= self.max_queued:
+            with self.lock:
+                self.stats['rejected'] += 1
+            raise RuntimeError("Too many queued jobs")
+        job_id = secrets.token_hex(8)
+        _, log_path = self.paths(job_id)
+        job = {
+            "id": job_id,
+            "command": command,
+            "cwd": cwd,
+            "owner": owner,
+            "status": "queued",
+            "returncode": None,
+            "started": time.time(),
+            "finished": None,
+            "truncated": False,
+            "worker": None,
+            "pid": None
+        }
+        open(log_path, 'wb').close()
+        self.save(job)
+        open(self.queue_path(job_id), 'w').close()
+        with self.lock:
+            self.stats['queued'] += 1
+        job['output_size'] = 0
+        return job
+
+    def start_supervisor(self):
+        if self.supervisor and self.supervisor.is_alive():
+            return
+        self.stop_event.clear()
+        self.supervisor = threading.Thread(target=self._supervise, name="job-supervisor", daemon=True)
+        self.supervisor.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.supervisor:
+            self.supervisor.join(5)
+            self.supervisor = None
+
+    def _supervise(self):
+        while not self.stop_event.wait(self.poll):
+            try:
+                with self.lock:
+                    free = self.max_running - len(self.running) if self.max_running else None
+                if free is not None and free <= 0:
+                    continue
+                queued = []
+                for job_id in os.listdir(self.queue_dir):
+                    try:
+                        queued.append((os.path.getmtime(self.queue_path(job_id)), job_id))
+                    except OSError:
+                        continue
+                queued.sort()
+                for _, job_id in queued[:free]:
+                    try:
+                        # Removing the entry claims the job; a cancel that got there first wins
+                        os.remove(self.queue_path(job_id))
+                    except OSError:
+                        continue
+                    self.launch(job_id)
+            except Exception as e:
+                print(f"Job supervisor error: {e}")
+
+    def launch(self, job_id):
+        try:
+            job = self.get(job_id)
+        except KeyError:
+            return None
+        _, log_path = self.paths(job_id)
+        job.pop('output_size', None)
+        job.update(status='running', worker=os.getpid())
+        popen_args = {}
+        if os.name == 'nt':
+            popen_args['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            # Own process group so cancel and timeout reach every child
+            popen_args['start_new_session'] = True
+        try:
+            process = subprocess.Popen(
+                self.wrap_command(job['command']), shell=True, cwd=job['cwd'],
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                **popen_args
+            )
+        except OSError as e:
+            with open(log_path, 'w') as file:
+                file.write(str(e))
+            job.update(status='failed', finished=time.time())
+            self.save(job)
+            return job
+        job['pid'] = process.pid
+        self.save(job)
+        with self.lock:
+            self.running[job_id] = process
+            self.stats['started'] += 1
+        threading.Thread(target=self._pump, args=(job, process, log_path), name=f"job-{job_id}", daemon=True).start()
+        self.prune()
+        return job
+
+    def _pump(self, job, process, log_path):
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, self._expire, args=(job['id'],))
+            timer.daemon = True
+            timer.start()
+        written = 0
+        truncated = False
+        with open(log_path, 'ab', buffering=0) as log_file:
+            while True:
+                chunk = process.stdout.read1(READ_CHUNK)
+                if not chunk:
+                    break
+                if written < self.max_output:
+                    chunk = chunk[:self.max_output - written]
+                    log_file.write(chunk)
+                    written += len(chunk)
+                elif not truncated:
+                    # Keep draining so the command never blocks on a full pipe
+                    truncated = True
+                    self.update(job['id'], truncated=True)
+        returncode = process.wait()
+        if timer:
+            timer.cancel()
+        status = self.get(job['id'])['status']
+        self.update(job['id'], status='exited' if status == 'running' else status, returncode=returncode, finished=time.time())
+        with self.lock:
+            self.running.pop(job['id'], None)
+            self.stats['finished'] += 1
+
+    def _expire(self, job_id):
+        self.stats['timeouts'] += 1
+        self.cancel(job_id, status='timeout')
+
+    def cancel(self, job_id, status='killed', grace=5):
+        job = self.get(job_id)
+        if job['status'] == 'queued':
+            try:
+                os.remove(self.queue_path(job_id))
+            except OSError:
+                # The supervisor claimed it first, wait for the launch to record a pid
+                job = self.wait(job_id, timeout=grace, until=lambda job: job['status'] != 'queued')
+            else:
+                self.update(job_id, status=status, finished=time.time())
+                self.stats['cancelled'] += 1
+                return True
+        if job['status'] != 'running' or not job['pid']:
+            return False
+        self.update(job_id, status=status)
+        self.signal(job['pid'], signal.SIGTERM)
+        killer = threading.Timer(grace, self.signal, args=(job['pid'], getattr(signal, 'SIGKILL', signal.SIGTERM)))
+        killer.daemon = True
+        killer.start()
+        if status == 'killed':
+            self.stats['cancelled'] += 1
+        return True
+
+    def signal(self, pid, signum):
+        try:
+            if os.name == 'nt':
+                subprocess.run(['taskkill', '/T', '/F', '/PID', str(pid)], capture_output=True)
+            else:
+                os.killpg(pid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def read(self, job_id, offset=0, limit=READ_CHUNK):
+        """Return (data, next_offset, job) for output starting at a byte offset."""
+        job = self.get(job_id)
+        _, log_path = self.paths(job_id)
+        with open(log_path, 'rb') as file:
+            file.seek(offset)
+            data = file.read(limit)
+        return data, offset + len(data), job
+
+    def join(self, job_id, timeout=None):
+        """Wait for a job to exit, whichever process runs it, and return its state."""
+        return self.wait(job_id, timeout=timeout, until=lambda job: job['finished'] or job['status'] == 'lost')
+
+    def wait(self, job_id, offset=0, timeout=25, poll=0.2, until=None):
+        """Block until output past offset exists, the job finishes, or the timeout passes."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if until is None:
+            until = lambda job: job['output_size'] > offset or job['status'] in FINISHED_STATES
+        while True:
+            job = self.get(job_id)
+            if until(job) or (deadline is not None and time.monotonic() >= deadline):
+                return job
+            time.sleep(poll)
+
+    def prune(self):
+        finished = []
+        for name in os.listdir(self.job_dir):
+            if name.endswith('.json'):
+                try:
+                    job = self.get(name[:-5])
+                except KeyError:
+                    continue
+                if job['status'] in FINISHED_STATES:
+                    finished.append((job['started'], job['id']))
+        finished.sort(reverse=True)
+        for _, job_id in finished[self.keep_finished:]:
+            for path in self.paths(job_id):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['launched_here'] = len(self.running)
+        stats['pending'] = len(os.listdir(self.queue_dir))
+        stats['supervising'] = bool(self.supervisor and self.supervisor.is_alive())
+        return stats
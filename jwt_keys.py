@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import secrets
+import threading
+import jwt
+
+ALGORITHM = 'HS256'
+
+class KeyRing:
+    """HS256 signing keys kept in a JSON file, shared by every worker process.
+
+    New tokens are signed with the current key and carry its id in the
+    `kid` header. Tokens signed with a previous key keep verifying until
+    that key falls off the ring, so rotation does not log anyone out.
+    """
+
+    def __init__(self, path, max_keys=3, reload_interval=1.0):
+        self.path = path
+        self.max_keys = max(1, int(max_keys))
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.current = None
+        self.keys = {}
+        self.stamp = None
+        self.checked = 0
+        self.stats = {"reloads": 0, "rotations": 0, "unknown_kid": 0}
+
+    def file_stamp(self):
+        try:
+            stat_result = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+    def write(self, data):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, indent=2)
+        return temp_path
+
+    def new_key(self):
+        return {"kid": secrets.token_urlsafe(6), "secret": secrets.token_hex(32), "created": int(time.time())}
+
+    def ensure(self):
+        """Create the key file if it is missing; only the first worker to get there wins."""
+        if os.path.exists(self.path):
+            return self.load()
+        key = self.new_key()
+        temp_path = self.write({"current": key['kid'], "keys": [key]})
+        try:
+            os.link(temp_path, self.path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # No hard links on this filesystem, fall back to a plain replace
+            os.replace(temp_path, self.path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return self.load()
+
+    def load(self):
+        for _ in range(50):
+            stamp = self.file_stamp()
+            try:
+                with open(self.path, 'r') as file:
+                    data = json.load(file)
+                break
+            except (OSError, ValueError):
+                time.sleep(0.1)
+        else:
+            raise RuntimeError(f"Cannot read JWT key ring {self.path}")
+        keys = {key['kid']: key['secret'] for key in data.get('keys', [])}
+        if data.get('current') not in keys:
+            raise RuntimeError("JWT key ring has no current key")
+        with self.lock:
+            self.keys = keys
+            self.current = data['current']
+            self.stamp = stamp
+            self.checked = time.monotonic()
+            self.stats['reloads'] += 1
+        return self
+
+    def refresh(self, force=False):
+        if not force and time.monotonic() - self.checked < self.reload_interval:
+            return
+        self.checked = time.monotonic()
+        if self.file_stamp() != self.stamp:
+            self.load()
+
+    def rotate(self, retire_previous=False):
+        """Make a fresh key current and return its id."""
+        self.refresh(force=True)
+        with open(self.path, 'r') as file:
+            data = json.load(file)
+        key = self.new_key()
+        previous = [] if retire_previous else data.get('keys', [])
+        data = {"current": key['kid'], "keys": ([key] + previous)[:self.max_keys]}
+        os.replace(self.write(data), self.path)
+        self.stats['rotations'] += 1
+        self.load()
+        return key['kid']
+
+    def sign(self, payload):
+        self.refresh()
+        with self.lock:
+            kid, secret = self.current, self.keys[self.current]
+        return jwt.encode(payload, secret, algorithm=ALGORITHM, headers={"kid": kid})
+
+    def verify(self, token):
+        """Decode a token with the key named in its header, raising jwt.InvalidTokenError."""
+        self.refresh()
+        kid = jwt.get_unverified_header(token).get('kid')
+        secret = self.keys.get(kid)
+        if secret is None:
+            # Another worker may have rotated a moment ago
+            self.refresh(force=True)
+            secret = self.keys.get(kid)
+        if secret is None:
+            self.stats['unknown_kid'] += 1
+            raise jwt.InvalidTokenError("Unknown signing key")
+        return jwt.decode(token, secret, algorithms=[ALGORITHM])
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['current'] = self.current
+            stats['keys'] = len(self.keys)
+        return stats
@@ -47,6 +47,16 @@ def is_cloud_on():
         print(f"Error reading cloud settings: {e}")
     return None
 
+def get_server_mode():
+    try:
+        settings_path = os.path.join(os.path.dirname(__file__), 'settings', 'settings.json')
+        if os.path.exists(settings_path):
+            with open(settings_path, 'r') as f:
+                return json.load(f).get('server', 'auto')
+    except Exception as e:
+        print(f"Error reading server mode: {e}")
+    return 'auto'
+
 def main():
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -57,7 +67,7 @@ def main():
             print(f"Error: wsgi.py not found at {main_py_path}")
             return
         
-        print(f"Starting Shareify with Python: {python_exe}")
+        print(f"Starting Shareify with Python: {python_exe} (server mode: {get_server_mode()})")
 
         if is_cloud_on():
             print("Cloud mode is enabled. Starting cloud bridge connection...")
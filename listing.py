@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import base64
+import bisect
+import fnmatch
+import mimetypes
+import threading
+from collections import OrderedDict
+
+SORT_FIELDS = ('name', 'size', 'mtime', 'type')
+
+def scan_directory(full_path):
+    entries = []
+    with os.scandir(full_path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+                stat_result = entry.stat()
+                size = 0 if is_dir else stat_result.st_size
+                mtime = stat_result.st_mtime
+            except OSError:
+                is_dir, size, mtime = False, 0, 0
+            entries.append({
+                "name": entry.name,
+                "is_dir": is_dir,
+                "size": size,
+                "mtime": mtime,
+                "mime": None if is_dir else mimetypes.guess_type(entry.name)[0]
+            })
+    return entries
+
+def sort_key(entry, sort, dirs_first, descending=False):
+    if sort == 'size':
+        primary = entry['size']
+    elif sort == 'mtime':
+        primary = entry['mtime']
+    elif sort == 'type':
+        primary = entry['mime'] or ''
+    else:
+        primary = entry['name'].lower()
+    rank = 0
+    if dirs_first:
+        # Folders lead the page in either direction
+        rank = int(entry['is_dir'] == descending)
+    return [rank, primary, entry['name']]
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, list) or len(key) != 3:
+        raise ValueError("Invalid cursor")
+    return key
+
+class DirectoryListing:
+    def __init__(self, mtime_ns, entries):
+        self.mtime_ns = mtime_ns
+        self.loaded = time.monotonic()
+        self.entries = entries
+        self.sorted = {}
+
+    def ordered(self, sort, dirs_first, descending=False):
+        """Return (entries, keys) sorted ascending, cached per sort order."""
+        cache_key = (sort, dirs_first, descending)
+        if cache_key not in self.sorted:
+            decorated = sorted(((sort_key(e, sort, dirs_first, descending), e) for e in self.entries), key=lambda pair: pair[0])
+            # Names are unique within a directory, so keys never tie
+            self.sorted[cache_key] = ([e for _, e in decorated], [k for k, _ in decorated])
+        return self.sorted[cache_key]
+
+class ListingCache:
+    """Per-directory listing cache, revalidated against the directory mtime."""
+
+    def __init__(self, max_dirs=256, max_age=30):
+        self.max_dirs = max_dirs
+        self.max_age = max_age
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, full_path):
+        mtime_ns = os.stat(full_path).st_mtime_ns
+        with self.lock:
+            listing = self.listings.get(full_path)
+            if listing and listing.mtime_ns == mtime_ns and time.monotonic() - listing.loaded < self.max_age:
+                self.listings.move_to_end(full_path)
+                self.stats['hits'] += 1
+                return listing
+            self.stats['misses'] += 1
+        listing = DirectoryListing(mtime_ns, scan_directory(full_path))
+        with self.lock:
+            self.listings[full_path] = listing
+            self.listings.move_to_end(full_path)
+            while len(self.listings) > self.max_dirs:
+                self.listings.popitem(last=False)
+        return listing
+
+    def invalidate(self, full_path=None):
+        with self.lock:
+            self.stats['invalidations'] += 1
+            if full_path is None:
+                self.listings.clear()
+            else:
+                self.listings.pop(os.path.normpath(full_path), None)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['directories'] = len(self.listings)
+        return stats
+
+def list_page(listing, sort='name', descending=False, dirs_first=True, pattern=None, cursor=None, limit=500):
+    """Return (items, next_cursor, total) for one page of a directory listing."""
+    entries, keys = listing.ordered(sort, dirs_first, descending)
+    if pattern:
+        pattern = pattern.lower()
+        matched = [i for i, e in enumerate(entries) if fnmatch.fnmatchcase(e['name'].lower(), pattern)]
+        entries = [entries[i] for i in matched]
+        keys = [keys[i] for i in matched]
+    total = len(entries)
+
+    if descending:
+        start = total - bisect.bisect_left(keys, decode_cursor(cursor)) if cursor else 0
+        page = [entries[i] for i in range(total - 1 - start, max(-1, total - 1 - start - limit), -1)]
+        last = total - start - len(page)
+        next_cursor = encode_cursor(keys[last]) if page and last > 0 else None
+    else:
+        start = bisect.bisect_right(keys, decode_cursor(cursor)) if cursor else 0
+        page = entries[start:start + limit]
+        end = start + len(page)
+        next_cursor = encode_cursor(keys[end - 1]) if page and end < total else None
+    return page, next_cursor, total
@@ -1,5 +1,5 @@
 #Imports
-from flask import Flask, request, jsonify, g, send_from_directory
+from flask import Flask, Response, request, jsonify, g, send_from_directory
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import os
@@ -11,7 +11,12 @@ import mimetypes
 from colorama import init, Fore, Back, Style
 from pyftpdlib.authorizers import DummyAuthorizer
 from pyftpdlib.handlers import FTPHandler
-from pyftpdlib.servers import FTPServer
+from pyftpdlib.servers import FTPServer, ThreadedFTPServer
+try:
+    from pyftpdlib.servers import MultiprocessFTPServer
+except ImportError:
+    # Only available on POSIX
+    MultiprocessFTPServer = None
 import threading
 from flask_cors import CORS
 import secrets
@@ -21,11 +26,31 @@ import sys
 import ctypes
 import update
 from werkzeug.utils import secure_filename
-import zipfile
-import tempfile
 import shutil
 import jwt
 import requests
+from collections import OrderedDict
+import queue
+import time
+import atexit
+import base64
+import functools
+import streaming
+import archive
+import listing
+import search_index
+import watcher
+import jwt_keys
+import sampler
+import jobs
+import uploads
+import dedup
+import thumbnails
+import static_assets
+import compression
+import permissions
+import ftp_handlers
+import quotas
 
 def is_admin():
     try:
@@ -52,6 +77,41 @@ if not is_admin():
 init(autoreset=True)
 
 class CustomAuthorizer(DummyAuthorizer):
+    """DummyAuthorizer whose accounts follow the ftp_users table.
+
+    Every write to the table bumps db/ftp_users.gen. Logins check that
+    file's stamp, other permission lookups do so at most once a second,
+    and the accounts are reloaded when it moved, so edits reach every FTP
+    thread, process and worker without polling the database.
+    """
+
+    reload_interval = 1.0
+    stamp = None
+    checked = 0
+
+    def refresh(self, force=False):
+        if not force and time.monotonic() - self.checked < self.reload_interval:
+            return
+        self.checked = time.monotonic()
+        stamp = file_stamp(ftp_users_generation_file)
+        if stamp != self.stamp:
+            try:
+                reload_ftp_users()
+                self.stamp = stamp
+            except Exception as e:
+                print_status(f"Error reloading FTP users: {e}", "error")
+
+    def validate_authentication(self, username, password, handler):
+        self.refresh(force=True)
+        return super().validate_authentication(username, password, handler)
+
+    def has_perm(self, username, perm, path=None):
+        self.refresh()
+        if username not in self.user_table:
+            # The account was deleted while the session was open
+            return False
+        return super().has_perm(username, perm, path)
+
     def edit_user(self, username, password=None, homedir=None, perm=None):
         if username not in self.user_table:
             raise ValueError(f"User '{username}' does not exist.")
@@ -70,15 +130,26 @@ class CustomAuthorizer(DummyAuthorizer):
                 username,
                 user_data.get('pwd', ''),
                 user_data.get('home', ''),
-                user_data.get('perm', '')
+                user_data.get('perm', ''),
+                user_data.get('download_limit', 0),
+                user_data.get('upload_limit', 0),
+                user_data.get('max_transfers', 0)
             ])
         return user_list
 
+    def get_quota(self, username):
+        """Return (download_limit, upload_limit, max_transfers) for an account, 0 meaning unlimited."""
+        self.refresh()
+        user_data = self.user_table.get(username) or {}
+        return tuple(user_data.get(field, 0) for field in QUOTA_FIELDS)
+
 authorizer = CustomAuthorizer()
 logs_db_path = os.path.join(os.path.dirname(__file__), 'db/logs.db')
 users_db_path = os.path.join(os.path.dirname(__file__), 'db/users.db')
+ftp_users_generation_file = os.path.join(os.path.dirname(__file__), 'db/ftp_users.gen')
 
 ftp_server_instance = None
+ftp_external = False
 
 def initialize_logs_db():
     conn = sqlite3.connect(logs_db_path)
@@ -110,7 +181,10 @@ def initialize_users_db():
             paths TEXT,
             settings TEXT,
             API_KEY TEXT NOT NULL,
-            paths_write TEXT
+            paths_write TEXT,
+            download_limit INTEGER NOT NULL DEFAULT 0,
+            upload_limit INTEGER NOT NULL DEFAULT 0,
+            max_transfers INTEGER NOT NULL DEFAULT 0
         )
     ''')
     cursor.execute('''
@@ -119,9 +193,29 @@ def initialize_users_db():
             username TEXT NOT NULL UNIQUE,
             password TEXT NOT NULL,
             homedir TEXT NOT NULL,
-            permissions TEXT NOT NULL
+            permissions TEXT NOT NULL,
+            download_limit INTEGER NOT NULL DEFAULT 0,
+            upload_limit INTEGER NOT NULL DEFAULT 0,
+            max_transfers INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in ('users', 'ftp_users'):
+        for column in QUOTA_FIELDS:
+            try:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+            except sqlite3.OperationalError:
+                pass
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS command_dirs (
+            owner TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            updated REAL NOT NULL DEFAULT 0
         )
     ''')
+    try:
+        cursor.execute('ALTER TABLE command_dirs ADD COLUMN updated REAL NOT NULL DEFAULT 0')
+    except sqlite3.OperationalError:
+        pass
     conn.commit()
     conn.close()
 
@@ -135,15 +229,34 @@ def get_users_db_connection():
     conn.execute('PRAGMA journal_mode=WAL;')
     return conn
 
-def save_ftp_user_to_db(username, password, homedir, permissions):
+QUOTA_FIELDS = ('download_limit', 'upload_limit', 'max_transfers')
+
+def parse_quota_limits(data):
+    """Pick the quota fields present in a request body; None when one is not a non-negative integer."""
+    limits = {}
+    for field in QUOTA_FIELDS:
+        value = data.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            return None
+        limits[field] = value
+    return limits
+
+def save_ftp_user_to_db(username, password, homedir, permissions, limits=None):
     conn = get_users_db_connection()
     cursor = conn.cursor()
+    # Keep the current limits unless new ones were given
+    cursor.execute('SELECT download_limit, upload_limit, max_transfers FROM ftp_users WHERE username = ?', (username,))
+    current = dict(zip(QUOTA_FIELDS, cursor.fetchone() or (0, 0, 0)))
+    current.update(limits or {})
     cursor.execute('''
-        INSERT OR REPLACE INTO ftp_users (username, password, homedir, permissions)
-        VALUES (?, ?, ?, ?)
-    ''', (username, password, homedir, permissions))
+        INSERT OR REPLACE INTO ftp_users (username, password, homedir, permissions, download_limit, upload_limit, max_transfers)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (username, password, homedir, permissions, current['download_limit'], current['upload_limit'], current['max_transfers']))
     conn.commit()
     conn.close()
+    bump_generation(ftp_users_generation_file)
 
 def delete_ftp_user_from_db(username):
     conn = get_users_db_connection()
@@ -151,32 +264,93 @@ def delete_ftp_user_from_db(username):
     cursor.execute('DELETE FROM ftp_users WHERE username = ?', (username,))
     conn.commit()
     conn.close()
+    bump_generation(ftp_users_generation_file)
 
 def load_ftp_users_from_db():
-    conn = get_users_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT username, password, homedir, permissions FROM ftp_users')
-    ftp_users = cursor.fetchall()
-    conn.close()
-    
-    for username, password, homedir, permissions in ftp_users:
+    reload_ftp_users()
+    for username in authorizer.user_table:
+        print_status(f"Loaded FTP user: {username}", "success")
+
+def reload_ftp_users(rows=None):
+    """Replace the in-memory FTP accounts with the rows stored in the database."""
+    if rows is None:
+        conn = get_users_db_connection()
+        rows = conn.execute('SELECT username, password, homedir, permissions, download_limit, upload_limit, max_transfers FROM ftp_users ORDER BY username').fetchall()
+        conn.close()
+    fresh = CustomAuthorizer()
+    for username, password, homedir, permissions, *limits in rows:
         try:
-            authorizer.add_user(username, password, homedir, permissions)
-            print_status(f"Loaded FTP user: {username}", "success")
+            fresh.add_user(username, password, homedir, permissions)
+            fresh.user_table[username].update(zip(QUOTA_FIELDS, (limit or 0 for limit in limits)))
         except Exception as e:
             print_status(f"Error loading FTP user {username}: {e}", "error")
+    authorizer.user_table = fresh.user_table
+
+if MultiprocessFTPServer is not None:
+    class LimitedMultiprocessFTPServer(MultiprocessFTPServer):
+        """MultiprocessFTPServer that enforces max_cons_per_ip.
+
+        The parent closes its copy of each handler right after forking,
+        which takes the address out of ip_map, so the stock server never
+        sees more than one connection per IP. Live children are counted
+        here instead.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.task_ips = {}
+
+        def handle_accepted(self, sock, addr):
+            ip = addr[0]
+            busy = [ip for task, task_ip in list(self.task_ips.items()) if task_ip == ip and task.is_alive()]
+            self.ip_map.extend(busy)
+            started = len(self._active_tasks)
+            try:
+                super().handle_accepted(sock, addr)
+            finally:
+                for _ in busy:
+                    self.ip_map.remove(ip)
+            if len(self._active_tasks) > started:
+                self.task_ips[self._active_tasks[-1]] = ip
+
+        def _refresh_tasks(self):
+            super()._refresh_tasks()
+            self.task_ips = {task: ip for task, ip in self.task_ips.items() if task in self._active_tasks}
+else:
+    LimitedMultiprocessFTPServer = None
+
+FTP_SERVER_MODES = {
+    'async': FTPServer,
+    'thread': ThreadedFTPServer,
+    'multiprocess': LimitedMultiprocessFTPServer
+}
+
+def make_ftp_server():
+    handler = ftp_handlers.ShareifyFTPHandler
+    handler.authorizer = authorizer
+    handler.quotas = transfer_quotas
+
+    handler.timeout = settings['ftp_timeout']
+    ftp_handlers.apply_profile(handler, settings.get('ftp_sendfile', True), settings.get('ftp_buffer_kb', 256) * 1024)
+
+    mode = settings.get('ftp_mode', 'async')
+    server_class = FTP_SERVER_MODES.get(mode)
+    if server_class is None:
+        print_status(f"FTP mode '{mode}' is not available here, using thread mode", "error")
+        mode, server_class = 'thread', ThreadedFTPServer
+    address = (settings['ftp_host'], settings['ftp_port'])
+    server = server_class(address, handler)
+    server.max_cons = settings.get('ftp_max_cons', 256)
+    server.max_cons_per_ip = settings.get('ftp_max_cons_per_ip', 16)
+    print_status(f"FTP server mode: {mode} (max {server.max_cons} connections, {server.max_cons_per_ip or 'unlimited'} per IP)", "info")
+    return server
 
 def start_ftp_server():
     global ftp_server_instance, settings
     def run_ftp():
+        global ftp_server_instance
         try:
-            handler = FTPHandler
-            handler.authorizer = authorizer
-
-            handler.timeout = settings['ftp_timeout']
-
-            address = (settings['ftp_host'], settings['ftp_port'])
-            ftp_server_instance = FTPServer(address, handler)
+            ftp_server_instance = make_ftp_server()
 
             print_status("FTP server started successfully.", "success")
             log("FTP server started", "-")
@@ -188,16 +362,174 @@ def start_ftp_server():
     ftp_thread = threading.Thread(target=run_ftp, daemon=True)
     ftp_thread.start()
 
+def serve_ftp_forever():
+    """Entry point of the FTP process that runs next to the web workers."""
+    initialize_users_db()
+    server = make_ftp_server()
+    print_status("FTP server started successfully.", "success")
+    log("FTP server started", "-")
+    server.serve_forever()
+
+def set_ftp_enabled(enabled):
+    with open(settings_file, 'r') as file:
+        current_settings = json.load(file)
+    current_settings['ftp'] = enabled
+    # Other workers and the FTP supervisor read this file at any moment, never let them see half of it
+    temp_path = f"{settings_file}.{os.getpid()}"
+    with open(temp_path, 'w') as file:
+        json.dump(current_settings, file)
+    os.replace(temp_path, settings_file)
+    reload_jsons()
+
+class LogWriter:
+    """Background writer that flushes queued log rows in batched transactions."""
+
+    OVERFLOW_POLICIES = ('drop', 'block', 'count')
+
+    def __init__(self, batch_size=100, flush_interval=0.5, max_queue=10000, overflow='drop'):
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.overflow = overflow if overflow in self.OVERFLOW_POLICIES else 'drop'
+        self.queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "batches": 0, "errors": 0}
+        self.pending_overflow = 0
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def submit(self, entry):
+        try:
+            if self.overflow == 'block':
+                self.queue.put(entry, timeout=5)
+            else:
+                self.queue.put_nowait(entry)
+        except queue.Full:
+            with self.lock:
+                self.stats['dropped'] += 1
+                if self.overflow == 'count':
+                    self.pending_overflow += 1
+            return False
+        with self.lock:
+            self.stats['queued'] += 1
+        return True
+
+    def stop(self, timeout=5):
+        if not self.is_running():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+        self.thread = None
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['pending'] = self.queue.qsize()
+        stats['overflow_policy'] = self.overflow
+        stats['running'] = self.is_running()
+        return stats
+
+    def _run(self):
+        running = True
+        while running:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    running = False
+                    break
+                batch.append(entry)
+            if not running:
+                # Drain whatever is left so shutdown loses nothing
+                while True:
+                    try:
+                        entry = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is not None:
+                        batch.append(entry)
+            self._write(batch)
+
+    def _write(self, batch):
+        with self.lock:
+            overflow = self.pending_overflow
+            self.pending_overflow = 0
+        if overflow:
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            batch.append((timestamp, f"Log queue overflow: {overflow} entries dropped", "-"))
+        if not batch:
+            return
+        try:
+            conn = get_db_connection()
+            try:
+                with conn:
+                    conn.executemany('''
+                        INSERT INTO logs (timestamp, action, ip)
+                        VALUES (?, ?, ?)
+                    ''', batch)
+            finally:
+                conn.close()
+            with self.lock:
+                self.stats['written'] += len(batch)
+                self.stats['batches'] += 1
+        except Exception as e:
+            with self.lock:
+                self.stats['errors'] += 1
+            print_status(f"Error writing logs: {e}", "error")
+
+log_writer = None
+
+def start_log_writer():
+    global log_writer
+    if log_writer and log_writer.is_running():
+        return log_writer
+    log_writer = LogWriter(
+        batch_size=settings.get('log_batch_size', 100),
+        flush_interval=settings.get('log_flush_ms', 500) / 1000,
+        max_queue=settings.get('log_queue_size', 10000),
+        overflow=settings.get('log_overflow', 'drop')
+    )
+    log_writer.start()
+    atexit.register(stop_log_writer)
+    return log_writer
+
+def stop_log_writer():
+    if log_writer:
+        log_writer.stop()
+
 # Functions
 def log(action, ip):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if log_writer and log_writer.is_running():
+        log_writer.submit((timestamp, action, ip))
+        return
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO logs (timestamp, action, ip)
-        VALUES (?, ?, ?)
-    ''', (timestamp, action, ip))
-    conn.commit()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO logs (timestamp, action, ip)
+            VALUES (?, ?, ?)
+        ''', (timestamp, action, ip))
+        conn.commit()
+    finally:
+        conn.close()
 
 def print_status(message, status_type="info"):
     if status_type == "success":
@@ -260,6 +592,15 @@ def stop_completely():
         except Exception as e:
             print_status(f"Error stopping FTP server: {e}", "error")
 
+    last_seen.stop()
+    if job_manager:
+        job_manager.stop()
+    if resource_sampler:
+        resource_sampler.stop()
+    if thumbnail_cache:
+        thumbnail_cache.shutdown()
+    stop_log_writer()
+
     try:
         def shutdown_server():
             sleep(1)
@@ -281,40 +622,197 @@ def reload_jsons():
     settings = load_settings(settings_file)
     roles = load_roles(roles_file)
 
+jwt_keys_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings/jwt_keys.json")
+principal_generation_file = os.path.join(os.path.dirname(__file__), 'db/principals.gen')
+shared_state_stamps = {}
+# How often each worker looks for edits made by other workers
+SHARED_STATE_CHECK_SECONDS = 0.5
+
+def file_stamp(path):
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+def bump_generation(path):
+    temp_path = f"{path}.{os.getpid()}"
+    with open(temp_path, 'w') as file:
+        file.write(str(time.time_ns()))
+    os.replace(temp_path, path)
+
+def bump_principal_generation():
+    bump_generation(principal_generation_file)
+
+def sync_shared_state():
+    """Pick up settings, roles and user edits written by other worker processes."""
+    global settings, roles, principal_cache_generation
+    now = time.monotonic()
+    if now - shared_state_stamps.get('checked', -SHARED_STATE_CHECK_SECONDS) < SHARED_STATE_CHECK_SECONDS:
+        return
+    shared_state_stamps['checked'] = now
+    stamps = (file_stamp(settings_file), file_stamp(roles_file))
+    if shared_state_stamps.get('jsons') != stamps:
+        new_settings = load_settings(settings_file)
+        new_roles = load_roles(roles_file)
+        # A half-written file parses as None, keep the old values until the next request
+        if new_settings is not None and new_roles is not None:
+            shared_state_stamps['jsons'] = stamps
+            settings, roles = new_settings, new_roles
+            apply_root_change()
+    stamp = file_stamp(principal_generation_file)
+    if shared_state_stamps.get('principals') != stamp:
+        shared_state_stamps['principals'] = stamp
+        with principal_cache_lock:
+            # A lookup already running must not store what it read before the edit
+            principal_cache_generation += 1
+            principal_cache.clear()
+
+role_matrix = permissions.RoleMatrix()
+
 def is_accessible(address):
     try:
         global roles
-        list = roles.get(address, [])
-        for item in list:
-            if item == g.role:
-                return True
-        return False
+        return role_matrix.allows(roles, address, g.role)
     except Exception as e:
         print_status("Error: " + str(e), "error")
         log("Error on is_accessible: " + str(e), "-")
         return False
 
+def parse_path_list(value):
+    if not value:
+        return []
+    try:
+        paths = json.loads(value)
+    except (TypeError, ValueError):
+        return []
+    return paths if isinstance(paths, list) else []
+
 def has_access(path):
-    result = g.result
-    if result:
-        paths = result[7]
-        if paths:
-            paths = json.loads(paths)
-            for p in paths:
-                if path.startswith(p):
-                    return True
-    return False
+    return getattr(g, 'read_access', permissions.EMPTY).matches(path)
 
 def has_write_access(path):
-    result = g.result
-    if result:
-        paths_write = result[10]
-        if paths_write:
-            paths_write = json.loads(paths_write)
-            for p in paths_write:
-                if path.startswith(p):
-                    return True
-    return False
+    return getattr(g, 'write_access', permissions.EMPTY).matches(path)
+
+PRINCIPAL_CACHE_SIZE = 1024
+principal_cache = OrderedDict()
+principal_cache_lock = threading.Lock()
+principal_cache_generation = 0
+principal_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def get_principal(user_id, signature):
+    global principal_cache_generation
+    key = (user_id, signature)
+    with principal_cache_lock:
+        principal = principal_cache.get(key)
+        if principal is not None:
+            principal_cache.move_to_end(key)
+            principal_cache_stats['hits'] += 1
+            return principal
+        principal_cache_stats['misses'] += 1
+        generation = principal_cache_generation
+
+    conn = get_users_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
+    result = cursor.fetchone()
+    conn.close()
+    if not result:
+        return None
+
+    paths = parse_path_list(result[7])
+    paths_write = parse_path_list(result[10])
+    principal = {
+        "result": result,
+        "role": result[5],
+        "paths": paths,
+        "paths_write": paths_write,
+        "read_access": permissions.PathTrie(paths),
+        "write_access": permissions.PathTrie(paths_write),
+        "quota": tuple(value or 0 for value in result[11:14])
+    }
+    with principal_cache_lock:
+        # Skip caching if an edit invalidated the cache while we were reading
+        if generation == principal_cache_generation:
+            principal_cache[key] = principal
+            while len(principal_cache) > PRINCIPAL_CACHE_SIZE:
+                principal_cache.popitem(last=False)
+    return principal
+
+def invalidate_principal_cache(user_id=None):
+    global principal_cache_generation
+    try:
+        bump_principal_generation()
+    except OSError as e:
+        print_status(f"Error signalling user change to other workers: {e}", "error")
+    with principal_cache_lock:
+        principal_cache_generation += 1
+        principal_cache_stats['invalidations'] += 1
+        if user_id is None:
+            principal_cache.clear()
+            return
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            principal_cache.clear()
+            return
+        for key in [key for key in principal_cache if key[0] == user_id]:
+            del principal_cache[key]
+
+transfer_quotas = quotas.QuotaManager(os.path.join(os.path.dirname(__file__), 'db/quotas.db'))
+
+def begin_transfer(direction):
+    """Take one of the caller's transfer slots; raises quotas.QuotaExceeded when none is free."""
+    download_limit, upload_limit, max_transfers = getattr(g, 'quota', (0, 0, 0))
+    return transfer_quotas.acquire(f"user:{g.user_id}", direction, download_limit, upload_limit, max_transfers)
+
+def paced_response(response, transfer):
+    if response.status_code not in (200, 206):
+        transfer.release()
+    elif not response.is_streamed and not response.direct_passthrough:
+        # Buffered bodies (JSON) are paid for up front so compression still applies
+        transfer.consume(response.content_length or 0)
+        transfer.release()
+    elif transfer.limited or response.content_length is None:
+        response.response = transfer.iterate(response.response)
+        response.call_on_close(transfer.release)
+    else:
+        # Uncapped files keep the wsgi.file_wrapper / sendfile path
+        length = response.content_length
+        response.call_on_close(lambda: transfer.release(length))
+    return response
+
+def metered(direction):
+    """Run a view inside one of the caller's transfer slots, paced by their bandwidth caps."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                transfer = begin_transfer(direction)
+            except quotas.QuotaExceeded as e:
+                return jsonify({"error": str(e)}), 429
+            if direction == 'upload' and transfer.limited:
+                # Must happen before anything reads the body
+                request.environ['wsgi.input'] = transfer.reader(request.environ['wsgi.input'])
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                transfer.release()
+                raise
+            if direction == 'upload':
+                transfer.release(request.content_length)
+                return response
+            return paced_response(response, transfer)
+        return wrapper
+    return decorator
+
+def get_principal_cache_stats():
+    with principal_cache_lock:
+        stats = dict(principal_cache_stats)
+        stats['size'] = len(principal_cache)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+    return stats
 
 def is_cloud_on():
     try:
@@ -330,10 +828,103 @@ def is_cloud_on():
         print(f"Error reading cloud settings: {e}")
     return None
 
+cloud_on = None
+
+def refresh_cloud_state():
+    global cloud_on
+    cloud_on = is_cloud_on()
+    return cloud_on
+
+class LastSeenTracker:
+    """Collects the latest IP per user and writes changed values in the background."""
+
+    def __init__(self, interval=5):
+        self.interval = max(0.1, float(interval))
+        self.seen = {}
+        self.stored = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {"touches": 0, "writes": 0, "flushes": 0}
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="last-seen", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(5)
+            self.thread = None
+        self.flush()
+
+    def touch(self, user_id, ip, stored_ip=None):
+        with self.lock:
+            self.stats['touches'] += 1
+            if user_id not in self.stored:
+                self.stored[user_id] = stored_ip
+            self.seen[user_id] = ip
+
+    def forget(self, user_id):
+        with self.lock:
+            self.seen.pop(user_id, None)
+            self.stored.pop(user_id, None)
+
+    def flush(self):
+        with self.lock:
+            pending = dict(self.seen)
+            changes = [(ip, user_id) for user_id, ip in pending.items() if self.stored.get(user_id) != ip]
+            if not changes:
+                self.seen.clear()
+                return 0
+        try:
+            conn = get_users_db_connection()
+            try:
+                with conn:
+                    conn.executemany('''
+                        UPDATE users
+                        SET ip = ?
+                        WHERE id = ?
+                    ''', changes)
+            finally:
+                conn.close()
+        except Exception as e:
+            # Entries stay in seen, the next flush tries again
+            print_status(f"Error updating IP in database: {e}", "error")
+            return 0
+        with self.lock:
+            for ip, user_id in changes:
+                self.stored[user_id] = ip
+            for user_id, ip in pending.items():
+                # Keep anything touched again while we were writing
+                if self.seen.get(user_id) == ip:
+                    del self.seen[user_id]
+            self.stats['writes'] += len(changes)
+            self.stats['flushes'] += 1
+        return len(changes)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending'] = len(self.seen)
+        return stats
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.flush()
+
+last_seen = LastSeenTracker()
+
 # Flask app
 app = Flask(__name__)
 CORS(app)
-app.config['JWT_SECRET_KEY'] = secrets.token_hex(32)
+key_ring = jwt_keys.KeyRing(
+    jwt_keys_file,
+    max_keys=(settings or {}).get('jwt_keys_kept', 3)
+).ensure()
 
 limiter = Limiter(
     app,
@@ -342,7 +933,10 @@ limiter = Limiter(
 
 @app.before_request
 def require_jwt():
-    if request.endpoint in ['login', 'is_up', 'root', 'serve_static', 'serve_assets', 'auth', 'preview']:
+    if request.endpoint in ['serve_static', 'serve_assets']:
+        return
+    sync_shared_state()
+    if request.endpoint in ['login', 'is_up', 'root', 'auth', 'preview']:
         return
     auth_header = request.headers.get('Authorization')
     if not auth_header or not auth_header.startswith('Bearer '):
@@ -351,23 +945,25 @@ def require_jwt():
     
     token = auth_header.split(' ')[1]
     try:
-        payload = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
+        payload = key_ring.verify(token)
         user_id = payload.get('user_id')
-        
-        conn = get_users_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        
-        if not result:
+        signature = token.rsplit('.', 1)[-1]
+
+        principal = get_principal(user_id, signature)
+
+        if not principal:
             log(str("Unauthorized access attempt (user not found) " + (request.endpoint or "")), request.remote_addr)
             return jsonify({"error": "Unauthorized"}), 401
-        
-        role = result[5]
-        g.role = role
-        g.result = result
+
+        g.role = principal['role']
+        g.result = principal['result']
+        g.paths = principal['paths']
+        g.paths_write = principal['paths_write']
+        g.read_access = principal['read_access']
+        g.write_access = principal['write_access']
+        g.quota = principal['quota']
         g.user_id = user_id
+        g.session_id = payload.get('sid')
         
         if request.endpoint in ['get_user', 'self_edit_user', 'get_self_role']:
             return
@@ -383,19 +979,16 @@ def require_jwt():
 @app.after_request
 def update_ip(response):
     if response.status_code == 200 and hasattr(g, 'user_id'):
-        try:
-            conn = get_users_db_connection()
-            cursor = conn.cursor()
-            if (not is_cloud_on()) or request.remote_addr != '127.0.0.1':
-                cursor.execute('''
-                    UPDATE users
-                    SET ip = ?
-                    WHERE id = ?
-                ''', (request.remote_addr, g.user_id))
-                conn.commit()
-                conn.close()
-        except Exception as e:
-            print_status(f"Error updating IP in database: {e}", "error")
+        if (not cloud_on) or request.remote_addr != '127.0.0.1':
+            last_seen.touch(g.user_id, request.remote_addr, g.result[4])
+    return response
+
+response_compressor = compression.ResponseCompressor()
+
+@app.after_request
+def compress_response(response):
+    if request.path.startswith('/api/') and settings.get('compress_responses', True):
+        return response_compressor.apply(request, response)
     return response
 
 @app.route('/api/is_up', methods=['GET'])
@@ -403,6 +996,37 @@ def update_ip(response):
 def is_up():
     return jsonify({"status": "Server is up"}), 200
 
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    return jsonify({
+        "principal_cache": get_principal_cache_stats(),
+        "log_writer": log_writer.get_stats() if log_writer else None,
+        "last_seen": last_seen.get_stats(),
+        "listing_cache": listing_cache.get_stats(),
+        "search_index": file_index.get_stats() if file_index else None,
+        "jwt_keys": key_ring.get_stats(),
+        "resource_sampler": resource_sampler.get_stats() if resource_sampler else None,
+        "jobs": job_manager.get_stats() if job_manager else None,
+        "uploads": upload_store.get_stats() if upload_store else None,
+        "dedup": dedup_store.get_stats() if dedup_store else None,
+        "thumbnails": thumbnail_cache.get_stats() if thumbnail_cache else None,
+        "static_assets": static_pipeline.get_stats(),
+        "compression": response_compressor.get_stats(),
+        "quotas": transfer_quotas.get_stats(),
+        "watcher": dict(change_feed.stats, kind=fs_watcher.kind if fs_watcher else None)
+    }), 200
+
+@app.route('/api/jwt/rotate', methods=['POST'])
+def rotate_jwt_key():
+    retire_previous = bool((request.get_json(silent=True) or {}).get('retire_previous'))
+    try:
+        kid = key_ring.rotate(retire_previous)
+    except Exception as e:
+        log("JWT key rotation error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+    log("JWT signing key rotated" + (" and previous keys retired" if retire_previous else ""), request.remote_addr)
+    return jsonify({"status": "JWT key rotated", "kid": kid}), 200
+
 @app.route('/api/shutdown', methods=['POST'])
 def shutdown():
     log("Shutdown", request.remote_addr)
@@ -462,17 +1086,306 @@ def finder():
             log("Finder error: " + str(e), request.remote_addr)
             return jsonify({"error": "Internal server error"}), 500
 
-current_command_dir = None
+listing_cache = listing.ListingCache()
+
+@app.route('/api/finder/v2', methods=['GET'])
+def finder_v2():
+    global settings
+    path = request.args.get('path') or ''
+    sort = request.args.get('sort', 'name')
+    order = request.args.get('order', 'asc')
+    limit = request.args.get('limit', 500, type=int)
+    if sort not in listing.SORT_FIELDS or order not in ('asc', 'desc') or not limit or limit < 1:
+        return jsonify({"error": "Invalid listing parameters"}), 400
+    if not has_access(path):
+        log("Unauthorized access attempt in finder", request.remote_addr)
+        return jsonify({"error": "Unauthorized"}), 401
+    full_path = os.path.normpath(os.path.join(settings['path'], path))
+    if not full_path.startswith(settings['path']):
+        return jsonify({"error": "Unauthorized"}), 401
+    if not os.path.isdir(full_path):
+        return jsonify({"error": "Path does not exist"}), 404
+    try:
+        follow_changes()
+        directory = listing_cache.get(full_path)
+        items, next_cursor, total = listing.list_page(
+            directory,
+            sort=sort,
+            descending=order == 'desc',
+            dirs_first=request.args.get('dirs_first', 'true').lower() != 'false',
+            pattern=request.args.get('glob'),
+            cursor=request.args.get('cursor'),
+            limit=min(limit, 5000)
+        )
+        return jsonify({"items": items, "next_cursor": next_cursor, "total": total}), 200
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid cursor"}), 400
+    except Exception as e:
+        log("Finder error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+
+file_index = None
+
+def start_search_index(crawl=True):
+    global file_index
+    if file_index:
+        file_index.stop()
+    file_index = search_index.SearchIndex(
+        os.path.join(os.path.dirname(__file__), 'db/search.db'),
+        settings['path'],
+        recrawl_interval=settings.get('search_recrawl_hours', 24) * 3600
+    )
+    file_index.initialize()
+    if crawl:
+        file_index.start()
+    return file_index
+
+def index_update(full_path):
+    if file_index:
+        try:
+            file_index.update_path(full_path)
+        except Exception as e:
+            print_status(f"Search index update failed: {e}", "error")
+
+def index_remove(full_path):
+    if file_index:
+        try:
+            file_index.remove_path(full_path)
+        except Exception as e:
+            print_status(f"Search index update failed: {e}", "error")
+
+def index_rename(old_full_path, new_full_path):
+    if file_index:
+        try:
+            file_index.rename_path(old_full_path, new_full_path)
+        except Exception as e:
+            print_status(f"Search index update failed: {e}", "error")
+
+@app.route('/api/search', methods=['GET'])
+def search_files():
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "No search query provided"}), 400
+    if not file_index:
+        return jsonify({"error": "Search index is disabled"}), 503
+    under = request.args.get('path') or None
+    if under and not has_access(under):
+        log("Unauthorized access attempt in search", request.remote_addr)
+        return jsonify({"error": "Unauthorized"}), 401
+    limit = min(max(request.args.get('limit', 100, type=int) or 100, 1), 1000)
+    offset = max(request.args.get('offset', 0, type=int) or 0, 0)
+    try:
+        results = file_index.search(query, g.paths, under, limit, offset)
+        return jsonify({"results": results}), 200
+    except Exception as e:
+        log("Search error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+
+change_feed = watcher.ChangeFeed(os.path.join(os.path.dirname(__file__), 'db/changes.db'))
+fs_watcher = None
+
+change_cursor = None
+change_cursor_lock = threading.Lock()
+
+def follow_changes():
+    """Drop this worker's cached listings for changes the leader's watcher published since the last call."""
+    global change_cursor
+    if not settings.get('watch', True):
+        return
+    with change_cursor_lock:
+        try:
+            events, _, newest = change_feed.read(change_cursor or 0)
+        except sqlite3.Error:
+            # The leader has not created the feed yet
+            return
+        if change_cursor is None or newest != change_cursor + len(events):
+            # First look, more happened than one read covers, or the feed was pruned or recreated
+            listing_cache.invalidate()
+            change_cursor = newest
+            return
+        root = os.path.normpath(settings['path'])
+        for event in events:
+            if event['event'] == 'rescan':
+                listing_cache.invalidate()
+                continue
+            full_path = os.path.normpath(os.path.join(root, event['path']))
+            listing_cache.invalidate(os.path.dirname(full_path))
+            if event['is_dir']:
+                listing_cache.invalidate(full_path)
+            if event['old_path']:
+                old_full_path = os.path.normpath(os.path.join(root, event['old_path']))
+                listing_cache.invalidate(os.path.dirname(old_full_path))
+                listing_cache.invalidate(old_full_path)
+        if events:
+            change_cursor = events[-1]['seq']
+
+def apply_changes(events):
+    """Keep the search index in step with changes made outside the API; runs in the leader only."""
+    root = os.path.normpath(settings['path'])
+    for event in events:
+        if event['event'] == 'rescan':
+            if file_index:
+                file_index.request_crawl()
+            continue
+        full_path = os.path.normpath(os.path.join(root, event['path']))
+        if event['event'] == 'moved':
+            old_full_path = os.path.normpath(os.path.join(root, event['old_path']))
+            index_rename(old_full_path, full_path)
+        elif event['event'] == 'deleted':
+            index_remove(full_path)
+        elif file_index:
+            # The watcher reports every entry of a new folder itself
+            try:
+                file_index.update_path(full_path, recursive=False)
+            except Exception as e:
+                print_status(f"Search index update failed: {e}", "error")
+
+change_feed.subscribe(apply_changes)
+
+leader_lock_path = os.path.join(os.path.dirname(__file__), 'db/leader.lock')
+leader_lock = None
+
+def try_become_leader():
+    """Take the lock that elects one worker process to run the crawler and the watcher."""
+    global leader_lock
+    if leader_lock:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        # Windows always serves from a single process
+        leader_lock = True
+        return True
+    lock_file = open(leader_lock_path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    leader_lock = lock_file
+    return True
+
+def run_leader_services():
+    while not try_become_leader():
+        sleep(5)
+    print_status(f"Worker {os.getpid()} runs the background indexer", "info")
+    if job_manager:
+        job_manager.start_supervisor()
+    if resource_sampler:
+        resource_sampler.start()
+    if file_index:
+        file_index.start()
+    if settings.get('watch', True):
+        start_watcher()
+
+def apply_root_change():
+    if file_index and os.path.normpath(settings['path']) != file_index.root:
+        start_search_index(crawl=leader_lock is not None)
+    if fs_watcher and os.path.normpath(settings['path']) != fs_watcher.root:
+        start_watcher()
+
+def start_watcher():
+    global fs_watcher
+    if fs_watcher:
+        fs_watcher.stop()
+    change_feed.retention = settings.get('changes_retention', 100000)
+    change_feed.initialize()
+    fs_watcher = watcher.create_watcher(settings['path'], change_feed, settings.get('watch_poll_seconds', 10))
+    fs_watcher.start()
+    print_status(f"Watching {settings['path']} ({fs_watcher.kind})", "info")
+    return fs_watcher
+
+def change_visible(event, access):
+    return access.matches(event['path']) or bool(event['old_path'] and access.matches(event['old_path']))
+
+@app.route('/api/changes', methods=['GET'])
+def changes():
+    since = request.args.get('since', type=int)
+    if since is None:
+        since = request.headers.get('Last-Event-ID', type=int)
+    access = g.read_access
+    # wsgiref serves one request at a time, so nobody may hold it for a long-poll there
+    can_block = request.environ.get('wsgi.multithread') or request.environ.get('wsgi.multiprocess')
+    oldest, newest = change_feed.head()
+    if since is None:
+        return jsonify({"events": [], "next": newest}), 200
+    if since > newest or (oldest and since < oldest - 1):
+        # Events the client has not seen were pruned, it has to relist
+        return jsonify({"events": [], "next": newest, "reset": True}), 200
+
+    if request.accept_mimetypes.best == 'text/event-stream' and can_block:
+        # End the stream now and then so it gives its thread back and the client
+        # reconnects with fresh credentials, resuming from Last-Event-ID
+        deadline = time.monotonic() + settings.get('changes_stream_seconds', 300)
+        def generate(cursor):
+            yield "retry: 3000\n\n"
+            while time.monotonic() < deadline:
+                events, _, _ = change_feed.read(cursor)
+                if events:
+                    cursor = events[-1]['seq']
+                    for event in events:
+                        if change_visible(event, access):
+                            yield watcher.format_sse(event)
+                elif not change_feed.wait(cursor, min(15, max(deadline - time.monotonic(), 0))):
+                    yield ": keepalive\n\n"
+            # Resume after events this user could not see as well
+            yield f"id: {cursor}\n\n"
+        response = Response(generate(since), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    timeout = min(max(request.args.get('timeout', 25, type=int) or 0, 0), 60) if can_block else 0
+    events, _, _ = change_feed.read(since)
+    if not events and timeout:
+        change_feed.wait(since, timeout)
+        events, _, _ = change_feed.read(since)
+    next_seq = events[-1]['seq'] if events else since
+    result = {"events": [e for e in events if change_visible(e, access)], "next": next_seq}
+    if not can_block:
+        # Seconds the client should wait before asking again
+        result['poll'] = settings.get('changes_poll_seconds', 10)
+    return jsonify(result), 200
+
+def command_session():
+    """Key of the caller's shell state: one per login, so users no longer share a directory."""
+    sid = getattr(g, 'session_id', None)
+    return f"{g.user_id}:{sid}" if sid else str(g.user_id)
 
 def get_command_dir():
-    global current_command_dir, settings
-    if current_command_dir is None:
-        current_command_dir = settings['path']
-    return current_command_dir
+    global settings
+    conn = get_users_db_connection()
+    row = conn.execute('SELECT path FROM command_dirs WHERE owner = ?', (command_session(),)).fetchone()
+    conn.close()
+    return row[0] if row else settings['path']
 
 def set_command_dir(new_dir):
-    global current_command_dir
-    current_command_dir = new_dir
+    conn = get_users_db_connection()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO command_dirs (owner, path, updated) VALUES (?, ?, ?)', (command_session(), new_dir, time.time()))
+    conn.close()
+
+def prune_command_dirs(max_age=2 * 86400):
+    conn = get_users_db_connection()
+    with conn:
+        # Tokens live for 24 hours, so older sessions can never come back
+        conn.execute('DELETE FROM command_dirs WHERE updated < ?', (time.time() - max_age,))
+    conn.close()
+
+job_manager = None
+
+def start_job_manager():
+    global job_manager
+    job_manager = jobs.JobManager(
+        os.path.join(os.path.dirname(__file__), 'db/jobs'),
+        timeout=settings.get('job_timeout', 300),
+        cpu_seconds=settings.get('job_cpu_seconds'),
+        memory_mb=settings.get('job_memory_mb'),
+        max_output=settings.get('job_max_output_mb', 16) * 1024 * 1024,
+        max_running=settings.get('job_max_running', 4),
+        max_queued=settings.get('job_max_queued', 16)
+    )
+    return job_manager
 
 @app.route('/api/command', methods=['POST'])
 def command():
@@ -499,6 +1412,7 @@ def command():
                         return jsonify({"error": "Unauthorized"}), 401
                     if not os.path.exists(new_dir):
                         os.makedirs(new_dir)
+                        index_update(new_dir)
                         return jsonify({"status": "Command executed", "output": f"Created directory: {target_dir}"})
                 else:
                     log("Unauthorized access attempt in creating directory", request.remote_addr)
@@ -535,22 +1449,111 @@ def command():
             
             else:
                 current_dir = get_command_dir()
-                if os.name == 'nt':
-                    full_command = f'cd /d "{current_dir}" && {command}'
-                else:
-                    full_command = f'cd "{current_dir}" && {command}'
-                
-                stream = os.popen(full_command)
-                output = stream.read()
+                job = job_manager.submit(command, current_dir, g.user_id)
+                job = job_manager.join(job['id'], job_manager.timeout + 10 if job_manager.timeout else None)
+                output, _, _ = job_manager.read(job['id'], 0, job_manager.max_output)
                 log("Command executed: " + command, request.remote_addr)
-                return jsonify({"status": "Command executed", "output": output})
+                return jsonify({"status": "Command executed", "output": jobs.decode_output(output, final=True)[0]})
                 
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 429
         except Exception as e:
             log("Command execution error: " + str(e), request.remote_addr)
             return jsonify({"error": "Internal server error"}), 500
     else:
         return jsonify({"error": "No command provided"}), 400
     
+@app.route('/api/jobs/start', methods=['POST'])
+def start_job():
+    command = (request.get_json(silent=True) or {}).get('command')
+    if not command or not command.strip():
+        return jsonify({"error": "No command provided"}), 400
+    try:
+        job = job_manager.submit(command.strip(), get_command_dir(), g.user_id)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 429
+    except Exception as e:
+        log("Job start error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+    log("Job started: " + command, request.remote_addr)
+    return jsonify({"status": "Job started", "job": job}), 200
+
+def get_own_job(job_id):
+    try:
+        job = job_manager.get(job_id or '')
+    except KeyError:
+        return None
+    return job if job['owner'] == g.user_id else None
+
+@app.route('/api/jobs/list', methods=['GET'])
+def list_jobs():
+    return jsonify({"jobs": job_manager.list(g.user_id)}), 200
+
+@app.route('/api/jobs/output', methods=['GET'])
+def job_output():
+    job_id = request.args.get('id')
+    if not get_own_job(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        offset = request.headers.get('Last-Event-ID', 0, type=int)
+    offset = max(offset or 0, 0)
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        def generate(offset):
+            held = 0
+            while True:
+                # Bytes of a split character already seen do not count as new output
+                job = job_manager.wait(job_id, offset + held, timeout=15)
+                data, next_offset, job = job_manager.read(job_id, offset)
+                done = job['status'] in jobs.FINISHED_STATES and next_offset >= job['output_size']
+                text, used = jobs.decode_output(data, final=done)
+                held = len(data) - used
+                if used:
+                    offset += used
+                    yield f"id: {offset}\nevent: output\ndata: {json.dumps(text)}\n\n"
+                if done:
+                    yield f"event: exit\ndata: {json.dumps({'status': job['status'], 'returncode': job['returncode']})}\n\n"
+                    return
+                if not used:
+                    yield ": keepalive\n\n"
+        response = Response(generate(offset), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    wait = min(max(request.args.get('wait', 0, type=int) or 0, 0), 60)
+    deadline = time.monotonic() + wait
+    if wait:
+        job_manager.wait(job_id, offset, timeout=wait)
+    limit = min(max(request.args.get('limit', jobs.READ_CHUNK, type=int) or jobs.READ_CHUNK, 1), 1024 * 1024)
+    while True:
+        data, next_offset, job = job_manager.read(job_id, offset, limit)
+        done = job['status'] in jobs.FINISHED_STATES and next_offset >= job['output_size']
+        text, used = jobs.decode_output(data, final=done)
+        if used or done or time.monotonic() >= deadline:
+            break
+        # Only part of a character so far, wait for the rest of it
+        job_manager.wait(job_id, offset + len(data), timeout=deadline - time.monotonic())
+    return jsonify({
+        "output": text,
+        "offset": offset + used,
+        "done": done,
+        "status": job['status'],
+        "returncode": job['returncode'],
+        "truncated": job['truncated']
+    }), 200
+
+@app.route('/api/jobs/cancel', methods=['POST'])
+def cancel_job():
+    job_id = (request.get_json(silent=True) or {}).get('id')
+    if not get_own_job(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    if not job_manager.cancel(job_id):
+        return jsonify({"error": "Job is not running"}), 400
+    log("Job cancelled: " + job_id, request.remote_addr)
+    return jsonify({"status": "Job cancelled"}), 200
+
 @app.route('/api/create_folder', methods=['POST'])
 def create_folder():
     global settings
@@ -564,6 +1567,7 @@ def create_folder():
                     if not full_path.startswith(settings['path']):
                         return jsonify({"error": "Unauthorized"}), 401
                     os.mkdir(full_path)
+                    index_update(full_path)
                     return jsonify({"status": "Folder created", "path": path + folder_name})
                 except Exception as e:
                     return jsonify({"error": "Internal server error"}), 500
@@ -577,6 +1581,7 @@ def create_folder():
                     if not full_path.startswith(settings['path']):
                         return jsonify({"error": "Unauthorized"}), 401
                     os.mkdir(full_path)
+                    index_update(full_path)
                     return jsonify({"status": "Folder created", "path": folder_name})
                 except Exception as e:
                     return jsonify({"error": "Internal server error"}), 500
@@ -598,6 +1603,7 @@ def delete_folder():
                     return jsonify({"error": "Unauthorized"}), 401
                 if os.path.exists(full_path):
                     shutil.rmtree(full_path)
+                    index_remove(full_path)
                     return jsonify({"status": "Folder deleted"})
                 else:
                     return jsonify ({"error": "Path does not exist"}), 404
@@ -625,6 +1631,7 @@ def rename_folder():
                         return jsonify({"error": "Unauthorized"}), 401
                     if os.path.exists(full_path):
                         os.rename(full_path, new_full_path)
+                        index_rename(full_path, new_full_path)
                         return jsonify({"status": "Folder renamed", "path": path + new_name})
                     else:
                         return jsonify({"error": "Path does not exist"}), 404
@@ -641,6 +1648,7 @@ def rename_folder():
                         return jsonify({"error": "Unauthorized"}), 401
                     if os.path.exists(full_path):
                         os.rename(full_path, new_full_path)
+                        index_rename(full_path, new_full_path)
                         return jsonify({"status": "Folder renamed", "path": new_name})
                     else:
                         return jsonify({"error": "Path does not exist"}), 404
@@ -652,16 +1660,60 @@ def rename_folder():
     else:
         return jsonify({"error": "No folder name provided"}), 400
     
+resource_sampler = None
+
+def start_resource_sampler(sample=True):
+    global resource_sampler
+    resource_sampler = sampler.ResourceSampler(
+        os.path.join(os.path.dirname(__file__), 'db/metrics.db'),
+        interval=settings.get('resources_interval', 2),
+        persist_every=settings.get('resources_persist_seconds', 60),
+        retention_days=settings.get('resources_history_days', 30)
+    )
+    resource_sampler.initialize()
+    if sample:
+        resource_sampler.start()
+    return resource_sampler
+
 @app.route('/api/resources', methods=['GET'])
 def resource():
     try:
-        cpu = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory().percent
-        disk = psutil.disk_usage('/').percent
-        return jsonify({"cpu": int(cpu), "memory": int(memory), "disk": int(disk)})
+        sample = resource_sampler.latest() if resource_sampler else None
+        if sample is None or time.time() - sample['time'] > resource_sampler.interval * 5:
+            # No fresh sample from the leader, answer without blocking on a CPU interval
+            cpu = psutil.cpu_percent(interval=None)
+            memory = psutil.virtual_memory().percent
+            disk = psutil.disk_usage('/').percent
+            return jsonify({"cpu": int(cpu), "memory": int(memory), "disk": int(disk)})
+        return jsonify({
+            "cpu": int(sample['cpu']),
+            "memory": int(sample['memory']),
+            "disk": int(sample['disk']),
+            "time": sample['time'],
+            "sample": sample
+        })
     except Exception as e:
         return jsonify ({"error": "Internal server error"}), 500
 
+@app.route('/api/resources/history', methods=['GET'])
+def resource_history():
+    if not resource_sampler:
+        return jsonify({"error": "Resource sampling is disabled"}), 503
+    now = time.time()
+    end = request.args.get('end', now, type=float)
+    start = request.args.get('start', end - 3600, type=float)
+    points = request.args.get('points', 200, type=int)
+    metrics = request.args.get('metrics')
+    metrics = tuple(metrics.split(',')) if metrics else sampler.HISTORY_METRICS
+    if start >= end or not points or not 1 <= points <= 2000 or any(m not in sampler.HISTORY_METRICS for m in metrics):
+        return jsonify({"error": "Invalid history parameters"}), 400
+    try:
+        series, step = resource_sampler.history(start, end, points, metrics)
+        return jsonify({"start": start, "end": end, "step": step, "series": series}), 200
+    except Exception as e:
+        log("Resource history error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+
     
 @app.route('/api/new_file', methods=['POST'])
 def new_file():
@@ -679,6 +1731,9 @@ def new_file():
                 return jsonify({"error": "Unauthorized"}), 401
             with open(full_path, 'w') as file:
                 file.write(file_content)
+            if dedup_store:
+                dedup_store.add(full_path)
+            index_update(full_path)
             return jsonify({"status": "File created", "path": path + file_name})
         except Exception as e:
             return jsonify({"error": "Internal server error"}), 500
@@ -697,6 +1752,7 @@ def delete_file():
                     return jsonify({"error": "Unauthorized"}), 401
                 if os.path.exists(full_path):
                     os.remove(full_path)
+                    index_remove(full_path)
                     return jsonify({"status": "File deleted"})
                 else:
                     return jsonify({"error": "Path does not exist"}), 404
@@ -726,6 +1782,7 @@ def rename_file():
             try:
                 if os.path.exists(full_path):
                     os.rename(full_path, new_full_path)
+                    index_rename(full_path, new_full_path)
                     return jsonify({"status": "File renamed", "path": path + new_name})
                 else:
                     return jsonify({"error": "Path does not exist"}), 404
@@ -738,6 +1795,7 @@ def rename_file():
         return jsonify({"error": "No file name provided"}), 400
     
 @app.route('/api/get_file', methods=['GET'])
+@metered('download')
 def get_file():
     global settings
     file = request.args.get('file_path')
@@ -747,12 +1805,15 @@ def get_file():
                 full_path = os.path.normpath(os.path.join(settings['path'], file))
                 if not full_path.startswith(settings['path']):
                     return jsonify({"error": "Unauthorized"}), 401
-                if os.path.exists(full_path):
+                if os.path.isfile(full_path):
                     mime_type, _ = mimetypes.guess_type(full_path)
+                    if streaming.wants_raw(mime_type or 'application/octet-stream'):
+                        return streaming.file_response(full_path, mime_type)
+                    if os.path.getsize(full_path) > settings.get('get_file_json_limit', 64 * 1024 * 1024):
+                        return jsonify({"error": "File too large for JSON transfer, request it with mode=raw"}), 413
                     if mime_type and (mime_type.startswith('video/') or mime_type.startswith('image/') or mime_type.startswith('audio/')):
                         with open(full_path, 'rb') as f:
                             content = f.read()
-                        import base64
                         encoded_content = base64.b64encode(content).decode('utf-8')
                         return jsonify({"status": "File content retrieved", "content": encoded_content, "type": "binary"}), 200
                     else:
@@ -763,7 +1824,6 @@ def get_file():
                         except UnicodeDecodeError:
                             with open(full_path, 'rb') as f:
                                 content = f.read()
-                            import base64
                             encoded_content = base64.b64encode(content).decode('utf-8')
                             return jsonify({"status": "File content retrieved", "content": encoded_content, "type": "binary"}), 200
                 else:
@@ -776,6 +1836,91 @@ def get_file():
     else:
         return jsonify({"error": "No file path provided"}), 400
     
+thumbnail_cache = None
+
+def thumbnail_format():
+    formats = thumbnail_cache.formats()
+    requested = (request.args.get('format') or (request.get_json(silent=True) or {}).get('format') or '').lower()
+    if requested == 'jpg':
+        requested = 'jpeg'
+    if requested:
+        return requested if requested in formats else None
+    if 'webp' in formats and request.accept_mimetypes['image/webp']:
+        return 'webp'
+    return 'jpeg' if 'jpeg' in formats else None
+
+@app.route('/api/thumbnail', methods=['GET'])
+def thumbnail():
+    global settings
+    path = request.args.get('path')
+    if not path:
+        return jsonify({"error": "No path provided"}), 400
+    if not thumbnail_cache:
+        return jsonify({"error": "Thumbnails are disabled"}), 503
+    if not has_access(path):
+        return jsonify({"error": "Unauthorized"}), 401
+    full_path = os.path.normpath(os.path.join(settings['path'], path))
+    if not full_path.startswith(settings['path']):
+        return jsonify({"error": "Unauthorized"}), 401
+    if not os.path.isfile(full_path):
+        return jsonify({"error": "Path does not exist"}), 404
+    if not thumbnail_cache.supports(full_path):
+        return jsonify({"error": "No thumbnail available for this file type"}), 415
+    fmt = thumbnail_format()
+    if not fmt:
+        return jsonify({"error": "Unsupported thumbnail format"}), 406
+    size = thumbnails.snap_size(max(1, request.args.get('size', 256, type=int)))
+    try:
+        key, _, _ = thumbnail_cache.lookup(full_path, size, fmt)
+        cache_control = 'private, max-age=31536000, immutable' if request.args.get('v') else 'private, no-cache'
+        if request.if_none_match.contains(key):
+            # Revalidation never touches the renderer
+            response = Response(status=304)
+        else:
+            key, cache_path = thumbnail_cache.get(full_path, size, fmt)
+            with open(cache_path, 'rb') as file:
+                response = Response(file.read(), mimetype=thumbnails.FORMATS[fmt][1])
+        response.headers['ETag'] = f'"{key}"'
+        response.headers['Cache-Control'] = cache_control
+        response.headers['Vary'] = 'Accept'
+        return response
+    except Exception as e:
+        log("Thumbnail error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Could not render thumbnail"}), 500
+
+@app.route('/api/thumbnail/prefetch', methods=['POST'])
+def prefetch_thumbnails():
+    global settings
+    if not thumbnail_cache:
+        return jsonify({"error": "Thumbnails are disabled"}), 503
+    data = request.get_json(silent=True) or {}
+    path = data.get('path') or ''
+    sizes = data.get('sizes') or [256]
+    if not isinstance(sizes, list) or not all(isinstance(size, int) and size > 0 for size in sizes):
+        return jsonify({"error": "Invalid sizes"}), 400
+    if not has_access(path):
+        return jsonify({"error": "Unauthorized"}), 401
+    folder = os.path.normpath(os.path.join(settings['path'], path)) if path else os.path.normpath(settings['path'])
+    if not folder.startswith(settings['path']):
+        return jsonify({"error": "Unauthorized"}), 401
+    if not os.path.isdir(folder):
+        return jsonify({"error": "Path does not exist"}), 404
+    fmt = thumbnail_format()
+    if not fmt:
+        return jsonify({"error": "Unsupported thumbnail format"}), 406
+    limit = settings.get('thumbnail_prefetch_limit', 5000)
+    try:
+        with os.scandir(folder) as entries:
+            files = [entry.path for entry in entries if entry.is_file() and thumbnail_cache.supports(entry.path)]
+        files.sort()
+        result = thumbnail_cache.prefetch(files[:limit], sorted({thumbnails.snap_size(size) for size in sizes}), fmt)
+    except Exception as e:
+        log("Thumbnail prefetch error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+    result['truncated'] = len(files) > limit
+    result['format'] = fmt
+    return jsonify(result), 200
+
 @app.route('/api/edit_file', methods=['POST'])
 def edit_file():
     global settings
@@ -792,6 +1937,8 @@ def edit_file():
                 with open(full_path, 'w') as file:
                     file.write(file_content)
                     file.close()
+                listing_cache.invalidate(os.path.dirname(full_path))
+                index_update(full_path)
                 return jsonify({"status": "File edited", "path": path})
             except Exception as e:
                 return jsonify({"error": "Internal server error"}), 500
@@ -828,6 +1975,9 @@ def get_settings():
     except Exception as e:
         return jsonify({"error": "Internal server error"}), 500
     
+# Keys the web UI settings page posts; anything else in settings.json is carried over on save
+SETTINGS_PAGE_KEYS = ('ftp', 'ftp_host', 'ftp_port', 'ftp_timeout', 'host', 'path', 'port', 'version')
+
 @app.route('/api/update_settings', methods=['POST'])
 def update_settings():
     new_settings = request.json
@@ -838,12 +1988,16 @@ def update_settings():
             
             if 'com_password' in current_settings:
                 new_settings['com_password'] = current_settings['com_password']
+            for key, value in current_settings.items():
+                if key not in SETTINGS_PAGE_KEYS:
+                    new_settings.setdefault(key, value)
             
             with open(settings_file, 'w') as file:
                 json.dump(new_settings, file)
                 file.close
             log("Settings updated", request.remote_addr)
             reload_jsons()
+            apply_root_change()
             return jsonify({"status": "Settings updated"}), 200
         except Exception as e:
             return jsonify({"error": "Internal server error"}), 500
@@ -878,6 +2032,9 @@ def create_ftp_user():
     password = data.get('password')
     path = data.get('path')
     permissions = data.get('permissions')
+    limits = parse_quota_limits(data)
+    if limits is None:
+        return jsonify({"error": "Limits must be non-negative integers"}), 400
     if username and password and permissions:
         try:
             if path:
@@ -888,8 +2045,9 @@ def create_ftp_user():
                 return jsonify({"error": "Unauthorized"}), 401
             if not os.path.exists(full_path):
                 return jsonify({"error": "Path does not exist"}), 404
+            reload_ftp_users()
             authorizer.add_user(username, password, full_path, permissions)
-            save_ftp_user_to_db(username, password, full_path, permissions)
+            save_ftp_user_to_db(username, password, full_path, permissions, limits)
             log("FTP user created: " + username, request.remote_addr)
             return jsonify({"status": "FTP user created"}), 200
         except Exception as e:
@@ -902,6 +2060,7 @@ def delete_ftp_user():
     username = request.json.get('username')
     if username:
         try:
+            reload_ftp_users()
             authorizer.remove_user(username)
             delete_ftp_user_from_db(username)
             log("FTP user deleted:" + username, request.remote_addr)
@@ -912,6 +2071,8 @@ def delete_ftp_user():
 @app.route('/api/ftp/get_users', methods=['GET'])
 def get_ftp_users():
     try:
+        # Accounts may have been changed through another worker
+        reload_ftp_users()
         user_list = authorizer.get_user_list()
         users = []
         for user in user_list:
@@ -919,7 +2080,10 @@ def get_ftp_users():
                 "username": user[0],
                 "password": user[1], 
                 "path": user[2],
-                "permissions": user[3]
+                "permissions": user[3],
+                "download_limit": user[4],
+                "upload_limit": user[5],
+                "max_transfers": user[6]
             })
         log("FTP users retrived", request.remote_addr)
         return jsonify(users), 200
@@ -933,6 +2097,9 @@ def edit_ftp_user():
     password = request.json.get('password')
     path = request.json.get('path')
     permissions = request.json.get('permissions')
+    limits = parse_quota_limits(request.json)
+    if limits is None:
+        return jsonify({"error": "Limits must be non-negative integers"}), 400
     if username:
         try:
             full_path = os.path.normpath(os.path.join(settings['path'], path)) if path else os.path.normpath(settings['path'])
@@ -947,8 +2114,9 @@ def edit_ftp_user():
                 result = cursor.fetchone()
                 conn.close()
                 password = result[0] if result else None
+            reload_ftp_users()
             authorizer.edit_user(username, password, full_path, permissions)
-            save_ftp_user_to_db(username, password, full_path, permissions)
+            save_ftp_user_to_db(username, password, full_path, permissions, limits)
             log("FTP user edited: " + username, request.remote_addr)
             return jsonify({"status": "FTP user edited"}), 200
         except ValueError as ve:
@@ -961,12 +2129,11 @@ def edit_ftp_user():
 @app.route('/api/ftp/start', methods=['POST'])
 def start_ftp_server_from_api():
     try:
-        start_ftp_server()
+        if not ftp_external:
+            start_ftp_server()
         log("FTP server started from API", request.remote_addr)
-        new_settings = settings.copy()
-        new_settings['ftp'] = True
-        with open(settings_file, 'w') as file:
-                json.dump(new_settings, file)
+        # With several workers the server process picks the flag up and starts FTP
+        set_ftp_enabled(True)
         print_status("FTP server started from API", "success")
         return jsonify({"status": "FTP server started"}), 200
     except Exception as e:
@@ -975,10 +2142,12 @@ def start_ftp_server_from_api():
 @app.route('/api/ftp/stop', methods=['POST'])
 def stop_ftp_server_from_api():
     global ftp_server_instance
-    if ftp_server_instance:
+    if ftp_server_instance or (ftp_external and settings.get('ftp')):
         try:
-            ftp_server_instance.close_all()
-            ftp_server_instance = None
+            if ftp_server_instance:
+                ftp_server_instance.close_all()
+                ftp_server_instance = None
+            set_ftp_enabled(False)
             log("FTP server stopped from API", request.remote_addr)
             print_status("FTP server stopped from API", "success")
             return jsonify({"status": "FTP server stopped"}), 200
@@ -999,15 +2168,19 @@ def create_user():
     paths = data.get('paths', '[""]')
     settings_val = ""
     paths_write = data.get('paths_write', '[""]')
+    limits = parse_quota_limits(data)
+    if limits is None:
+        return jsonify({"error": "Limits must be non-negative integers"}), 400
     if username and password and name and role:
         try:
             api_key = generate_unique_api_key()
             conn = get_users_db_connection()
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO users (username, password, name, ip, role, ftp_users, paths, settings, API_KEY, paths_write)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (username, password, name, ip, role, ftp_user, paths, settings_val, api_key, paths_write))
+                INSERT INTO users (username, password, name, ip, role, ftp_users, paths, settings, API_KEY, paths_write, download_limit, upload_limit, max_transfers)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (username, password, name, ip, role, ftp_user, paths, settings_val, api_key, paths_write,
+                  limits.get('download_limit', 0), limits.get('upload_limit', 0), limits.get('max_transfers', 0)))
             conn.commit()
             conn.close()
             log("User created: " + username, request.remote_addr)
@@ -1026,7 +2199,7 @@ def delete_user():
             cursor = conn.cursor()
             
             cursor.execute('''
-                           SELECT role FROM users WHERE username = ?
+                           SELECT role, id FROM users WHERE username = ?
                            ''', (username,))
             user_result = cursor.fetchone()
             user_role = user_result[0] if user_result else None
@@ -1036,6 +2209,9 @@ def delete_user():
                            ''', (username,))
             conn.commit()
             conn.close()
+            if user_result:
+                invalidate_principal_cache(user_result[1])
+                last_seen.forget(user_result[1])
 
             if user_role and user_role != 'admin':
                 try:
@@ -1072,6 +2248,9 @@ def edit_user():
     paths = request.json.get('paths', '[""]')
     paths_write = request.json.get('paths_write', '[""]')
     id = request.json.get('id')
+    limits = parse_quota_limits(request.json)
+    if limits is None:
+        return jsonify({"error": "Limits must be non-negative integers"}), 400
     if username and name and id:
         try:
             conn = get_users_db_connection()
@@ -1088,9 +2267,12 @@ def edit_user():
                                SET username = ?, name = ?, paths = ?, paths_write = ?
                                WHERE id = ?
                                ''', (username, name, paths, paths_write, id))
+            for field, value in limits.items():
+                cursor.execute(f'UPDATE users SET {field} = ? WHERE id = ?', (value, id))
             log("User edited: " + username, request.remote_addr)
             conn.commit()
             conn.close()
+            invalidate_principal_cache(id)
             return jsonify({"status": "User edited"}), 200
         except Exception as e:
             return jsonify({"error": "Internal server error"}), 500
@@ -1116,9 +2298,11 @@ def login():
                 payload = {
                     'user_id': user[0],
                     'username': user[1],
+                    'sid': secrets.token_urlsafe(8),
                     'exp': datetime.datetime.now(datetime.UTC) + datetime.timedelta(hours=24)
                 }
-                token = jwt.encode(payload, app.config['JWT_SECRET_KEY'], algorithm='HS256')
+                token = key_ring.sign(payload)
+                prune_command_dirs()
                 return jsonify({"token": token}), 200
             else:
                 log("Invalid login attempt: " + username, request.remote_addr)
@@ -1140,7 +2324,10 @@ def get_user():
             "ftp_users": data[6],
             "paths": data[7],
             "settings": data[8],
-            "paths_write": data[10]
+            "paths_write": data[10],
+            "download_limit": data[11],
+            "upload_limit": data[12],
+            "max_transfers": data[13]
         }
         return jsonify(user), 200
     else:
@@ -1167,7 +2354,10 @@ def get_all_users():
                 "paths": user[7],
                 "settings": user[8],
                 "API_KEY": user[9],
-                "paths_write": user[10]
+                "paths_write": user[10],
+                "download_limit": user[11],
+                "upload_limit": user[12],
+                "max_transfers": user[13]
             })
         return jsonify(user_list), 200
     except Exception as e:
@@ -1214,6 +2404,7 @@ def self_edit_user():
             try:
                 cursor.execute(query, tuple(params))
                 conn.commit()
+                invalidate_principal_cache(data[0])
                 log("User self-edited: " + data[1], request.remote_addr)
                 return jsonify({"status": "User updated"}), 200
             except Exception as e:
@@ -1245,6 +2436,7 @@ def edit_roles():
                 file.close()
             log('Roles updated', request.remote_addr)
             reload_jsons()
+            invalidate_principal_cache()
             return jsonify ({"status": "Roles update"}), 200
         except Exception as e:
             return jsonify ({"error": "Internal server error"}), 500
@@ -1267,28 +2459,38 @@ def get_self_role():
     else:
         return jsonify({"error": "Role not found"}), 404
 
+static_pipeline = static_assets.AssetPipeline(
+    os.path.join(os.path.dirname(__file__), 'web'),
+    os.path.join(os.path.dirname(__file__), 'db/static')
+)
+
+def serve_web(filename):
+    # Anything the pipeline does not know about keeps the old behaviour, including the 404
+    return static_pipeline.serve(filename) or send_from_directory(os.path.join(os.path.dirname(__file__), 'web'), filename)
+
 @app.route('/', methods=['GET'])
 def root():
-    return send_from_directory(os.path.join(os.path.dirname(__file__), 'web'), 'index.html')
+    return serve_web('index.html')
 
 @app.route('/auth', methods=['GET'])
 def auth():
-    return send_from_directory(os.path.join(os.path.dirname(__file__), 'web'), 'login.html')
+    return serve_web('login.html')
 
 @app.route('/preview', methods=['GET'])
 def preview():
-    return send_from_directory(os.path.join(os.path.dirname(__file__), 'web'), 'preview.html')
+    return serve_web('preview.html')
 
 
 @app.route('/web/<path:filename>', methods=['GET'])
 def serve_static(filename):
-    return send_from_directory(os.path.join(os.path.dirname(__file__), 'web'), filename)
+    return serve_web(filename)
 
 @app.route('/web/assets/<path:filename>', methods=['GET'])
 def serve_assets(filename):
-    return send_from_directory(os.path.join(os.path.dirname(__file__), 'web', 'assets'), filename, mimetype=mimetypes.guess_type(filename)[0])
+    return serve_web('assets/' + filename)
 
 @app.route('/api/upload', methods=['POST'])
+@metered('upload')
 def upload_file():
     global settings
     file = request.files.get('file')
@@ -1308,13 +2510,184 @@ def upload_file():
     if not dest_path.startswith(settings['path']):
         return jsonify({"error": "Unauthorized"}), 401
     try:
-        file.save(dest_path)
+        if dedup_store:
+            with open(dest_path, 'wb') as out:
+                digest = dedup_store.copy_stream(file.stream, out)
+            dedup_store.add(dest_path, digest)
+        else:
+            file.save(dest_path)
+        index_update(dest_path)
         log(f"File uploaded", request.remote_addr)
         return jsonify({"status": "File uploaded"}), 200
     except Exception as e:
         return jsonify({"error": "Internal server error"}), 500
     
+upload_store = None
+
+def get_own_upload(upload_id):
+    upload = upload_store.get(upload_id or '')
+    if upload['owner'] != g.user_id or not has_write_access(upload['path']):
+        raise uploads.UploadError("Upload not found", 404)
+    return upload
+
+@app.route('/api/upload/create', methods=['POST'])
+def create_upload():
+    global settings
+    data = request.get_json(silent=True) or {}
+    path = data.get('path') or ''
+    filename = secure_filename(data.get('filename') or '')
+    length = data.get('length')
+    if not filename or not isinstance(length, int) or length < 0:
+        return jsonify({"error": "No filename or length provided"}), 400
+    if not has_write_access(path):
+        return jsonify({"error": "Unauthorized"}), 401
+    dest_dir = os.path.normpath(os.path.join(settings['path'], path)) if path else os.path.normpath(settings['path'])
+    if not dest_dir.startswith(settings['path']):
+        return jsonify({"error": "Unauthorized"}), 401
+    dest_path = os.path.normpath(os.path.join(dest_dir, filename))
+    if not dest_path.startswith(settings['path']):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+        checksum = uploads.parse_checksum(data.get('checksum'))
+        upload = upload_store.create(g.user_id, path, dest_path, length, checksum)
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        log("Upload create error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+    return jsonify(upload), 200
+
+@app.route('/api/upload/chunk', methods=['PATCH', 'POST'])
+@metered('upload')
+def upload_chunk():
+    offset = request.headers.get('Upload-Offset', type=int)
+    length = request.content_length
+    if offset is None or length is None:
+        return jsonify({"error": "Upload-Offset and Content-Length are required"}), 400
+    try:
+        get_own_upload(request.args.get('id'))
+        checksum = uploads.parse_checksum(request.headers.get('Upload-Checksum'))
+        # Read the raw body so Werkzeug does not spool it to a temp file first
+        status = upload_store.write_chunk(request.args['id'], offset, length, request.stream, checksum)
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        log("Upload chunk error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+    response = jsonify(status)
+    response.headers['Upload-Offset'] = str(status['offset'])
+    return response, 200
+
+@app.route('/api/upload/status', methods=['GET'])
+def upload_status():
+    try:
+        status = upload_store.describe(get_own_upload(request.args.get('id')))
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    response = jsonify(status)
+    response.headers['Upload-Offset'] = str(status['offset'])
+    response.headers['Upload-Length'] = str(status['length'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response, 200
+
+@app.route('/api/upload/finish', methods=['POST'])
+def finish_upload():
+    upload_id = (request.get_json(silent=True) or {}).get('id')
+    try:
+        get_own_upload(upload_id)
+        upload = upload_store.finish(upload_id)
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        log("Upload finish error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+    if dedup_store:
+        try:
+            dedup_store.add(upload['dest'])
+        except Exception as e:
+            log("Dedup error: " + str(e), request.remote_addr)
+    index_update(upload['dest'])
+    listing_cache.invalidate(os.path.dirname(upload['dest']))
+    log(f"File uploaded", request.remote_addr)
+    return jsonify({"status": "File uploaded", "path": os.path.relpath(upload['dest'], settings['path'])}), 200
+
+@app.route('/api/upload/abort', methods=['POST'])
+def abort_upload():
+    upload_id = (request.get_json(silent=True) or {}).get('id')
+    try:
+        get_own_upload(upload_id)
+        upload_store.abort(upload_id)
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify({"status": "Upload aborted"}), 200
+
+dedup_store = None
+
+def dedup_readable(full_path):
+    if not full_path.startswith(settings['path']):
+        return False
+    return has_access(os.path.relpath(full_path, settings['path']))
+
+@app.route('/api/dedup/check', methods=['POST'])
+def dedup_check():
+    if not dedup_store:
+        return jsonify({"error": "Deduplication is disabled"}), 400
+    data = request.get_json(silent=True) or {}
+    hashes = data.get('hashes')
+    algorithm = data.get('algorithm', dedup_store.algorithm)
+    if not isinstance(hashes, list) or len(hashes) > 1000 or not all(isinstance(digest, str) for digest in hashes):
+        return jsonify({"error": "Provide up to 1000 hashes"}), 400
+    if algorithm != dedup_store.algorithm:
+        return jsonify({"error": f"Hashes must use {dedup_store.algorithm}", "algorithm": dedup_store.algorithm}), 400
+    # Only files this user can read count, so the check reveals nothing about anyone else's files
+    known = dedup_store.known([digest.lower() for digest in hashes], dedup_readable)
+    return jsonify({"algorithm": dedup_store.algorithm, "known": known}), 200
+
+@app.route('/api/dedup/link', methods=['POST'])
+def dedup_link():
+    global settings
+    if not dedup_store:
+        return jsonify({"error": "Deduplication is disabled"}), 400
+    data = request.get_json(silent=True) or {}
+    path = data.get('path') or ''
+    filename = secure_filename(data.get('filename') or '')
+    digest = (data.get('hash') or '').lower()
+    if not filename or not digest:
+        return jsonify({"error": "No filename or hash provided"}), 400
+    if not has_write_access(path):
+        return jsonify({"error": "Unauthorized"}), 401
+    dest_dir = os.path.normpath(os.path.join(settings['path'], path)) if path else os.path.normpath(settings['path'])
+    dest_path = os.path.normpath(os.path.join(dest_dir, filename))
+    if not dest_dir.startswith(settings['path']) or not dest_path.startswith(settings['path']):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+        linked = dedup_store.link(digest, dest_path, dedup_readable)
+    except Exception as e:
+        log("Dedup link error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+    if not linked:
+        return jsonify({"error": "Content not found, upload the file instead"}), 404
+    index_update(dest_path)
+    listing_cache.invalidate(dest_dir)
+    log(f"File uploaded from existing content", request.remote_addr)
+    return jsonify({"status": "File uploaded", "method": linked[0], "size": linked[1], "path": os.path.relpath(dest_path, settings['path'])}), 200
+
+@app.route('/api/dedup/reclaim', methods=['POST'])
+def dedup_reclaim():
+    if not dedup_store:
+        return jsonify({"error": "Deduplication is disabled"}), 400
+    try:
+        report = dedup_store.reclaim()
+    except Exception as e:
+        log("Dedup reclaim error: " + str(e), request.remote_addr)
+        return jsonify({"error": "Internal server error"}), 500
+    log(f"Dedup reclaim freed {report['reclaimed_bytes']} bytes", request.remote_addr)
+    return jsonify(report), 200
+
 @app.route('/api/download', methods=['GET'])
+@metered('download')
 def download_file():
     global settings
     file_path = request.args.get('file_path')
@@ -1327,34 +2700,23 @@ def download_file():
         return jsonify({"error": "Unauthorized"}), 401
     if os.path.exists(full_path):
         if os.path.isfile(full_path):
-            directory = os.path.dirname(full_path)
-            filename = os.path.basename(full_path)
-            return send_from_directory(directory, filename, as_attachment=True)
-        elif os.path.isdir(full_path):  
-            temp_dir = tempfile.mkdtemp()
-            zip_filename = f"{os.path.basename(file_path)}.zip"
-            zip_path = os.path.join(temp_dir, zip_filename)
-            
-            try:
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for root, dirs, files in os.walk(full_path):
-                        for file in files:
-                            file_full_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_full_path, full_path)
-                            zipf.write(file_full_path, arcname)                
-                def cleanup_temp_file():
-                    try:
-                        shutil.rmtree(temp_dir)
-                    except:
-                        pass
-                
-                response = send_from_directory(temp_dir, zip_filename, as_attachment=True)
-                response.call_on_close(cleanup_temp_file)
-                return response
-                
-            except Exception as e:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-                return jsonify({"error": "Internal server error"}), 500
+            return streaming.file_response(full_path, as_attachment=True)
+        elif os.path.isdir(full_path):
+            level = request.args.get('level', settings.get('zip_level', 6), type=int)
+            if level is None or not 0 <= level <= 9:
+                return jsonify({"error": "Invalid compression level"}), 400
+            archive_format = request.args.get('format', 'zip').lower()
+            if archive_format == 'tgz':
+                archive_format = 'tar.gz'
+            if archive_format not in archive.FORMATS:
+                return jsonify({"error": "Unsupported archive format"}), 400
+            if archive_format == 'tar.zst' and archive.zstandard is None:
+                return jsonify({"error": "zstd archives are not available on this server"}), 400
+            workers = settings.get('archive_workers') or os.cpu_count() or 1
+            body, mime_type, extension = archive.stream_directory(full_path, archive_format, level, workers)
+            response = Response(body, mimetype=mime_type, direct_passthrough=True)
+            streaming.set_content_disposition(response, os.path.basename(full_path) + extension, True)
+            return response
     
     return jsonify({"error": "File or folder does not exist"}), 404
 
@@ -1385,6 +2747,7 @@ def manage_cloud():
             
             with open(cloud_path, 'w') as f:
                 json.dump(cloud_settings, f, indent=2)
+            refresh_cloud_state()
             
             log(f"Cloud {'enabled' if enabled else 'disabled'}", request.remote_addr)
             return jsonify({"status": f"Cloud {'enabled' if enabled else 'disabled'}"}), 200
@@ -1403,6 +2766,7 @@ def manage_cloud():
                 
                 with open(cloud_path, 'w') as f:
                     json.dump(cloud_settings, f, indent=2)
+                refresh_cloud_state()
                 
                 log("Cloud authentication data deleted", request.remote_addr)
                 return jsonify({"status": "Authentication data deleted"}), 200
@@ -1452,14 +2816,57 @@ def manage_cloud():
     else:
         return jsonify({"error": "Invalid action"}), 400
 
-def create_app():
+def create_app(start_ftp=True):
+    global ftp_external, upload_store, dedup_store, thumbnail_cache
     if settings:
         print_status("Settings loaded successfully.", "success")
         initialize_logs_db()
         initialize_users_db()
+        start_log_writer()
+        start_job_manager()
+        upload_store = uploads.UploadStore(
+            os.path.join(os.path.dirname(__file__), 'db/uploads'),
+            max_age=settings.get('upload_expiry_hours', 24) * 3600
+        )
+        if settings.get('dedup', False):
+            try:
+                dedup_store = dedup.DedupStore(
+                    os.path.join(os.path.dirname(__file__), 'db/dedup.db'),
+                    algorithm=settings.get('dedup_hash', 'blake2b'),
+                    link_mode=settings.get('dedup_link', 'reflink')
+                )
+            except ValueError as e:
+                print_status(f"Deduplication disabled: {e}", "error")
+        if settings.get('thumbnails', True):
+            thumbnail_cache = thumbnails.ThumbnailCache(
+                os.path.join(os.path.dirname(__file__), 'db/thumbnails'),
+                budget=settings.get('thumbnail_cache_mb', 512) * 1024 * 1024,
+                workers=settings.get('thumbnail_workers', min(2, os.cpu_count() or 1)),
+                quality=settings.get('thumbnail_quality', 80)
+            )
+        try:
+            static_pipeline.build()
+        except Exception as e:
+            print_status(f"Error building web assets: {e}", "error")
+        response_compressor.min_size = settings.get('compress_min_bytes', 1024)
+        response_compressor.gzip_level = settings.get('compress_gzip_level', 6)
+        response_compressor.zstd_level = settings.get('compress_zstd_level', 3)
+        response_compressor.loopback = settings.get('compress_loopback', False)
+        listing_cache.max_dirs = settings.get('listing_cache_dirs', 256)
+        listing_cache.max_age = settings.get('listing_cache_ttl', 30)
+        refresh_cloud_state()
+        if settings.get('search_index', True):
+            start_search_index(crawl=False)
+        if settings.get('resources_sampler', True):
+            start_resource_sampler(sample=False)
+        threading.Thread(target=run_leader_services, name="leader-election", daemon=True).start()
+        last_seen.interval = max(0.1, float(settings.get('ip_flush_seconds', 5)))
+        last_seen.start()
         load_ftp_users_from_db()
+        # The multi-worker server runs FTP in a process of its own
+        ftp_external = not start_ftp
         try:
-            if settings['ftp']:
+            if settings['ftp'] and start_ftp:
                 start_ftp_server()
         except Exception as e:
             print_status(f"Error starting FTP: {e}", "error")
@@ -0,0 +1,64 @@
+import threading
+
+class PathTrie:
+    """Character trie over path grants answering `any(path.startswith(p) for p in grants)`.
+
+    A lookup walks the path once, so its cost depends on the path length
+    and not on how many grants the user has.
+    """
+
+    __slots__ = ('root', 'prefixes', 'everything')
+
+    def __init__(self, prefixes=()):
+        self.prefixes = tuple(p for p in prefixes if isinstance(p, str))
+        self.everything = '' in self.prefixes
+        self.root = {}
+        for prefix in self.prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            # None marks the end of a grant
+            node[None] = True
+
+    def matches(self, path):
+        if self.everything:
+            return True
+        node = self.root
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.prefixes)
+
+EMPTY = PathTrie()
+
+def compile_roles(roles):
+    """Turn roles.json's {endpoint: [role, ...]} into {endpoint: frozenset(roles)}."""
+    return {endpoint: frozenset(allowed) for endpoint, allowed in roles.items() if isinstance(allowed, list)}
+
+class RoleMatrix:
+    """Compiled copy of the roles mapping, rebuilt whenever a new mapping is loaded."""
+
+    def __init__(self):
+        self.source = None
+        self.compiled = {}
+        self.lock = threading.Lock()
+        self.compiles = 0
+
+    def get(self, roles):
+        # roles is swapped for a fresh dict on every reload, so identity tells us when to rebuild
+        if roles is not self.source:
+            with self.lock:
+                if roles is not self.source:
+                    self.compiled = compile_roles(roles)
+                    self.source = roles
+                    self.compiles += 1
+        return self.compiled
+
+    def allows(self, roles, endpoint, role):
+        return role in self.get(roles).get(endpoint, ())
@@ -0,0 +1,378 @@
+import os
+import time
+import sqlite3
+import threading
+
+DIRECTIONS = ('download', 'upload')
+CHUNK_SIZE = 256 * 1024
+# Seconds of unused allowance an account can save up
+BURST = 1.0
+# How often each process settles its local buckets with the database
+SETTLE_INTERVAL = 0.1
+
+class QuotaExceeded(Exception):
+    pass
+
+def pid_alive(pid):
+    if os.name == 'nt':
+        # Single process there, and os.kill would terminate the target
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def refill(tokens, stamp, rate, now):
+    return min(rate * BURST, tokens + max(0.0, now - stamp) * rate)
+
+class LocalBucket:
+    """This process's copy of one shared bucket, settled with the database in the background."""
+
+    def __init__(self, rate, tokens, stamp):
+        self.rate = rate
+        self.tokens = tokens
+        self.stamp = stamp
+        self.unsettled = 0
+        self.active = 0
+
+class Transfer:
+    """One running download or upload, holding a concurrency slot until released."""
+
+    def __init__(self, manager, slot, key, direction, rate):
+        self.manager = manager
+        self.slot = slot
+        self.key = key
+        self.direction = direction
+        self.rate = rate
+        self.bytes = 0
+        self.counted = 0
+        self.released = False
+
+    @property
+    def limited(self):
+        return bool(self.rate)
+
+    def charge(self, size):
+        """Account for `size` bytes and return how long to pause; for callers that cannot block."""
+        self.bytes += size
+        if not self.rate:
+            # Uncapped bytes are only added to the totals on release
+            return 0.0
+        self.counted += size
+        return self.manager.charge(self.key, self.direction, size)
+
+    def consume(self, size):
+        delay = self.charge(size)
+        if delay > 0:
+            time.sleep(delay)
+
+    def iterate(self, iterable, chunk_size=CHUNK_SIZE):
+        """Re-yield a response body at the account's rate, releasing the slot when it ends."""
+        try:
+            for chunk in iterable:
+                for start in range(0, len(chunk), chunk_size):
+                    piece = chunk[start:start + chunk_size]
+                    self.consume(len(piece))
+                    yield piece
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+            self.release()
+
+    def reader(self, stream):
+        return ThrottledReader(stream, self)
+
+    def release(self, total=None):
+        """Free the slot; `total` records bytes that bypassed charge(), e.g. via sendfile."""
+        with self.manager.state_lock:
+            if self.released:
+                return
+            self.released = True
+        if total is not None and total > self.bytes:
+            self.bytes = total
+        self.manager.release(self.slot, self.key, self.direction, self.bytes - self.counted)
+
+class ThrottledReader:
+    """File-like wrapper that paces reads from a request body."""
+
+    def __init__(self, stream, transfer):
+        self.stream = stream
+        self.transfer = transfer
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.transfer.consume(len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        if data:
+            self.transfer.consume(len(data))
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        close = getattr(self.stream, 'close', None)
+        if close is not None:
+            close()
+
+class QuotaManager:
+    """Per-account bandwidth buckets and concurrent transfer counters.
+
+    Accounts are keyed by strings like 'user:3' or 'ftp:alice'. Limits are
+    passed on every acquire so edits to the users tables apply to the next
+    transfer without a reload step. Slots and buckets are rows in a SQLite
+    database, so every gunicorn worker and the FTP process that opens the
+    same file enforces one cap together; the default in-memory database
+    only covers this process.
+
+    Buckets hold tokens for bytes per second. Transfers take tokens for what
+    they just moved and may run the bucket into debt; the delay returned by
+    charge() is how long the caller must pause until the debt is paid, so
+    N parallel streams together still average the account's rate. charge()
+    and release() only touch memory, which keeps them safe on the FTP
+    ioloop: a background thread settles the bytes with the database every
+    SETTLE_INTERVAL and brings back what the other processes used.
+    """
+
+    def __init__(self, db_path=':memory:'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.settle_lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        self.buckets = {}
+        self.releases = []
+        self.settler = None
+
+    def connect(self):
+        # One connection per process; a worker forked from a parent opens its own
+        if self.conn is not None and self.pid == os.getpid():
+            return self.conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        # Only live counters are kept here, nothing worth an fsync
+        conn.execute('PRAGMA synchronous=OFF;')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS slots (
+                id INTEGER PRIMARY KEY,
+                key TEXT NOT NULL,
+                direction TEXT NOT NULL,
+                pid INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS slots_key ON slots (key);
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT NOT NULL,
+                direction TEXT NOT NULL,
+                rate INTEGER NOT NULL DEFAULT 0,
+                tokens REAL NOT NULL DEFAULT 0,
+                stamp REAL NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (key, direction)
+            );
+            CREATE TABLE IF NOT EXISTS accounts (
+                key TEXT PRIMARY KEY,
+                max_transfers INTEGER NOT NULL DEFAULT 0,
+                started INTEGER NOT NULL DEFAULT 0,
+                rejected INTEGER NOT NULL DEFAULT 0
+            );
+        ''')
+        # Slots left by an earlier process that had our pid
+        conn.execute('DELETE FROM slots WHERE pid = ?', (os.getpid(),))
+        self.conn = conn
+        self.pid = os.getpid()
+        with self.state_lock:
+            # Anything inherited across a fork belongs to the parent
+            self.buckets = {}
+            self.releases = []
+        return conn
+
+    def execute(self, statements):
+        """Run statements(conn) as one write transaction across every process using the database."""
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(conn)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return result
+
+    def start_settler(self):
+        with self.state_lock:
+            if self.settler is not None and self.settler.is_alive():
+                return
+            self.settler = threading.Thread(target=self._run_settler, name="quota-settler", daemon=True)
+            self.settler.start()
+
+    def _run_settler(self):
+        while True:
+            time.sleep(SETTLE_INTERVAL)
+            try:
+                self.settle()
+            except Exception as e:
+                print(f"Quota settle failed: {e}")
+
+    def apply_releases(self, conn, releases):
+        for slot, key, direction, uncounted in releases:
+            conn.execute('DELETE FROM slots WHERE id = ?', (slot,))
+            if uncounted:
+                conn.execute('UPDATE buckets SET bytes = bytes + ? WHERE key = ? AND direction = ?', (uncounted, key, direction))
+
+    def take_releases(self):
+        with self.state_lock:
+            releases, self.releases = self.releases, []
+        return releases
+
+    def restore_releases(self, releases):
+        with self.state_lock:
+            self.releases[:0] = releases
+
+    def acquire(self, key, direction, download_limit=0, upload_limit=0, max_transfers=0):
+        if direction not in DIRECTIONS:
+            raise ValueError(f"Unknown transfer direction: {direction}")
+        limits = {'download': download_limit or 0, 'upload': upload_limit or 0}
+        max_transfers = max_transfers or 0
+        releases = self.take_releases()
+
+        def statements(conn):
+            # Slots this process freed since the last settle must not count against the caller
+            self.apply_releases(conn, releases)
+            conn.execute('INSERT OR IGNORE INTO accounts (key) VALUES (?)', (key,))
+            conn.execute('UPDATE accounts SET max_transfers = ? WHERE key = ?', (max_transfers, key))
+            for name, rate in limits.items():
+                conn.execute('INSERT OR IGNORE INTO buckets (key, direction, rate, tokens, stamp) VALUES (?, ?, ?, ?, ?)',
+                             (key, name, rate, rate * BURST, time.time()))
+                conn.execute('UPDATE buckets SET rate = ?, tokens = MIN(tokens, ?) WHERE key = ? AND direction = ? AND rate != ?',
+                             (rate, rate * BURST, key, name, rate))
+            if max_transfers:
+                slots = conn.execute('SELECT id, pid FROM slots WHERE key = ?', (key,)).fetchall()
+                dead = [(slot_id,) for slot_id, pid in slots if not pid_alive(pid)]
+                if dead:
+                    # A worker that was killed mid-transfer never released its slots
+                    conn.executemany('DELETE FROM slots WHERE id = ?', dead)
+                if len(slots) - len(dead) >= max_transfers:
+                    conn.execute('UPDATE accounts SET rejected = rejected + 1 WHERE key = ?', (key,))
+                    return None, None
+            conn.execute('UPDATE accounts SET started = started + 1 WHERE key = ?', (key,))
+            slot = conn.execute('INSERT INTO slots (key, direction, pid) VALUES (?, ?, ?)', (key, direction, os.getpid())).lastrowid
+            return slot, conn.execute('SELECT tokens, stamp FROM buckets WHERE key = ? AND direction = ?', (key, direction)).fetchone()
+
+        try:
+            slot, row = self.execute(statements)
+        except BaseException:
+            self.restore_releases(releases)
+            raise
+        if slot is None:
+            raise QuotaExceeded(f"Too many concurrent transfers (limit {max_transfers})")
+        rate = limits[direction]
+        with self.state_lock:
+            bucket = self.buckets.get((key, direction))
+            if bucket is None or bucket.rate != rate:
+                previous = bucket
+                bucket = self.buckets[(key, direction)] = LocalBucket(rate, row[0], row[1])
+                if previous is not None:
+                    bucket.active, bucket.unsettled = previous.active, previous.unsettled
+            bucket.active += 1
+        self.start_settler()
+        return Transfer(self, slot, key, direction, rate)
+
+    def charge(self, key, direction, size):
+        """Take `size` tokens from this process's bucket and return the seconds to pause (0 when within budget)."""
+        with self.state_lock:
+            bucket = self.buckets[(key, direction)]
+            now = time.time()
+            bucket.tokens = refill(bucket.tokens, bucket.stamp, bucket.rate, now) - size
+            bucket.stamp = now
+            bucket.unsettled += size
+            return -bucket.tokens / bucket.rate if bucket.rate and bucket.tokens < 0 else 0.0
+
+    def release(self, slot, key, direction, uncounted=0):
+        with self.state_lock:
+            bucket = self.buckets.get((key, direction))
+            if bucket is not None:
+                bucket.active -= 1
+            self.releases.append((slot, key, direction, uncounted))
+
+    def settle(self):
+        """Write local usage and freed slots to the database and take back the shared bucket levels."""
+        # Two settles at once would both write the same unsettled bytes
+        with self.settle_lock:
+            self._settle()
+
+    def _settle(self):
+        releases = self.take_releases()
+        with self.state_lock:
+            pending = {
+                name: bucket.unsettled for name, bucket in self.buckets.items()
+                if bucket.rate and (bucket.active or bucket.unsettled)
+            }
+        if not releases and not pending:
+            return
+
+        def statements(conn):
+            self.apply_releases(conn, releases)
+            levels = {}
+            now = time.time()
+            for (key, direction), used in pending.items():
+                row = conn.execute('SELECT rate, tokens, stamp FROM buckets WHERE key = ? AND direction = ?', (key, direction)).fetchone()
+                if row is None:
+                    continue
+                rate, tokens, stamp = row
+                tokens = refill(tokens, stamp, rate, now) - used
+                conn.execute('UPDATE buckets SET tokens = ?, stamp = ?, bytes = bytes + ? WHERE key = ? AND direction = ?',
+                             (tokens, now, used, key, direction))
+                levels[(key, direction)] = (tokens, now)
+            return levels
+
+        try:
+            levels = self.execute(statements)
+        except BaseException:
+            self.restore_releases(releases)
+            raise
+        with self.state_lock:
+            for name, (tokens, stamp) in levels.items():
+                bucket = self.buckets.get(name)
+                if bucket is None:
+                    continue
+                bucket.unsettled -= pending[name]
+                # Bytes charged here while the transaction ran are still owed
+                bucket.tokens = tokens - bucket.unsettled
+                bucket.stamp = stamp
+
+    def get_stats(self):
+        self.settle()
+
+        def statements(conn):
+            active = {}
+            for key, pid in conn.execute('SELECT key, pid FROM slots').fetchall():
+                if pid_alive(pid):
+                    active[key] = active.get(key, 0) + 1
+            accounts = {
+                key: {"active": active.get(key, 0), "max_transfers": max_transfers, "started": started, "rejected": rejected}
+                for key, max_transfers, started, rejected in conn.execute('SELECT key, max_transfers, started, rejected FROM accounts')
+            }
+            for key, direction, rate, total in conn.execute('SELECT key, direction, rate, bytes FROM buckets'):
+                if key in accounts:
+                    accounts[key][f"{direction}_limit"] = rate
+                    accounts[key][f"{direction}_bytes"] = total
+            return accounts
+
+        accounts = self.execute(statements)
+        return {
+            "active": sum(account['active'] for account in accounts.values()),
+            "rejected": sum(account['rejected'] for account in accounts.values()),
+            "accounts": accounts
+        }
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import psutil
+
+HISTORY_METRICS = ('cpu', 'memory', 'disk', 'net_sent', 'net_recv', 'disk_read', 'disk_write', 'process_cpu', 'process_rss')
+
+class ResourceSampler:
+    """Samples system and process stats on a fixed cadence in the background.
+
+    Only the leader process samples. Every sample goes to a samples table
+    kept for buffer_seconds, which serves /api/resources in any worker, and
+    averages over persist_every seconds go to the metrics table for the
+    history charts.
+    """
+
+    def __init__(self, db_path, interval=2, buffer_seconds=3600, persist_every=60,
+                 retention_days=30, disk_path='/', top_processes=5, process_every=5):
+        self.db_path = db_path
+        self.interval = max(0.5, float(interval))
+        self.buffer_seconds = buffer_seconds
+        self.persist_every = persist_every
+        self.retention_days = retention_days
+        self.disk_path = disk_path
+        self.top_processes = top_processes
+        self.process_every = max(1, int(process_every))
+        self.pending = []
+        self.processes = []
+        self.counters = None
+        self.own_process = psutil.Process(os.getpid())
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {"samples": 0, "persisted": 0, "errors": 0, "last_sample_ms": None}
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        return conn
+
+    def initialize(self):
+        conn = self.connect()
+        try:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS metrics (
+                    time REAL PRIMARY KEY,
+                    {', '.join(f'{name} REAL' for name in HISTORY_METRICS)}
+                )
+            ''')
+            conn.execute('CREATE TABLE IF NOT EXISTS samples (time REAL PRIMARY KEY, data TEXT)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        # The first non-blocking cpu_percent call only sets the baseline
+        psutil.cpu_percent(interval=None)
+        self.own_process.cpu_percent(interval=None)
+        self.counters = self.read_counters()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(5)
+            self.thread = None
+        self.flush()
+
+    def read_counters(self):
+        net = psutil.net_io_counters()
+        try:
+            disk_io = psutil.disk_io_counters()
+        except (RuntimeError, OSError):
+            disk_io = None
+        return (
+            time.monotonic(),
+            net.bytes_sent if net else 0,
+            net.bytes_recv if net else 0,
+            disk_io.read_bytes if disk_io else 0,
+            disk_io.write_bytes if disk_io else 0
+        )
+
+    def read_processes(self):
+        processes = []
+        for process in psutil.process_iter(['pid', 'name', 'memory_info']):
+            try:
+                cpu = process.cpu_percent(interval=None)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            memory_info = process.info.get('memory_info')
+            processes.append({
+                "pid": process.info['pid'],
+                "name": process.info.get('name'),
+                "cpu": cpu,
+                "rss": memory_info.rss if memory_info else 0
+            })
+        processes.sort(key=lambda item: item['cpu'], reverse=True)
+        return processes[:self.top_processes]
+
+    def collect(self):
+        started = time.perf_counter()
+        counters = self.read_counters()
+        previous = self.counters or counters
+        self.counters = counters
+        elapsed = max(counters[0] - previous[0], 1e-6)
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self.disk_path)
+        with self.own_process.oneshot():
+            process_cpu = self.own_process.cpu_percent(interval=None)
+            process_rss = self.own_process.memory_info().rss
+            process_threads = self.own_process.num_threads()
+        if self.top_processes and self.stats['samples'] % self.process_every == 0:
+            self.processes = self.read_processes()
+        sample = {
+            "time": time.time(),
+            "cpu": psutil.cpu_percent(interval=None),
+            "memory": memory.percent,
+            "memory_used": memory.used,
+            "memory_total": memory.total,
+            "disk": disk.percent,
+            "disk_used": disk.used,
+            "disk_total": disk.total,
+            "net_sent": (counters[1] - previous[1]) / elapsed,
+            "net_recv": (counters[2] - previous[2]) / elapsed,
+            "disk_read": (counters[3] - previous[3]) / elapsed,
+            "disk_write": (counters[4] - previous[4]) / elapsed,
+            "process_cpu": process_cpu,
+            "process_rss": process_rss,
+            "process_threads": process_threads,
+            "processes": self.processes
+        }
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO samples (time, data) VALUES (?, ?)', (sample['time'], json.dumps(sample)))
+                conn.execute('DELETE FROM samples WHERE time < ?', (sample['time'] - self.buffer_seconds,))
+        finally:
+            conn.close()
+        with self.lock:
+            self.pending.append(sample)
+            self.stats['samples'] += 1
+            self.stats['last_sample_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return sample
+
+    def latest(self):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT data FROM samples ORDER BY time DESC LIMIT 1').fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    def flush(self):
+        """Write the average of the pending samples as one history row."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+        row = [pending[-1]['time']]
+        row.extend(sum(sample[name] for sample in pending) / len(pending) for name in HISTORY_METRICS)
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    f'INSERT OR REPLACE INTO metrics (time, {", ".join(HISTORY_METRICS)}) VALUES ({", ".join("?" * (len(HISTORY_METRICS) + 1))})',
+                    row
+                )
+                conn.execute('DELETE FROM metrics WHERE time < ?', (time.time() - self.retention_days * 86400,))
+        finally:
+            conn.close()
+        self.stats['persisted'] += 1
+        return 1
+
+    def _run(self):
+        next_persist = time.monotonic() + self.persist_every
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.collect()
+                if time.monotonic() >= next_persist:
+                    next_persist = time.monotonic() + self.persist_every
+                    self.flush()
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"Resource sampling failed: {e}")
+
+    def history(self, start, end, points=200, metrics=HISTORY_METRICS):
+        """Return `points` evenly spaced averages per metric between start and end."""
+        step = max((end - start) / points, 1e-3)
+        conn = self.connect()
+        try:
+            oldest_buffered = conn.execute('SELECT MIN(time) FROM samples WHERE time >= ?', (start,)).fetchone()[0]
+            if oldest_buffered is not None and oldest_buffered - start <= max(step, self.interval * 2):
+                # The samples table covers the range at full resolution
+                buckets = {}
+                for (data,) in conn.execute('SELECT data FROM samples WHERE time >= ? AND time <= ?', (start, end)):
+                    sample = json.loads(data)
+                    buckets.setdefault(int((sample['time'] - start) / step), []).append(sample)
+                rows = [
+                    [start + bucket * step] + [sum(s[name] for s in samples) / len(samples) for name in metrics]
+                    for bucket, samples in sorted(buckets.items())
+                ]
+            else:
+                rows = conn.execute(f'''
+                    SELECT MIN(time), {', '.join(f'AVG({name})' for name in metrics)}
+                    FROM metrics
+                    WHERE time >= ? AND time <= ?
+                    GROUP BY CAST((time - ?) / ? AS INTEGER)
+                    ORDER BY 1
+                ''', (start, end, start, step)).fetchall()
+        finally:
+            conn.close()
+        series = {"time": [round(row[0], 3) for row in rows]}
+        for index, name in enumerate(metrics, start=1):
+            series[name] = [round(row[index], 2) if row[index] is not None else None for row in rows]
+        return series, step
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['sampling'] = bool(self.thread and self.thread.is_alive())
+        return stats
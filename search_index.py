@@ -0,0 +1,284 @@
+import os
+import time
+import sqlite3
+import mimetypes
+import threading
+
+BATCH_SIZE = 2000
+PATH_MAX_CHAR = '\U0010ffff'
+
+def path_range(prefix):
+    return prefix, prefix + PATH_MAX_CHAR
+
+def fts_query(query):
+    terms = [term for term in query.split() if term]
+    return ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+class SearchIndex:
+    """SQLite FTS5 index of every path under the shared root.
+
+    Paths are stored relative to the root, the same form the API takes,
+    so has_access prefixes can be applied as index range scans.
+    """
+
+    def __init__(self, db_path, root, recrawl_interval=24 * 3600):
+        self.db_path = db_path
+        self.root = os.path.normpath(root) if root else ''
+        self.recrawl_interval = recrawl_interval
+        self.lock = threading.Lock()
+        self.crawl_requested = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_scan = 0
+        self.tokenizer = 'trigram'
+        self.stats = {"crawls": 0, "last_crawl_seconds": None, "last_crawl_files": 0, "updates": 0, "crawling": False}
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        return conn
+
+    def initialize(self):
+        conn = self.connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL UNIQUE,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    mime TEXT,
+                    is_dir INTEGER NOT NULL,
+                    scan INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            try:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(name, content='files', content_rowid='id', tokenize='trigram')")
+            except sqlite3.OperationalError:
+                # SQLite older than 3.34 has no trigram tokenizer
+                self.tokenizer = 'unicode61'
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(name, content='files', content_rowid='id')")
+            conn.executescript('''
+                CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+                    INSERT INTO files_fts(rowid, name) VALUES (new.id, new.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+                    INSERT INTO files_fts(files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS files_au AFTER UPDATE OF name ON files BEGIN
+                    INSERT INTO files_fts(files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO files_fts(rowid, name) VALUES (new.id, new.name);
+                END;
+            ''')
+            row = conn.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+            if row and row[0] != self.root:
+                conn.execute('DELETE FROM files')
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('root', ?)", (self.root,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def relative(self, full_path):
+        return os.path.relpath(os.path.normpath(full_path), self.root)
+
+    def row_for(self, full_path, stat_result, is_dir, scan):
+        name = os.path.basename(full_path)
+        return (
+            self.relative(full_path), name, 0 if is_dir else stat_result.st_size, stat_result.st_mtime,
+            None if is_dir else mimetypes.guess_type(name)[0], int(is_dir), scan
+        )
+
+    def upsert(self, conn, rows):
+        conn.executemany('''
+            INSERT INTO files (path, name, size, mtime, mime, is_dir, scan)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                size = excluded.size, mtime = excluded.mtime, mime = excluded.mime,
+                is_dir = excluded.is_dir, scan = excluded.scan
+        ''', rows)
+
+    def upsert_existing(self, conn, rows):
+        """Upsert the rows whose paths are still on disk and return how many that was."""
+        # Take the write lock before looking: a delete that committed earlier has already
+        # removed its file, and one that commits later deletes these rows again
+        conn.execute('BEGIN IMMEDIATE')
+        rows = [row for row in rows if os.path.lexists(os.path.join(self.root, row[0]))]
+        self.upsert(conn, rows)
+        return len(rows)
+
+    def next_scan(self):
+        # Strictly increasing, so a row written after a crawl started always outlives that crawl's prune
+        with self.lock:
+            self.last_scan = max(int(time.time() * 1000), self.last_scan + 1)
+            return self.last_scan
+
+    def iter_rows(self, top, scan):
+        stack = [top]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            stat_result = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        yield self.row_for(entry.path, stat_result, is_dir, scan)
+                        if is_dir:
+                            stack.append(entry.path)
+            except OSError:
+                continue
+
+    def crawl(self):
+        if not self.root or not os.path.isdir(self.root):
+            return 0
+        started = time.monotonic()
+        scan = self.next_scan()
+        count = 0
+        self.stats['crawling'] = True
+        conn = self.connect()
+        try:
+            batch = []
+            for row in self.iter_rows(self.root, scan):
+                batch.append(row)
+                if len(batch) >= BATCH_SIZE:
+                    with self.lock, conn:
+                        count += self.upsert_existing(conn, batch)
+                    batch = []
+                if self.stop_event.is_set():
+                    return count
+            with self.lock, conn:
+                count += self.upsert_existing(conn, batch)
+                conn.execute('DELETE FROM files WHERE scan < ?', (scan,))
+        finally:
+            conn.close()
+            self.stats['crawling'] = False
+        self.stats['crawls'] += 1
+        self.stats['last_crawl_files'] = count
+        self.stats['last_crawl_seconds'] = round(time.monotonic() - started, 2)
+        return count
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.crawl_requested.set()
+        self.thread = threading.Thread(target=self._run, name="search-crawler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.crawl_requested.set()
+
+    def request_crawl(self):
+        self.crawl_requested.set()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.crawl_requested.wait(self.recrawl_interval)
+            if self.stop_event.is_set():
+                break
+            self.crawl_requested.clear()
+            try:
+                self.crawl()
+            except Exception as e:
+                print(f"Search index crawl failed: {e}")
+
+    def update_path(self, full_path, recursive=True):
+        """Index a new or changed path, including everything below a folder unless recursive is off."""
+        try:
+            stat_result = os.lstat(full_path)
+        except OSError:
+            return self.remove_path(full_path)
+        is_dir = os.path.isdir(full_path) and not os.path.islink(full_path)
+        scan = self.next_scan()
+        rows = [self.row_for(full_path, stat_result, is_dir, scan)]
+        if is_dir and recursive:
+            rows.extend(self.iter_rows(full_path, scan))
+        conn = self.connect()
+        try:
+            with self.lock, conn:
+                self.upsert_existing(conn, rows)
+        finally:
+            conn.close()
+        self.stats['updates'] += 1
+
+    def remove_path(self, full_path):
+        relative = self.relative(full_path)
+        low, high = path_range(relative + os.sep)
+        conn = self.connect()
+        try:
+            with self.lock, conn:
+                conn.execute('DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)', (relative, low, high))
+        finally:
+            conn.close()
+        self.stats['updates'] += 1
+
+    def rename_path(self, old_full_path, new_full_path):
+        old = self.relative(old_full_path)
+        new = self.relative(new_full_path)
+        low, high = path_range(old + os.sep)
+        conn = self.connect()
+        try:
+            with self.lock, conn:
+                conn.execute('DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)', (new, new + os.sep, new + os.sep + PATH_MAX_CHAR))
+                conn.execute('UPDATE files SET path = ?, name = ? WHERE path = ?', (new, os.path.basename(new), old))
+                conn.execute('UPDATE files SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?', (new, len(old) + 1, low, high))
+        finally:
+            conn.close()
+        self.stats['updates'] += 1
+
+    def search(self, query, prefixes, under=None, limit=100, offset=0):
+        """Return matching rows visible through any of the given path prefixes."""
+        conditions = []
+        params = []
+        if self.tokenizer == 'trigram' and all(len(term) >= 3 for term in query.split()):
+            conditions.append('files.id IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)')
+            params.append(fts_query(query))
+        else:
+            for term in query.split():
+                conditions.append("files.name LIKE ? ESCAPE '\\'")
+                params.append('%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if '' not in prefixes:
+            if not prefixes:
+                return []
+            clauses = []
+            for prefix in prefixes:
+                clauses.append('(files.path >= ? AND files.path < ?)')
+                params.extend(path_range(prefix))
+            conditions.append('(' + ' OR '.join(clauses) + ')')
+        if under:
+            conditions.append('files.path >= ? AND files.path < ?')
+            params.extend(path_range(under.rstrip(os.sep) + os.sep))
+        params.extend([limit, offset])
+        conn = self.connect()
+        try:
+            rows = conn.execute(f'''
+                SELECT path, name, size, mtime, mime, is_dir FROM files
+                WHERE {' AND '.join(conditions)}
+                ORDER BY is_dir DESC, length(name), path
+                LIMIT ? OFFSET ?
+            ''', params).fetchall()
+        finally:
+            conn.close()
+        return [
+            {"path": row[0], "name": row[1], "size": row[2], "mtime": row[3], "mime": row[4], "is_dir": bool(row[5])}
+            for row in rows
+        ]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['tokenizer'] = self.tokenizer
+        try:
+            conn = self.connect()
+            try:
+                stats['entries'] = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            stats['entries'] = None
+        return stats
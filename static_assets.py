@@ -0,0 +1,227 @@
+import os
+import re
+import gzip
+import time
+import hashlib
+import threading
+import posixpath
+import mimetypes
+from flask import Response, request
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+MIN_COMPRESS_SIZE = 1024
+IMMUTABLE = 'public, max-age=31536000, immutable'
+HTML_REFERENCE = re.compile(r'''((?:href|src)=["']|url\(\s*['"]?)web/([^"'?#)\s]+)''')
+CSS_REFERENCE = re.compile(r'''(url\(\s*['"]?)(?![a-z]+:|/|#|data:)([^"'?#)\s]+)''')
+
+def guess_mimetype(path):
+    mime_type, _ = mimetypes.guess_type(path)
+    return mime_type or 'application/octet-stream'
+
+def compressible(mime_type):
+    return mime_type.startswith(COMPRESSIBLE_TYPES)
+
+class Asset:
+    __slots__ = ('relative', 'source', 'path', 'mime_type', 'version', 'size', 'variants')
+
+    def __init__(self, relative, source, path, mime_type, version, size):
+        self.relative = relative
+        self.source = source
+        self.path = path
+        self.mime_type = mime_type
+        self.version = version
+        self.size = size
+        self.variants = {}
+
+class AssetPipeline:
+    """Serves the web UI with content hashes, precompressed variants and revalidation.
+
+    At build time every file under root is hashed; HTML and CSS have their
+    references to other assets rewritten to carry a ?v=<hash> fingerprint,
+    and text assets get gzip (and brotli, when installed) variants written
+    next to them in cache_dir. Fingerprinted URLs are cached as immutable,
+    everything else revalidates against a strong ETag.
+    """
+
+    def __init__(self, root, cache_dir, check_interval=2.0, gzip_level=9, brotli_quality=11):
+        self.root = os.path.abspath(root)
+        self.cache_dir = cache_dir
+        self.check_interval = check_interval
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.assets = {}
+        self.stamps = {}
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.stats = {"builds": 0, "not_modified": 0, "served": 0, "encoded": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def scan(self):
+        stamps = {}
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+                stamps[relative] = (stat_result.st_mtime_ns, stat_result.st_size)
+        return stamps
+
+    def write_cache(self, name, data):
+        path = os.path.join(self.cache_dir, name)
+        if not os.path.exists(path):
+            # Several workers may build at once, whoever finishes first wins
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        return path
+
+    def rewrite(self, relative, text, versions):
+        def fingerprint(match, target):
+            version = versions.get(target)
+            return f"{match.group(0)}?v={version}" if version else match.group(0)
+        if relative.endswith('.css'):
+            base = posixpath.dirname(relative)
+            return CSS_REFERENCE.sub(lambda match: fingerprint(match, posixpath.normpath(posixpath.join(base, match.group(2)))), text)
+        return HTML_REFERENCE.sub(lambda match: fingerprint(match, match.group(2)), text)
+
+    def build(self):
+        stamps = self.scan()
+        assets = {}
+        versions = {}
+        # Plain files first, then CSS which points at them, then HTML which points at everything
+        order = sorted(stamps, key=lambda relative: (relative.endswith(('.html', '.htm')), relative.endswith('.css'), relative))
+        for relative in order:
+            source = os.path.join(self.root, *relative.split('/'))
+            mime_type = guess_mimetype(source)
+            try:
+                with open(source, 'rb') as file:
+                    data = file.read()
+            except OSError:
+                continue
+            rewritten = False
+            if relative.endswith(('.html', '.htm', '.css')):
+                try:
+                    text = data.decode('utf-8')
+                except UnicodeDecodeError:
+                    text = None
+                if text is not None:
+                    new_text = self.rewrite(relative, text, versions)
+                    if new_text != text:
+                        data = new_text.encode('utf-8')
+                        rewritten = True
+            digest = hashlib.sha256(data).hexdigest()
+            version = digest[:12]
+            versions[relative] = version
+            path = self.write_cache(digest, data) if rewritten else source
+            asset = Asset(relative, source, path, mime_type, version, len(data))
+            if compressible(mime_type) and len(data) >= MIN_COMPRESS_SIZE:
+                self.add_variant(asset, 'gzip', digest + '.gz', lambda: gzip.compress(data, self.gzip_level, mtime=0))
+                if brotli is not None:
+                    self.add_variant(asset, 'br', digest + '.br', lambda: brotli.compress(data, quality=self.brotli_quality))
+            assets[relative] = asset
+        self.prune({os.path.basename(path) for asset in assets.values() for path in [asset.path, *asset.variants.values()]})
+        with self.lock:
+            self.assets = assets
+            self.stamps = stamps
+            self.checked = time.monotonic()
+            self.stats['builds'] += 1
+        return self
+
+    def add_variant(self, asset, encoding, name, compress):
+        path = os.path.join(self.cache_dir, name)
+        if not os.path.exists(path):
+            encoded = compress()
+            if len(encoded) > asset.size * 0.9:
+                # Not worth a Content-Encoding round trip
+                return
+            path = self.write_cache(name, encoded)
+        asset.variants[encoding] = path
+
+    def prune(self, keep):
+        for name in os.listdir(self.cache_dir):
+            if name not in keep and not name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def refresh(self):
+        """Rebuild when any file under root changed, checking at most every check_interval seconds."""
+        if time.monotonic() - self.checked < self.check_interval:
+            return
+        self.checked = time.monotonic()
+        if self.scan() != self.stamps:
+            self.build()
+
+    def get(self, relative):
+        if safe_join(self.root, relative) is None:
+            return None
+        self.refresh()
+        with self.lock:
+            return self.assets.get(relative.replace(os.sep, '/'))
+
+    def version(self, relative):
+        asset = self.get(relative)
+        return asset.version if asset else None
+
+    def choose_encoding(self, asset):
+        best = None
+        for encoding in ('br', 'gzip'):
+            if encoding in asset.variants:
+                quality = request.accept_encodings[encoding]
+                if quality and (best is None or quality > best[1]):
+                    best = (encoding, quality)
+        return best[0] if best else None
+
+    def serve(self, relative, mime_type=None, retry=True):
+        """Return a response for the asset, or None if there is no such file."""
+        asset = self.get(relative)
+        if asset is None:
+            return None
+        encoding = self.choose_encoding(asset)
+        etag = f"{asset.version}-{encoding}" if encoding else asset.version
+        if request.if_none_match.contains(etag):
+            self.stats['not_modified'] += 1
+            response = Response(status=304)
+        else:
+            path = asset.variants[encoding] if encoding else asset.path
+            try:
+                file = open(path, 'rb')
+            except OSError:
+                if not retry:
+                    return None
+                # Another worker rebuilt after an update and pruned this variant
+                self.build()
+                return self.serve(relative, mime_type, retry=False)
+            response = Response(wrap_file(request.environ, file), mimetype=mime_type or asset.mime_type, direct_passthrough=True)
+            response.content_length = os.fstat(file.fileno()).st_size
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+                self.stats['encoded'] += 1
+            self.stats['served'] += 1
+        response.headers['ETag'] = f'"{etag}"'
+        response.headers['Vary'] = 'Accept-Encoding'
+        if request.args.get('v') == asset.version:
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['assets'] = len(self.assets)
+            stats['precompressed'] = sum(len(asset.variants) for asset in self.assets.values())
+        stats['brotli'] = brotli is not None
+        return stats
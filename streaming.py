@@ -0,0 +1,166 @@
+import os
+import mimetypes
+import secrets
+import unicodedata
+from urllib.parse import quote
+from flask import Response, request
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date, parse_date, parse_range_header
+
+CHUNK_SIZE = 256 * 1024
+MAX_RANGES = 32
+
+def guess_mimetype(path):
+    mime_type, _ = mimetypes.guess_type(path)
+    return mime_type or 'application/octet-stream'
+
+def wants_raw(mime_type):
+    """Pick raw bytes over the JSON envelope from ?mode= or the Accept header."""
+    mode = (request.args.get('mode') or '').lower()
+    if mode in ('raw', 'stream'):
+        return True
+    if mode == 'json':
+        return False
+    best = request.accept_mimetypes.best_match(['application/json', mime_type, 'application/octet-stream'])
+    return best is not None and best != 'application/json'
+
+def set_content_disposition(response, filename, as_attachment):
+    kind = 'attachment' if as_attachment else 'inline'
+    try:
+        filename.encode('ascii')
+        response.headers.set('Content-Disposition', kind, filename=filename)
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        response.headers.set('Content-Disposition', kind, filename=simple, **{'filename*': "UTF-8''" + quote(filename)})
+
+def iter_file(path, start=0, length=None, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            data = f.read(size)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+def make_etag(stat_result):
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+def not_modified(etag, mtime):
+    if_none_match = request.if_none_match
+    if if_none_match:
+        return if_none_match.contains(etag.strip('"')) or if_none_match.star_tag
+    if_modified_since = request.if_modified_since
+    if if_modified_since:
+        return int(mtime) <= int(if_modified_since.timestamp())
+    return False
+
+def precondition_failed(etag, mtime):
+    if_match = request.if_match
+    if if_match and not (if_match.star_tag or if_match.contains(etag.strip('"'))):
+        return True
+    if_unmodified_since = request.if_unmodified_since
+    if if_unmodified_since and int(mtime) > int(if_unmodified_since.timestamp()):
+        return True
+    return False
+
+def if_range_matches(etag, last_modified):
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"'):
+        return value == etag
+    if value.startswith('W/'):
+        return False
+    date = parse_date(value)
+    return date is not None and http_date(date) == last_modified
+
+def resolve_ranges(header, size):
+    """Return sorted, merged (start, end) pairs, [] if unsatisfiable, None to ignore Range."""
+    parsed = parse_range_header(header)
+    if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) > MAX_RANGES:
+        return None
+    ranges = []
+    for begin, end in parsed.ranges:
+        if begin < 0:
+            begin = max(0, size + begin)
+            end = size
+        else:
+            end = size if end is None else min(end, size)
+        if begin < end:
+            ranges.append([begin, end])
+    ranges.sort()
+    merged = []
+    for begin, end in ranges:
+        if merged and begin <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([begin, end])
+    return [(begin, end) for begin, end in merged]
+
+def multipart_body(path, ranges, size, mime_type, boundary):
+    for begin, end in ranges:
+        yield (f"\r\n--{boundary}\r\nContent-Type: {mime_type}\r\n"
+               f"Content-Range: bytes {begin}-{end - 1}/{size}\r\n\r\n").encode('latin-1')
+        yield from iter_file(path, begin, end - begin)
+    yield f"\r\n--{boundary}--\r\n".encode('latin-1')
+
+def multipart_length(ranges, size, mime_type, boundary):
+    length = len(f"\r\n--{boundary}--\r\n")
+    for begin, end in ranges:
+        length += len(f"\r\n--{boundary}\r\nContent-Type: {mime_type}\r\n"
+                      f"Content-Range: bytes {begin}-{end - 1}/{size}\r\n\r\n")
+        length += end - begin
+    return length
+
+def file_response(path, mime_type=None, as_attachment=False, download_name=None, chunk_size=CHUNK_SIZE):
+    """Stream a file in fixed-size chunks with Range and conditional request support.
+
+    Whole-file responses go through the server's wsgi.file_wrapper when
+    available, which lets gunicorn hand the descriptor to os.sendfile.
+    """
+    mime_type = mime_type or guess_mimetype(path)
+    stat_result = os.stat(path)
+    size = stat_result.st_size
+    etag = make_etag(stat_result)
+    last_modified = http_date(stat_result.st_mtime)
+
+    if precondition_failed(etag, stat_result.st_mtime):
+        response = Response(status=412)
+    elif not_modified(etag, stat_result.st_mtime):
+        response = Response(status=304)
+    else:
+        ranges = None
+        range_header = request.headers.get('Range')
+        if range_header and if_range_matches(etag, last_modified):
+            ranges = resolve_ranges(range_header, size)
+
+        if ranges is None:
+            f = open(path, 'rb')
+            body = wrap_file(request.environ, f, chunk_size)
+            response = Response(body, mimetype=mime_type, direct_passthrough=True)
+            response.content_length = size
+        elif not ranges:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+        elif len(ranges) == 1:
+            begin, end = ranges[0]
+            response = Response(iter_file(path, begin, end - begin, chunk_size), status=206, mimetype=mime_type, direct_passthrough=True)
+            response.content_length = end - begin
+            response.headers['Content-Range'] = f'bytes {begin}-{end - 1}/{size}'
+        else:
+            boundary = secrets.token_hex(16)
+            response = Response(multipart_body(path, ranges, size, mime_type, boundary), status=206, direct_passthrough=True)
+            response.headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+            response.content_length = multipart_length(ranges, size, mime_type, boundary)
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = last_modified
+    if response.status_code in (200, 206):
+        set_content_disposition(response, download_name or os.path.basename(path), as_attachment)
+    return response
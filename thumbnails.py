@@ -0,0 +1,239 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+SIZES = (64, 128, 256, 512, 1024)
+FORMATS = {'jpeg': ('jpg', 'image/jpeg'), 'webp': ('webp', 'image/webp')}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff')
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.ogg', '.avi', '.mov', '.mkv', '.m4v')
+
+def snap_size(value):
+    """Round a requested size up to the nearest cached size so requests share renditions."""
+    for size in SIZES:
+        if value <= size:
+            return size
+    return SIZES[-1]
+
+def render_image(source, dest, size, fmt, quality):
+    with Image.open(source) as image:
+        # Lets the JPEG decoder scale down while decoding instead of after
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(dest, format=fmt.upper(), quality=quality)
+
+def render_video(source, dest, size, fmt, quality, ffmpeg):
+    codec = {'jpeg': ['-c:v', 'mjpeg', '-q:v', str(max(2, 31 - quality * 29 // 100))], 'webp': ['-c:v', 'libwebp', '-quality', str(quality)]}[fmt]
+    for seek in ('1', '0'):
+        # Very short clips have no frame at one second
+        result = subprocess.run(
+            [ffmpeg, '-v', 'error', '-y', '-ss', seek, '-i', source, '-frames:v', '1',
+             '-vf', f'scale={size}:{size}:force_original_aspect_ratio=decrease', *codec, '-f', 'image2', dest],
+            stdin=subprocess.DEVNULL, capture_output=True, timeout=60
+        )
+        if result.returncode == 0 and os.path.exists(dest) and os.path.getsize(dest):
+            return
+    raise RuntimeError(result.stderr.decode('utf-8', errors='replace').strip() or "ffmpeg produced no frame")
+
+def render(source, dest, size, fmt, quality, ffmpeg=None):
+    """Write a rendition of source to dest; runs in a pool process."""
+    temp_path = f"{dest}.{os.getpid()}.tmp"
+    try:
+        if source.lower().endswith(VIDEO_EXTENSIONS):
+            render_video(source, temp_path, size, fmt, quality, ffmpeg)
+        else:
+            render_image(source, temp_path, size, fmt, quality)
+        os.replace(temp_path, dest)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.path.getsize(dest)
+
+class ThumbnailCache:
+    """Resized renditions rendered in worker processes and kept in an LRU disk cache.
+
+    A rendition is named after a hash of the source path, mtime, size and
+    the requested dimensions, so a changed file simply misses the cache and
+    its old renditions age out. Hits touch the file's mtime, which is what
+    eviction orders by once the cache grows past its budget.
+    """
+
+    def __init__(self, cache_dir, budget=512 * 1024 * 1024, workers=2, quality=80, render_timeout=60):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.workers = max(1, int(workers))
+        self.quality = quality
+        self.render_timeout = render_timeout
+        self.ffmpeg = shutil.which('ffmpeg')
+        self.pool = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.used = None
+        self.evicting = False
+        self.stats = {"hits": 0, "misses": 0, "renders": 0, "failures": 0, "evictions": 0, "prefetched": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def supports(self, path):
+        lowered = path.lower()
+        if lowered.endswith(IMAGE_EXTENSIONS):
+            return Image is not None
+        if lowered.endswith(VIDEO_EXTENSIONS):
+            return self.ffmpeg is not None
+        return False
+
+    def formats(self):
+        if Image is None:
+            return ['jpeg', 'webp'] if self.ffmpeg else []
+        Image.init()
+        return [fmt for fmt in FORMATS if fmt.upper() in Image.SAVE]
+
+    def key(self, full_path, stat_result, size, fmt):
+        raw = f"{full_path}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}\0{size}\0{fmt}"
+        return hashlib.blake2b(raw.encode('utf-8', errors='surrogateescape'), digest_size=16).hexdigest()
+
+    def cache_path(self, key, fmt):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{FORMATS[fmt][0]}")
+
+    def lookup(self, full_path, size, fmt):
+        """Return (key, cache path, whether it is already rendered) without rendering."""
+        key = self.key(full_path, os.stat(full_path), size, fmt)
+        path = self.cache_path(key, fmt)
+        return key, path, os.path.exists(path)
+
+    def executor(self):
+        if self.pool is None:
+            # Forking a threaded worker can copy locks other threads hold, so start renderers clean
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+        return self.pool
+
+    def submit(self, full_path, size, fmt):
+        key, path, cached = self.lookup(full_path, size, fmt)
+        if cached:
+            return key, path, None
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    future = self.executor().submit(render, full_path, path, size, fmt, self.quality, self.ffmpeg)
+                except BrokenProcessPool:
+                    # A decoder crashed a worker, start over with a fresh pool
+                    self.pool = None
+                    future = self.executor().submit(render, full_path, path, size, fmt, self.quality, self.ffmpeg)
+                self.pending[key] = future
+                future.add_done_callback(lambda done, key=key: self._rendered(key, done))
+        return key, path, future
+
+    def _rendered(self, key, future):
+        with self.lock:
+            self.pending.pop(key, None)
+            if future.exception() is not None:
+                self.stats['failures'] += 1
+                return
+            self.stats['renders'] += 1
+            if self.used is not None:
+                self.used += future.result()
+            over_budget = (self.used is None or self.used > self.budget) and not self.evicting
+            if over_budget:
+                self.evicting = True
+        if over_budget:
+            threading.Thread(target=self.evict, name="thumbnail-evict", daemon=True).start()
+
+    def get(self, full_path, size, fmt):
+        """Return (key, cache path), rendering and waiting for it on a miss."""
+        key, path, future = self.submit(full_path, size, fmt)
+        if future is None:
+            with self.lock:
+                self.stats['hits'] += 1
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return key, path
+        with self.lock:
+            self.stats['misses'] += 1
+        future.result(self.render_timeout)
+        return key, path
+
+    def prefetch(self, full_paths, sizes, fmt):
+        queued = cached = skipped = 0
+        for full_path in full_paths:
+            if not self.supports(full_path):
+                skipped += 1
+                continue
+            for size in sizes:
+                try:
+                    _, _, future = self.submit(full_path, size, fmt)
+                except OSError:
+                    skipped += 1
+                    continue
+                if future is None:
+                    cached += 1
+                else:
+                    queued += 1
+        with self.lock:
+            self.stats['prefetched'] += queued
+        return {"queued": queued, "cached": cached, "skipped": skipped}
+
+    def evict(self):
+        """Delete the least recently used renditions until the cache is under 90% of its budget."""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tmp') and stat_result.st_mtime > time.time() - 3600:
+                    continue
+                entries.append((stat_result.st_mtime, stat_result.st_size, path))
+                total += stat_result.st_size
+        evicted = 0
+        if total > self.budget:
+            entries.sort()
+            target = self.budget * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+        with self.lock:
+            self.used = total
+            self.evicting = False
+            self.stats['evictions'] += evicted
+        return evicted
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending'] = len(self.pending)
+            stats['used_bytes'] = self.used
+        stats['budget_bytes'] = self.budget
+        stats['pillow'] = Image is not None
+        stats['ffmpeg'] = self.ffmpeg is not None
+        return stats
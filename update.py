@@ -140,6 +140,11 @@ def update():
         with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cloud_connection.py"), 'w') as file:
             file.write(cloud_conn)
             file.close()
+        for module_name in ["streaming.py", "archive.py", "listing.py", "search_index.py", "watcher.py", "wsgi.py", "jwt_keys.py", "sampler.py", "jobs.py", "uploads.py", "dedup.py", "thumbnails.py", "static_assets.py", "compression.py", "permissions.py", "ftp_handlers.py", "quotas.py"]:
+            module_py = requests.get("https://raw.githubusercontent.com/bbarni2020/Shareify/refs/heads/main/current/" + module_name).text
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module_name), 'w') as file:
+                file.write(module_py)
+                file.close()
         with open(settings_file, 'w') as file:
             settings['version'] = requests.get("https://raw.githubusercontent.com/bbarni2020/Shareify/refs/heads/main/info/version").text
             json.dump(settings, file, indent=4)
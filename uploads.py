@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import shutil
+import secrets
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+WRITE_BLOCK = 1024 * 1024
+CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512')
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def parse_checksum(header):
+    """Parse a tus style 'Upload-Checksum: <algorithm> <base64 digest>' header."""
+    if not header:
+        return None
+    try:
+        algorithm, encoded = header.strip().split(' ', 1)
+        digest = base64.b64decode(encoded.strip(), validate=True)
+    except ValueError:
+        raise UploadError("Invalid Upload-Checksum header")
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise UploadError("Unsupported checksum algorithm")
+    return algorithm, digest
+
+def merge_range(ranges, start, end):
+    merged = []
+    for low, high in sorted(ranges + [[start, end]]):
+        if merged and low <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return merged
+
+class UploadStore:
+    """Resumable uploads written straight into a sparse temp file next to the target.
+
+    Chunks can arrive at any offset and in parallel. Each session's state
+    (received byte ranges) lives in a JSON file guarded by a file lock, so
+    any worker can accept the next chunk.
+    """
+
+    def __init__(self, state_dir, max_age=24 * 3600):
+        self.state_dir = state_dir
+        self.max_age = max_age
+        self.thread_lock = threading.Lock()
+        self.stats = {"created": 0, "chunks": 0, "bytes": 0, "completed": 0, "checksum_failures": 0}
+        os.makedirs(state_dir, exist_ok=True)
+
+    def state_path(self, upload_id):
+        if not upload_id or not all(c in '0123456789abcdef' for c in upload_id):
+            raise UploadError("Upload not found", 404)
+        return os.path.join(self.state_dir, upload_id + '.json')
+
+    @contextmanager
+    def locked(self, upload_id):
+        state_path = self.state_path(upload_id)
+        with self.thread_lock if fcntl is None else open(state_path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield state_path
+
+    def load(self, state_path):
+        try:
+            with open(state_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            raise UploadError("Upload not found", 404)
+
+    def save(self, state_path, upload):
+        upload['updated'] = time.time()
+        temp_path = f"{state_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(upload, file)
+        os.replace(temp_path, state_path)
+
+    def create(self, owner, relative_path, dest_path, length, checksum=None):
+        if length < 0:
+            raise UploadError("Invalid upload length")
+        dest_dir = os.path.dirname(dest_path)
+        if length > shutil.disk_usage(dest_dir).free:
+            raise UploadError("Not enough free space", 507)
+        self.prune()
+        upload_id = secrets.token_hex(12)
+        temp_path = os.path.join(dest_dir, f".{os.path.basename(dest_path)}.{upload_id}.part")
+        with open(temp_path, 'wb') as file:
+            # Reserve the size without writing anything, the file stays sparse
+            file.truncate(length)
+        upload = {
+            "id": upload_id,
+            "owner": owner,
+            "path": relative_path,
+            "dest": dest_path,
+            "temp": temp_path,
+            "length": length,
+            "checksum": [checksum[0], base64.b64encode(checksum[1]).decode('ascii')] if checksum else None,
+            "ranges": [],
+            "created": time.time()
+        }
+        with self.locked(upload_id) as state_path:
+            self.save(state_path, upload)
+        self.stats['created'] += 1
+        return self.describe(upload)
+
+    def get(self, upload_id):
+        return self.load(self.state_path(upload_id))
+
+    def describe(self, upload):
+        ranges = upload['ranges']
+        offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+        received = sum(high - low for low, high in ranges)
+        return {
+            "id": upload['id'],
+            "path": upload['path'],
+            "length": upload['length'],
+            "offset": offset,
+            "received": received,
+            "ranges": ranges,
+            "complete": received == upload['length']
+        }
+
+    def write_chunk(self, upload_id, offset, length, stream, checksum=None):
+        """Copy `length` bytes from stream to the temp file at offset, verifying the checksum."""
+        upload = self.get(upload_id)
+        if offset < 0 or length < 0 or offset + length > upload['length']:
+            raise UploadError("Chunk is outside the upload", 416)
+        hasher = hashlib.new(checksum[0]) if checksum else None
+        written = 0
+        try:
+            fd = os.open(upload['temp'], os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        except FileNotFoundError:
+            raise UploadError("Upload not found", 404)
+        try:
+            position = offset
+            while written < length:
+                block = stream.read(min(WRITE_BLOCK, length - written))
+                if not block:
+                    break
+                if hasher:
+                    hasher.update(block)
+                if hasattr(os, 'pwrite'):
+                    os.pwrite(fd, block, position)
+                else:
+                    os.lseek(fd, position, os.SEEK_SET)
+                    os.write(fd, block)
+                position += len(block)
+                written += len(block)
+        finally:
+            os.close(fd)
+        self.stats['bytes'] += written
+        if written != length:
+            # Connection dropped mid-chunk, nothing is recorded and the client resends it
+            raise UploadError("Incomplete chunk", 400)
+        if hasher and hasher.digest() != checksum[1]:
+            self.stats['checksum_failures'] += 1
+            raise UploadError("Checksum mismatch", 460)
+        with self.locked(upload_id) as state_path:
+            upload = self.load(state_path)
+            if length:
+                upload['ranges'] = merge_range(upload['ranges'], offset, offset + length)
+            self.save(state_path, upload)
+        self.stats['chunks'] += 1
+        return self.describe(upload)
+
+    def finish(self, upload_id):
+        with self.locked(upload_id) as state_path:
+            upload = self.load(state_path)
+            if not self.describe(upload)['complete']:
+                raise UploadError("Upload is incomplete", 409)
+            if upload.get('checksum'):
+                algorithm, digest = upload['checksum']
+                hasher = hashlib.new(algorithm)
+                with open(upload['temp'], 'rb') as file:
+                    for block in iter(lambda: file.read(WRITE_BLOCK), b''):
+                        hasher.update(block)
+                if base64.b64encode(hasher.digest()).decode('ascii') != digest:
+                    self.stats['checksum_failures'] += 1
+                    raise UploadError("Checksum mismatch", 460)
+            with open(upload['temp'], 'rb+') as file:
+                os.fsync(file.fileno())
+            os.replace(upload['temp'], upload['dest'])
+            os.remove(state_path)
+        self.remove_lock(upload_id)
+        self.stats['completed'] += 1
+        return upload
+
+    def abort(self, upload_id):
+        with self.locked(upload_id) as state_path:
+            upload = self.load(state_path)
+            for path in (upload['temp'], state_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self.remove_lock(upload_id)
+        return upload
+
+    def remove_lock(self, upload_id):
+        try:
+            os.remove(self.state_path(upload_id) + '.lock')
+        except OSError:
+            pass
+
+    def prune(self):
+        """Drop sessions that have not received a chunk within max_age."""
+        cutoff = time.time() - self.max_age
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.json'):
+                continue
+            state_path = os.path.join(self.state_dir, name)
+            try:
+                if os.path.getmtime(state_path) < cutoff:
+                    self.abort(name[:-5])
+            except (OSError, UploadError):
+                continue
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['active'] = sum(1 for name in os.listdir(self.state_dir) if name.endswith('.json'))
+        return stats
@@ -0,0 +1,346 @@
+import os
+import sys
+import time
+import json
+import select
+import struct
+import sqlite3
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT_HEADER = struct.Struct('iIII')
+
+class ChangeFeed:
+    """Journal of filesystem changes with resumable sequence numbers.
+
+    Events live in SQLite so every worker process can serve the same
+    sequence, and in-process subscribers are called as events arrive.
+    """
+
+    def __init__(self, db_path, retention=100000):
+        self.db_path = db_path
+        self.retention = retention
+        self.subscribers = []
+        self.condition = threading.Condition()
+        self.stats = {"published": 0, "batches": 0}
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        return conn
+
+    def initialize(self):
+        conn = self.connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    time REAL NOT NULL,
+                    event TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    is_dir INTEGER NOT NULL,
+                    old_path TEXT
+                )
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def publish(self, events):
+        if not events:
+            return
+        now = time.time()
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT INTO changes (time, event, path, is_dir, old_path) VALUES (?, ?, ?, ?, ?)',
+                    [(now, e['event'], e['path'], int(e['is_dir']), e.get('old_path')) for e in events]
+                )
+                conn.execute('DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?', (self.retention,))
+        finally:
+            conn.close()
+        self.stats['published'] += len(events)
+        self.stats['batches'] += 1
+        with self.condition:
+            self.condition.notify_all()
+        for callback in self.subscribers:
+            try:
+                callback(events)
+            except Exception as e:
+                print(f"Change subscriber failed: {e}")
+
+    def head(self):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT MIN(seq), MAX(seq) FROM changes').fetchone()
+        finally:
+            conn.close()
+        return (row[0] or 0), (row[1] or 0)
+
+    def read(self, since, limit=1000):
+        """Return (events, oldest_seq, newest_seq) for events after `since`."""
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                'SELECT seq, time, event, path, is_dir, old_path FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                (since, limit)
+            ).fetchall()
+            oldest, newest = conn.execute('SELECT MIN(seq), MAX(seq) FROM changes').fetchone()
+        finally:
+            conn.close()
+        events = [
+            {"seq": r[0], "time": r[1], "event": r[2], "path": r[3], "is_dir": bool(r[4]), "old_path": r[5]}
+            for r in rows
+        ]
+        return events, (oldest or 0), (newest or 0)
+
+    def wait(self, since, timeout):
+        """Block until an event newer than `since` exists or the timeout passes."""
+        deadline = time.monotonic() + timeout
+        while True:
+            events, oldest, newest = self.read(since, limit=1)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return bool(events)
+            # Events published by other worker processes only show up in
+            # SQLite, so wake up at least once a second to look
+            with self.condition:
+                self.condition.wait(min(1.0, remaining))
+
+class Watcher:
+    """Base class turning filesystem activity under root into feed events."""
+
+    def __init__(self, root, feed):
+        self.root = os.path.normpath(root)
+        self.feed = feed
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def relative(self, full_path):
+        return os.path.relpath(full_path, self.root)
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name=f"{self.kind}-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(5)
+            self.thread = None
+
+    def event(self, kind, full_path, is_dir, old_full_path=None):
+        event = {"event": kind, "path": self.relative(full_path), "is_dir": is_dir}
+        if old_full_path:
+            event["old_path"] = self.relative(old_full_path)
+        return event
+
+class InotifyWatcher(Watcher):
+    kind = 'inotify'
+
+    def __init__(self, root, feed):
+        super().__init__(root, feed)
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.ctypes = ctypes
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.watch_errors = 0
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            self.watch_errors += 1
+            if self.watch_errors == 1:
+                print(f"inotify watch failed for {path} (errno {self.ctypes.get_errno()}); raise fs.inotify.max_user_watches")
+            return False
+        self.watches[wd] = path
+        return True
+
+    def add_tree(self, top, report=False):
+        """Watch top and every folder below it, returning created events when report is set."""
+        events = []
+        for current, dirs, files in os.walk(top):
+            self.add_watch(current)
+            if report:
+                if current != top:
+                    events.append(self.event('created', current, True))
+                events.extend(self.event('created', os.path.join(current, name), False) for name in files)
+        return events
+
+    def move_watches(self, old_path, new_path):
+        prefix = old_path + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == old_path:
+                self.watches[wd] = new_path
+            elif path.startswith(prefix):
+                self.watches[wd] = new_path + path[len(old_path):]
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        raw = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            raw.append((wd, mask, cookie, os.fsdecode(name)))
+        return raw
+
+    def translate(self, raw):
+        events = []
+        moved_from = {}
+        for wd, mask, cookie, name in raw:
+            if mask & IN_Q_OVERFLOW:
+                events.append({"event": "rescan", "path": "", "is_dir": True})
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            parent = self.watches.get(wd)
+            if parent is None or not name:
+                continue
+            full_path = os.path.join(parent, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = (full_path, is_dir)
+            elif mask & IN_MOVED_TO:
+                source = moved_from.pop(cookie, None)
+                if source:
+                    if is_dir:
+                        self.move_watches(source[0], full_path)
+                    events.append(self.event('moved', full_path, is_dir, source[0]))
+                elif is_dir:
+                    events.append(self.event('created', full_path, True))
+                    events.extend(self.add_tree(full_path, report=True))
+                else:
+                    events.append(self.event('created', full_path, False))
+            elif mask & IN_CREATE:
+                events.append(self.event('created', full_path, is_dir))
+                if is_dir:
+                    # Files can land in a new folder before its watch exists
+                    events.extend(self.add_tree(full_path, report=True))
+            elif mask & IN_DELETE:
+                events.append(self.event('deleted', full_path, is_dir))
+            elif mask & (IN_CLOSE_WRITE | IN_ATTRIB):
+                events.append(self.event('modified', full_path, is_dir))
+        # Moved out of the tree without a matching IN_MOVED_TO
+        for full_path, is_dir in moved_from.values():
+            events.append(self.event('deleted', full_path, is_dir))
+        return coalesce(events)
+
+    def _run(self):
+        self.add_tree(self.root)
+        try:
+            while not self.stop_event.is_set():
+                ready, _, _ = select.select([self.fd], [], [], 1.0)
+                if not ready:
+                    continue
+                # Give bursts (untar, rsync) a moment so they arrive as one batch
+                time.sleep(0.05)
+                try:
+                    self.feed.publish(self.translate(self.read_events()))
+                except Exception as e:
+                    print(f"Watcher error: {e}")
+        finally:
+            os.close(self.fd)
+
+class PollingWatcher(Watcher):
+    kind = 'polling'
+
+    def __init__(self, root, feed, interval=10):
+        super().__init__(root, feed)
+        self.interval = interval
+
+    def snapshot(self):
+        state = {}
+        for current, dirs, files in os.walk(self.root):
+            for name in dirs:
+                full_path = os.path.join(current, name)
+                state[full_path] = (True, 0, 0)
+            for name in files:
+                full_path = os.path.join(current, name)
+                try:
+                    stat_result = os.stat(full_path)
+                except OSError:
+                    continue
+                state[full_path] = (False, stat_result.st_mtime_ns, stat_result.st_size)
+        return state
+
+    def diff(self, before, after):
+        events = []
+        for full_path, info in after.items():
+            previous = before.get(full_path)
+            if previous is None:
+                events.append(self.event('created', full_path, info[0]))
+            elif previous != info and not info[0]:
+                events.append(self.event('modified', full_path, False))
+        for full_path, info in before.items():
+            if full_path not in after:
+                events.append(self.event('deleted', full_path, info[0]))
+        return events
+
+    def _run(self):
+        state = self.snapshot()
+        while not self.stop_event.wait(self.interval):
+            try:
+                current = self.snapshot()
+                self.feed.publish(self.diff(state, current))
+                state = current
+            except Exception as e:
+                print(f"Watcher error: {e}")
+
+def coalesce(events):
+    """Drop repeats within a batch, keeping 'created' over a following 'modified'."""
+    result = []
+    index = {}
+    for event in events:
+        key = event['path']
+        previous = index.get(key)
+        if previous is not None and event['event'] == 'modified' and result[previous]['event'] in ('created', 'modified'):
+            continue
+        index[key] = len(result)
+        result.append(event)
+    return result
+
+def create_watcher(root, feed, poll_interval=10):
+    """Use inotify on Linux and fall back to polling elsewhere or if it is unavailable."""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, feed)
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({e}), falling back to polling")
+    return PollingWatcher(root, feed, poll_interval)
+
+def format_sse(event):
+    return f"id: {event['seq']}\nevent: change\ndata: {json.dumps(event)}\n\n"
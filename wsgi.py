@@ -1,10 +1,15 @@
 import sys
 import os
 import json
+import time
+import threading
+import subprocess
 import update
 
 sys.path.insert(0, os.path.dirname(__file__))
 
+SERVER_MODES = ('auto', 'gunicorn', 'threaded', 'wsgiref')
+
 def load_settings():
     settings_file = os.path.join(os.path.dirname(__file__), "settings/settings.json")
     if os.path.exists(settings_file):
@@ -20,21 +25,153 @@ def load_settings():
 
 settings = load_settings()
 
-from main import create_app
+def server_mode():
+    mode = (settings or {}).get('server', 'auto')
+    if mode not in SERVER_MODES:
+        print(f"Unknown server mode '{mode}', using auto.")
+        mode = 'auto'
+    if mode == 'auto':
+        if os.name == 'nt':
+            return 'threaded'
+        try:
+            import gunicorn
+            return 'gunicorn'
+        except ImportError:
+            return 'threaded'
+    return mode
 
-application = create_app()
+def default_workers():
+    return min((os.cpu_count() or 1) * 2 + 1, 12)
 
-if __name__ == "__main__":
+class FTPSupervisor:
+    """Keeps the FTP server process in line with the ftp flag in settings.json.
+
+    Workers only flip the flag, so FTP runs exactly once however many
+    workers there are, and survives worker restarts.
+    """
+
+    def __init__(self, interval=2):
+        self.interval = interval
+        self.process = None
+        self.started = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="ftp-supervisor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.stop_process()
+
+    def start_process(self):
+        print("Starting FTP server process...")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--ftp'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        self.started = time.monotonic()
+
+    def stop_process(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            current = load_settings() or {}
+            running = self.process is not None and self.process.poll() is None
+            if current.get('ftp') and not running:
+                # Back off when the process keeps dying, e.g. the port is taken
+                if time.monotonic() - self.started > 10:
+                    self.start_process()
+            elif not current.get('ftp') and running:
+                print("Stopping FTP server process...")
+                self.stop_process()
+            self.stop_event.wait(self.interval)
+
+def run_gunicorn(host, port):
+    from gunicorn.app.base import BaseApplication
+
+    supervisor = FTPSupervisor()
+
+    class ShareifyApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Imported per worker so background threads start after the fork
+            from main import create_app
+            return create_app(start_ftp=False)
+
+    config = settings or {}
+    bind = f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+    options = {
+        'bind': bind,
+        'worker_class': 'gthread',
+        'workers': config.get('server_workers') or default_workers(),
+        'threads': config.get('server_threads', 8),
+        'keepalive': config.get('server_keepalive', 5),
+        'timeout': config.get('server_timeout', 120),
+        'graceful_timeout': config.get('server_graceful_timeout', 30),
+        # Recycling the leader worker loses the jobs it supervises, so it is opt-in
+        'max_requests': config.get('server_max_requests', 0),
+        'max_requests_jitter': config.get('server_max_requests_jitter', 1000),
+        'when_ready': lambda server: supervisor.start(),
+        'on_exit': lambda server: supervisor.stop(),
+    }
+    print(f"Server running on http://{host}:{port} ({options['workers']} workers x {options['threads']} threads)")
+    ShareifyApplication(options).run()
+
+def run_threaded(host, port):
+    from werkzeug.serving import make_server
+    from main import create_app
+
+    server = make_server(host, port, create_app(), threaded=True)
+    print(f"Server running on http://{host}:{port} (threaded)")
+    server.serve_forever()
+
+def run_wsgiref(host, port):
     from wsgiref.simple_server import make_server
-    
+    from main import create_app
+
+    server = make_server(host, port, create_app())
+    print(f"Server running on http://{host}:{port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    if '--ftp' in sys.argv:
+        from main import serve_ftp_forever
+        serve_ftp_forever()
+        sys.exit(0)
+
     if settings:
         host = settings.get('host', '0.0.0.0')
         port = settings.get('port', 8000)
     else:
         host = '0.0.0.0'
         port = 8000
-    
+
     update.kill_process_on_port(port)
-    server = make_server(host, port, application)
-    print(f"Server running on http://{host}:{port}")
-    server.serve_forever()
+    mode = server_mode()
+    if mode == 'gunicorn':
+        run_gunicorn(host, port)
+    elif mode == 'threaded':
+        run_threaded(host, port)
+    else:
+        run_wsgiref(host, port)
+elif __name__ != "__mp_main__":
+    # Thumbnail renderer processes re-run this script under __mp_main__ and need no app
+    from main import create_app
+
+    application = create_app()